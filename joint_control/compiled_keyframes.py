@@ -0,0 +1,166 @@
+'''Choregraphe keyframes compiled into flat arrays for vectorized evaluation
+
+The keys of all joints are stored one after the other as rows of one
+table, each with the cubic of the segment starting at the key. It is
+converted from the Bezier control points
+
+    P0 = angle of key i, P1 = P0 + out handle of key i,
+    P2 = P3 + in handle of key i + 1, P3 = angle of key i + 1
+
+to a + b u + c u^2 + d u^3, so it is evaluated with Horner's rule. The
+rows before the first and of the last key are constant. The times are
+shifted by joint index * shift into one increasing array, so a single
+np.searchsorted finds the active segment of every joint. The result is
+the same as interpolate_keyframes, for any number of joints and keys
+the cost per tick is a fixed number of array operations.
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'software_installation'))
+
+import numpy as np
+
+from spark_agent import JOINT_INDEX
+
+
+def _is_key(key):
+    return isinstance(key, (list, tuple)) and len(key) == 3
+
+
+def _is_handle(handle):
+    return isinstance(handle, (list, tuple)) and len(handle) == 3
+
+
+def _angle(key):
+    return key[0] if isinstance(key, (list, tuple)) else key
+
+
+class CompiledKeyframes(object):
+    '''keyframes (names, times, keys) as arrays, evaluate(t) returns all joint angles
+
+    Segments with malformed keys hold the angle of their first key, like
+    interpolate_keyframes does.
+    '''
+    name = None  # set by MotionLibrary
+
+    def __init__(self, keyframes):
+        names, times, keys = keyframes
+        self.names = []
+        # one row per key and one in front of the first key of each joint:
+        # time, 1 / duration, cubic coefficients a + b u + c u^2 + d u^3
+        rows = []
+        for name, joint_times, joint_keys in zip(names, times, keys):
+            n = min(len(joint_times), len(joint_keys))
+            if not n:
+                continue
+            self.names.append(name)
+            rows.append([-np.inf, 1.0, float(_angle(joint_keys[0])), 0.0, 0.0, 0.0])
+            for i in range(n):
+                t0 = float(joint_times[i])
+                a0 = float(_angle(joint_keys[i]))
+                row = [t0, 1.0, a0, 0.0, 0.0, 0.0]
+                if i + 1 < n:
+                    k0, k1 = joint_keys[i], joint_keys[i + 1]
+                    t1 = float(joint_times[i + 1])
+                    if t1 > t0 and _is_key(k0) and _is_key(k1) and _is_handle(k0[2]) and _is_handle(k1[1]):
+                        a3 = float(k1[0])
+                        p0, p1, p2, p3 = a0, a0 + k0[2][2], a3 + k1[1][2], a3
+                        row[3:] = [3 * (p1 - p0), 3 * (p0 - 2 * p1 + p2), p3 - 3 * p2 + 3 * p1 - p0]
+                    if t1 > t0:
+                        row[1] = 1.0 / (t1 - t0)
+                rows.append(row)
+        table = np.array(rows).reshape(-1, 6)
+        times = table[:, 0]
+        finite = np.isfinite(times)
+        t_min = times[finite].min() if finite.any() else 0.0
+        t_max = times[finite].max() if finite.any() else 0.0
+        # times are clipped to [t_min - 1, t_max + 1] before the lookup
+        times[~finite] = t_min - 2.0
+        shift = t_max - t_min + 4.0
+        joint_of_row = np.cumsum(~finite) - 1
+        shifted_times = times + np.arange(len(self.names))[joint_of_row] * shift
+        # searchsorted returns the row after the active one, hence the dummy row 0
+        table = np.vstack([np.zeros((1, 6)), table])
+        self._init_arrays(self.names, table, shifted_times, t_min, t_max)
+
+    @classmethod
+    def from_arrays(cls, names, table, shifted_times, t_min, t_max):
+        '''rebuild compiled keyframes from the arrays returned by to_arrays()'''
+        self = cls.__new__(cls)
+        self._init_arrays([str(name) for name in names], table, shifted_times, float(t_min), float(t_max))
+        return self
+
+    def to_arrays(self):
+        '''return {name: ndarray} from which from_arrays() rebuilds self'''
+        return {'names': np.array(self.names), 'table': self.table, 'shifted_times': self.shifted_times,
+                't_min': np.float64(self.t_min), 't_max': np.float64(self.t_max)}
+
+    def _init_arrays(self, names, table, shifted_times, t_min, t_max):
+        self.names = names
+        self.table = table
+        self.shifted_times = shifted_times
+        self.t_min = t_min
+        self.t_max = t_max
+        self.shift = t_max - t_min + 4.0
+        self.offsets = np.arange(len(names)) * self.shift
+        # joint of each row of table[1:], its times are in [t_min - 2, t_max]
+        # (one second of slack against rounding)
+        self.row_joints = ((shifted_times - (t_min - 3.0)) // self.shift).astype(np.intp)
+
+        # position of each joint in JOINT_NAMES, the others (e.g. LHand) are extra
+        self.indices = np.array([JOINT_INDEX.get(name, -1) for name in self.names], dtype=np.intp)
+        self.known = self.indices >= 0
+        self.joint_indices = self.indices[self.known]
+        self.extra_names = [name for name, i in zip(self.names, self.indices) if i < 0]
+
+    @property
+    def duration(self):
+        return self.t_max
+
+    def scaled(self, rate):
+        '''return these keyframes played rate times as fast'''
+        table = self.table.copy()
+        times = table[1:, 0]
+        times /= rate
+        table[1:, 1] *= rate
+        t_min, t_max = self.t_min / rate, self.t_max / rate
+        first = np.ones(len(times), dtype=bool)
+        first[1:] = self.row_joints[1:] != self.row_joints[:-1]
+        times[first] = t_min - 2.0
+        shifted_times = times + self.row_joints * (t_max - t_min + 4.0)
+        scaled = CompiledKeyframes.from_arrays(self.names, table, shifted_times, t_min, t_max)
+        scaled.name = self.name
+        return scaled
+
+    def evaluate(self, t):
+        '''return the angles of all joints (in self.names order) at time t,
+        shape (n_joints,) for a scalar t or (len(t), n_joints) for an array of times
+        '''
+        if np.ndim(t):
+            t = np.clip(t, self.t_min - 1.0, self.t_max + 1.0)[:, np.newaxis]
+        else:
+            t = min(max(t, self.t_min - 1.0), self.t_max + 1.0)
+        rows = self.table[np.searchsorted(self.shifted_times, self.offsets + t, side='right')]
+        u = t - rows[..., 0]
+        u *= rows[..., 1]
+        angles = rows[..., 5] * u
+        angles += rows[..., 4]
+        angles *= u
+        angles += rows[..., 3]
+        angles *= u
+        angles += rows[..., 2]
+        return angles
+
+    def velocity(self, t):
+        '''return the angular velocities of all joints at time t, shaped like evaluate(t)'''
+        if np.ndim(t):
+            t = np.clip(t, self.t_min - 1.0, self.t_max + 1.0)[:, np.newaxis]
+        else:
+            t = min(max(t, self.t_min - 1.0), self.t_max + 1.0)
+        rows = self.table[np.searchsorted(self.shifted_times, self.offsets + t, side='right')]
+        u = (t - rows[..., 0]) * rows[..., 1]
+        return (rows[..., 3] + (2 * rows[..., 4] + 3 * rows[..., 5] * u) * u) * rows[..., 1]
+
+    def to_dict(self, t):
+        '''return {joint name: angle} at time t like interpolate_keyframes'''
+        return dict(zip(self.names, self.evaluate(t).tolist()))
@@ -0,0 +1,184 @@
+'''Keyframe motions loaded once, validated, compiled and cached
+
+The functions in `keyframes` build their nested lists anew on every
+call. MotionLibrary calls each of them at most once: the result is
+checked by validate_keyframes, compiled to CompiledKeyframes and kept
+in an LRU cache of `capacity` motions.
+
+The compiled arrays of all motions can be written with save() to one
+.npy file of float64 values and an index `<file>.json` with the offset,
+joint names and time range of each motion. A library created with that
+file maps it with mmap, so a motion is two array views instead of
+running the keyframe module, unless the module was changed after the
+file was written:
+
+    python motion_library.py          # writes motions.npy
+    library = MotionLibrary(MOTIONS_FILE)
+    agent.keyframes = library['rightBellyToStand']
+'''
+import json
+import os
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+
+import keyframes
+from compiled_keyframes import CompiledKeyframes
+
+MOTIONS = ['hello', 'wipe_forehead', 'leftBackToStand', 'leftBellyToStand',
+           'rightBackToStand', 'rightBellyToStand']
+MOTIONS_FILE = path.join(path.dirname(path.abspath(__file__)), 'motions.npy')
+KEYFRAMES_DIR = path.dirname(path.abspath(keyframes.__file__))
+
+
+def load_keyframes(name):
+    '''return the (names, times, keys) of motion name from the keyframes package'''
+    motion = getattr(keyframes, name, None)
+    if motion is None:
+        raise KeyError('unknown motion %r' % name)
+    if name == 'wipe_forehead':
+        return motion(None)  # its argument is not used
+    return motion()
+
+
+def source_mtime(name):
+    '''modification time of the keyframe module of motion name, 0 if unknown'''
+    try:
+        return os.stat(path.join(KEYFRAMES_DIR, name + '.py')).st_mtime
+    except OSError:
+        return 0.0
+
+
+def _is_handle(handle):
+    return (isinstance(handle, (list, tuple)) and len(handle) == 3 and
+            all(np.isfinite(float(x)) for x in handle))
+
+
+def validate_keyframes(keyframes, name='keyframes'):
+    '''raise ValueError if keyframes is not (names, times, keys) in Choregraphe format
+
+    Every joint needs as many keys as times, increasing times and keys
+    [angle, [3, dt, dangle], [3, dt, dangle]] with finite numbers.
+    '''
+    if not isinstance(keyframes, (list, tuple)) or len(keyframes) != 3:
+        raise ValueError('%s: expected (names, times, keys)' % name)
+    names, times, keys = keyframes
+    if not len(names) == len(times) == len(keys):
+        raise ValueError('%s: %d names, %d times and %d keys' % (name, len(names), len(times), len(keys)))
+    if len(set(names)) != len(names):
+        raise ValueError('%s: duplicate joint names' % name)
+    for joint, joint_times, joint_keys in zip(names, times, keys):
+        where = '%s, %s' % (name, joint)
+        if len(joint_times) != len(joint_keys):
+            raise ValueError('%s: %d times but %d keys' % (where, len(joint_times), len(joint_keys)))
+        t = np.asarray(joint_times, dtype=float)
+        if not np.all(np.isfinite(t)) or np.any(np.diff(t) <= 0):
+            raise ValueError('%s: times are not finite and increasing' % where)
+        for i, key in enumerate(joint_keys):
+            if not (isinstance(key, (list, tuple)) and len(key) == 3 and np.isfinite(float(key[0])) and
+                    _is_handle(key[1]) and _is_handle(key[2])):
+                raise ValueError('%s: malformed key %d %r' % (where, i, key))
+    return keyframes
+
+
+class MotionLibrary(object):
+    '''compiled motions by name with LRU eviction
+
+    library[name] returns CompiledKeyframes which can be assigned to
+    AngleInterpolationAgent.keyframes directly.
+    '''
+    def __init__(self, filename=None, capacity=8):
+        self.filename = filename
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.index = {}
+        self.data = None
+        if filename is not None and path.exists(filename) and path.exists(filename + '.json'):
+            with open(filename + '.json') as f:
+                self.index = json.load(f)
+            self.data = np.load(filename, mmap_mode='r')
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return name in MOTIONS or hasattr(keyframes, name)
+
+    def get(self, name):
+        cache = self.cache
+        motion = cache.get(name)
+        if motion is not None:
+            cache.move_to_end(name)
+            self.hits += 1
+            return motion
+        self.misses += 1
+        motion = self._load_archived(name)
+        if motion is None:
+            motion = CompiledKeyframes(validate_keyframes(load_keyframes(name), name))
+        motion.name = name
+        cache[name] = motion
+        if len(cache) > self.capacity:
+            cache.popitem(last=False)
+        return motion
+
+    def _load_archived(self, name):
+        entry = self.index.get(name)
+        if entry is None or entry['mtime'] < source_mtime(name):
+            return None  # not archived or the keyframe module changed after save()
+        offset, rows = entry['offset'], entry['rows']
+        table = self.data[offset:offset + 6 * rows].reshape(rows, 6)
+        shifted_times = self.data[offset + 6 * rows:offset + 7 * rows - 1]
+        return CompiledKeyframes.from_arrays(entry['joints'], table, shifted_times, entry['t_min'], entry['t_max'])
+
+    def save(self, filename=None, names=MOTIONS):
+        '''write the compiled motions to filename (.npy) and its index filename.json'''
+        filename = filename or self.filename
+        index = {}
+        chunks = []
+        offset = 0
+        for name in names:
+            motion = self.get(name)
+            rows = len(motion.table)  # shifted_times has one entry less, no dummy row
+            index[name] = {'offset': offset, 'rows': rows, 'joints': motion.names,
+                           't_min': motion.t_min, 't_max': motion.t_max, 'mtime': source_mtime(name)}
+            chunks += [motion.table.ravel(), motion.shifted_times]
+            offset += 7 * rows - 1
+        data = np.concatenate(chunks) if chunks else np.zeros(0)
+        with open(filename + '.tmp', 'wb') as f:
+            np.save(f, data)
+        with open(filename + '.json.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(filename + '.tmp', filename)
+        os.replace(filename + '.json.tmp', filename + '.json')
+
+
+if __name__ == '__main__':
+    import sys
+    from timeit import repeat
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else MOTIONS_FILE
+    MotionLibrary(capacity=len(MOTIONS)).save(filename)
+    print('written to', filename)
+
+    archived = MotionLibrary(filename)
+    for name in MOTIONS:
+        compiled = CompiledKeyframes(load_keyframes(name))
+        times = np.linspace(-1, compiled.duration + 1, 200)
+        assert np.array_equal(compiled.evaluate(times), archived[name].evaluate(times)), name
+
+    def best(stmt, number):
+        return min(repeat(stmt, number=number, repeat=5)) / number * 1e6
+    print('per motion [us]')
+    print('  keyframe module + compile %8.1f' % best(
+        lambda: CompiledKeyframes(load_keyframes('rightBellyToStand')), 50))
+    print('  open %-20s %8.1f' % (path.basename(filename), best(
+        lambda: MotionLibrary(filename)['rightBellyToStand'], 50)))
+    archived.cache.clear()
+    print('  load from open file       %8.1f' % best(
+        lambda: archived.cache.clear() or archived['rightBellyToStand'], 1000))
+    library = MotionLibrary()
+    library['rightBellyToStand']
+    print('  cache hit                 %8.3f' % best(lambda: library['rightBellyToStand'], 10000))
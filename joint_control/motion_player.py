@@ -0,0 +1,90 @@
+'''Keyframe motions played relative to their start, one after the other
+
+The keyframes of Choregraphe start at time 0, but perception.time is the
+time of the server. MotionPlayer records the time at which each motion
+starts and evaluates it on that clock, so a motion can be started at any
+moment, and further motions can be queued to follow it.
+
+To avoid a step in the targets, a motion is faded in from the measured
+pose with weight w = smoothstep((t - start) / blend_time). Most motions
+hold their first key for a while so the robot can get there; this lead
+in is shortened to blend_time, during which the fade brings the joints
+to the first key:
+
+    player.play(library['rightBellyToStand'])
+    player.enqueue(library['hello'])
+    motion, angles = player.update(perception.time, perception.joint_angles)
+'''
+from collections import deque
+
+import numpy as np
+
+
+class MotionPlayer(object):
+    def __init__(self, blend_time=0.3):
+        self.blend_time = blend_time
+        self.queue = deque()
+        self.motion = None
+        self.start_time = None  # set by the first update() after the motion was started
+        self.offset = 0.0  # skipped part of the lead in
+        self.blend_from = None
+
+    @property
+    def playing(self):
+        return self.motion is not None
+
+    def play(self, motion):
+        '''start motion (CompiledKeyframes) with the next update, drop the queue'''
+        self.queue.clear()
+        self._start(motion)
+
+    def enqueue(self, motion):
+        '''play motion after the current and the queued ones'''
+        if self.motion is None:
+            self._start(motion)
+        else:
+            self.queue.append(motion)
+
+    def stop(self):
+        self.queue.clear()
+        self.motion = None
+
+    def _start(self, motion):
+        if motion is None or not motion.names:
+            self.motion = None
+            return
+        self.motion = motion
+        self.start_time = None
+        self.offset = max(motion.t_min - self.blend_time, 0.0)
+
+    def update(self, now, joint_angles):
+        '''return (motion, its angles in motion.names order) at time now,
+        (None, None) if nothing is played
+
+        joint_angles are the measured angles in JOINT_NAMES order, the fade
+        in starts from them.
+        '''
+        motion = self.motion
+        if motion is None:
+            return None, None
+        if self.start_time is None:
+            self._begin(now, joint_angles)
+        elif now - self.start_time + self.offset >= motion.duration:
+            if self.queue:
+                self._start(self.queue.popleft())
+                return self.update(now, joint_angles)
+            self.motion = None
+            return motion, motion.evaluate(motion.duration)
+        elapsed = now - self.start_time
+        angles = motion.evaluate(elapsed + self.offset)
+        if elapsed < self.blend_time:
+            u = elapsed / self.blend_time
+            angles += (self.blend_from - angles) * (1.0 - u * u * (3.0 - 2.0 * u))
+        return motion, angles
+
+    def _begin(self, now, joint_angles):
+        motion = self.motion
+        self.start_time = now
+        # joints which are not measured (e.g. LHand) start at their first key
+        self.blend_from = motion.evaluate(motion.t_min)
+        self.blend_from[motion.known] = joint_angles[motion.joint_indices]
@@ -1,102 +1,177 @@
+import json
 import os
 import sys
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'software_installation'))
 
 import numpy as np
-from collections import deque
-from spark_agent import SparkAgent, JOINT_CMD_NAMES
-
-class PIDController(object):
-    def __init__(self, dt, size):
+from spark_agent import SparkAgent, JointView, JOINT_NAMES
+
+# gains per joint written by pid_tuner.py
+GAINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pid_gains.json')
+DEFAULT_GAINS = (20.0, 0.2, 1.0)
+# commands predicted by the controller, pid_tuner.py tunes for the same delay
+CONTROL_DELAY = 0
+
+
+def load_gains(filename=GAINS_FILE):
+    '''return Kp, Ki, Kd vectors in JOINT_NAMES order'''
+    with open(filename) as f:
+        table = json.load(f)['gains']
+    gains = np.array([[table[name][k] for k in ('Kp', 'Ki', 'Kd')] for name in JOINT_NAMES])
+    return gains[:, 0], gains[:, 1], gains[:, 2]
+
+
+class BatchPIDController(object):
+    '''PID controllers for n_robots x n_joints, updated in place
+
+    Velocity form PID, the sensor value is predicted `delay` cycles ahead
+    from the recent commands. Kp, Ki and Kd can be scalars or per joint
+    vectors, assigning one of them or calling set_gains updates the
+    coefficients used by control. The last `delay` commands are kept
+    in a circular (delay, n_robots, n_joints) history.
+    '''
+    def __init__(self, dt, n_robots, n_joints, Kp=DEFAULT_GAINS[0], Ki=DEFAULT_GAINS[1], Kd=DEFAULT_GAINS[2],
+                 delay=0):
         self.dt = dt
-        self.size = size
-        self.u = np.zeros(size)
-        self.e1 = np.zeros(size)
-        self.e2 = np.zeros(size)
-
-        # HIER DIE BESTEN PARAMETER NACH DEM TUNING EINTRAGEN
-        self.Kp = 20.0
-        self.Ki = 0.2
-        self.Kd = 1.0
-
-        self._integral = np.zeros(size) # Wird für Velocity Form evtl. nicht direkt benötigt, aber im delta_u enthalten
-
-        delay = 0
-        self.y_buffer = deque(maxlen=delay + 1)
-        for _ in range(delay + 1):
-            self.y_buffer.appendleft(np.zeros(size))
+        self.shape = (n_robots, n_joints)
+        self.u = np.zeros(self.shape)
+        self.e1 = np.zeros(self.shape)
+        self.e2 = np.zeros(self.shape)
+        self._e0 = np.zeros(self.shape)
+        self._y_pred = np.zeros(self.shape)
+        self._tmp = np.zeros(self.shape)
+
+        self.set_gains(Kp, Ki, Kd)
+
+        self.history = np.zeros((0,) + self.shape)
+        self._head = 0
+        self.set_delay(delay)
+
+    def set_gains(self, Kp, Ki, Kd):
+        '''set the gains and precompute the coefficients of the error terms'''
+        self._Kp, self._Ki, self._Kd = Kp, Ki, Kd
+        # Kp (e0 - e1) + Ki dt e0 + Kd (e0 - 2 e1 + e2) / dt, sorted by error terms
+        if self.dt > 0:
+            self._c2 = Kd / self.dt
+            self._c0 = Kp + Ki * self.dt + self._c2
+            self._c1 = Kp + 2 * self._c2
+        else:
+            self._c2 = 0
+            self._c0 = self._c1 = Kp
+
+    @property
+    def Kp(self):
+        return self._Kp
+
+    @Kp.setter
+    def Kp(self, Kp):
+        self.set_gains(Kp, self._Ki, self._Kd)
+
+    @property
+    def Ki(self):
+        return self._Ki
+
+    @Ki.setter
+    def Ki(self, Ki):
+        self.set_gains(self._Kp, Ki, self._Kd)
+
+    @property
+    def Kd(self):
+        return self._Kd
+
+    @Kd.setter
+    def Kd(self, Kd):
+        self.set_gains(self._Kp, self._Ki, Kd)
+
+    def recent_commands(self):
+        '''return the history ordered from the most recent command'''
+        delay = len(self.history)
+        return self.history[[(self._head - 1 - k) % delay for k in range(delay)]]
 
     def set_delay(self, delay):
-        current_elements = list(self.y_buffer)
-        self.y_buffer = deque(maxlen=delay + 1)
-        for elem in reversed(current_elements):
-             if len(self.y_buffer) < delay + 1:
-                 self.y_buffer.appendleft(elem)
-             else:
-                 break
-        while len(self.y_buffer) < delay + 1:
-            self.y_buffer.appendleft(np.zeros(self.size))
+        recent = self.recent_commands()
+        self.history = np.zeros((delay,) + self.shape)
+        n = min(delay, len(recent))
+        # most recent command at history[head - 1]
+        self.history[delay - n:][::-1] = recent[:n]
+        self._head = 0
 
     def control(self, target, sensor):
-        delay = self.y_buffer.maxlen - 1
-        y_pred = sensor.copy()
-
-        if delay > 0 and self.dt > 0:
-             num_past_u = len(self.y_buffer)
-             for k in range(min(delay, num_past_u)):
-                 if k < len(self.y_buffer):
-                     y_pred += self.y_buffer[k] * self.dt
-
-        e0 = target - y_pred
-
-        # Velocity Form Calculation
-        delta_u = self.Kp * (e0 - self.e1)
+        y_pred = self._y_pred
+        history = self.history
+        if len(history) and self.dt > 0:
+            np.sum(history, axis=0, out=y_pred)
+            y_pred *= self.dt
+            y_pred += sensor
+        else:
+            y_pred[...] = sensor
+
+        e0 = self._e0
+        np.subtract(target, y_pred, out=e0)
+
+        # Velocity Form Calculation with the coefficients from set_gains
+        tmp = self._tmp
+        u = self.u
+        np.multiply(e0, self._c0, out=tmp)
+        u += tmp
+        np.multiply(self.e1, self._c1, out=tmp)
+        u -= tmp
+        np.multiply(self.e2, self._c2, out=tmp)
+        u += tmp
+
+        # e2 <- e1 <- e0, the old e2 buffer is reused for the next e0
+        self.e2, self.e1, self._e0 = self.e1, e0, self.e2
+
+        if len(history):
+            history[self._head] = self.u
+            self._head = (self._head + 1) % len(history)
 
-        if self.dt > 0:
-            delta_u += self.Ki * e0 * self.dt
-            # Check if dt is sufficiently large to avoid division by a very small number if Kd is large
-            if self.Kd != 0: # Avoid calculation if Kd is zero
-                 delta_u += self.Kd * (e0 - 2*self.e1 + self.e2) / self.dt
-        
-        self.u += delta_u
+        return self.u
 
-        self.e2 = self.e1.copy()
-        self.e1 = e0.copy()
 
-        self.y_buffer.appendleft(self.u.copy())
+class PIDController(BatchPIDController):
+    '''PID controller for the joints of one robot'''
+    def __init__(self, dt, size, Kp=DEFAULT_GAINS[0], Ki=DEFAULT_GAINS[1], Kd=DEFAULT_GAINS[2], delay=0):
+        super(PIDController, self).__init__(dt, 1, size, Kp=Kp, Ki=Ki, Kd=Kd, delay=delay)
+        self.size = size
 
-        return self.u
+    def control(self, target, sensor):
+        return super(PIDController, self).control(target, sensor)[0]
 
 
 class PIDAgent(SparkAgent):
+    '''SparkAgent with a PID controller for the joints
+
+    The gains are read from gains_file if it exists (see pid_tuner.py),
+    otherwise DEFAULT_GAINS are used for all joints.
+    '''
     def __init__(self, simspark_ip='localhost',
                  simspark_port=3100,
                  teamname='DAInamite',
                  player_id=0,
-                 sync_mode=True):
+                 sync_mode=True,
+                 gains_file=GAINS_FILE):
         super(PIDAgent, self).__init__(simspark_ip, simspark_port, teamname, player_id, sync_mode)
-        self.joint_names = list(JOINT_CMD_NAMES.keys()) # Ensure list for consistent order
+        self.joint_names = list(JOINT_NAMES) # same order as perception.joint_angles
         number_of_joints = len(self.joint_names)
-        self.joint_controller = PIDController(dt=0.02, size=number_of_joints)
-        self.target_joints = {k: 0.0 for k in self.joint_names} # Use float for consistency
-        # Optional: self.joint_controller.set_delay(1) # Example
+        gains = load_gains(gains_file) if gains_file and os.path.exists(gains_file) else DEFAULT_GAINS
+        self.joint_controller = PIDController(0.02, number_of_joints, *gains, delay=CONTROL_DELAY)
+        # target_joints is a dict view of target_angles, both can be written
+        self.target_angles = np.zeros(number_of_joints)
+        self.target_joints = JointView(self.target_angles, np.ones(number_of_joints, dtype=bool))
 
 
     def think(self, perception):
         action = super(PIDAgent, self).think(perception)
 
-        joint_ids_ordered = self.joint_names # Use the stored ordered list
-
-        joint_angles = np.nan_to_num(np.array(
-            [perception.joint.get(joint_id, 0.0) for joint_id in joint_ids_ordered], dtype=float
-        ))
-
-        target_angles = np.array([self.target_joints.get(joint_id,
-            perception.joint.get(joint_id, 0.0)) for joint_id in joint_ids_ordered], dtype=float)
+        joint_angles = np.nan_to_num(perception.joint_angles)
+        # joints without target keep their current angle
+        target_angles = np.where(self.target_joints.present, self.target_angles, joint_angles)
 
-        u = self.joint_controller.control(target_angles, joint_angles)
+        with self.timed('pid'):
+            u = self.joint_controller.control(target_angles, joint_angles)
 
-        action.speed = dict(zip(joint_ids_ordered, u))
+        action.speed = u
         return action
 
 
@@ -0,0 +1,45 @@
+'''Step the PID controllers of a whole team: one PIDController per robot
+against a single BatchPIDController
+
+usage: python pid_benchmark.py [n_robots] [delay]
+'''
+import sys
+from timeit import repeat
+
+import numpy as np
+
+from pid import PIDController, BatchPIDController
+from spark_agent import N_JOINTS
+
+
+def benchmark(n_robots=22, delay=2, number=200):
+    '''return seconds per team step of (PIDController per robot, BatchPIDController)'''
+    rng = np.random.RandomState(0)
+    target = rng.uniform(-1, 1, (n_robots, N_JOINTS))
+    sensor = rng.uniform(-1, 1, (n_robots, N_JOINTS))
+    singles = [PIDController(0.02, N_JOINTS) for _ in range(n_robots)]
+    for c in singles:
+        c.set_delay(delay)
+    batch = BatchPIDController(0.02, n_robots, N_JOINTS, delay=delay)
+
+    def run_singles():
+        for i, c in enumerate(singles):
+            c.control(target[i], sensor[i])
+
+    def run_batch():
+        batch.control(target, sensor)
+
+    # the plant is not simulated, the commands grow without bound
+    with np.errstate(over='ignore', invalid='ignore'):
+        return (min(repeat(run_singles, number=number, repeat=5)) / number,
+                min(repeat(run_batch, number=number, repeat=5)) / number)
+
+
+if __name__ == '__main__':
+    n_robots = int(sys.argv[1]) if len(sys.argv) > 1 else 22
+    delay = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    t_singles, t_batch = benchmark(n_robots, delay)
+    print('%d robots x %d joints, delay %d' % (n_robots, N_JOINTS, delay))
+    print('PIDController per robot: %8.1f us/step' % (t_singles * 1e6))
+    print('BatchPIDController:      %8.1f us/step' % (t_batch * 1e6))
+    print('speedup:                 %8.1fx' % (t_singles / t_batch))
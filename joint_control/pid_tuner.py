@@ -0,0 +1,156 @@
+'''Offline auto-tuning of the PID gains per joint
+
+Thousands of (Kp, Ki, Kd) sets are simulated at once: every set is one
+row of a BatchPIDController which drives a vectorized model of the
+joints, a first-order actuator (time constant tau) behind a command
+delay. The references are the trajectories of all keyframes in
+`keyframes`, sampled every dt and held for `settle` seconds at the end.
+
+Per set and joint the score is
+
+    rms tracking error + OVERSHOOT_WEIGHT * overshoot + SETTLING_WEIGHT * settling time
+
+where overshoot is how far the joint leaves the range of its reference
+and settling time is counted from the end of the motion until the error
+stays below SETTLING_TOLERANCE. The set with the lowest score summed
+over all motions is chosen for each joint and written as JSON to
+GAINS_FILE, which PIDAgent loads:
+
+    python pid_tuner.py [n_sets] [processes]
+
+The plant delay is CONTROL_DELAY, the delay PIDAgent's controller is
+configured with, and the simulated controllers predict the same delay.
+'''
+import json
+import multiprocessing
+import sys
+
+import numpy as np
+
+from motion_library import MotionLibrary, MOTIONS, MOTIONS_FILE
+from pid import BatchPIDController, CONTROL_DELAY, DEFAULT_GAINS, GAINS_FILE, load_gains
+from spark_agent import JOINT_NAMES, JOINT_INDEX, N_JOINTS
+
+OVERSHOOT_WEIGHT = 1.0
+SETTLING_WEIGHT = 0.1
+SETTLING_TOLERANCE = 0.02  # rad
+
+motions = MotionLibrary(MOTIONS_FILE)
+
+
+def reference_trajectory(motion, dt=0.02, settle=1.0):
+    '''return (targets (T, N_JOINTS), driven (N_JOINTS,) bool, index of the end of the motion)'''
+    compiled = motions[motion]
+    end = compiled.duration
+    samples = np.arange(0, end + settle, dt)
+    targets = np.zeros((len(samples), N_JOINTS))
+    targets[:, compiled.joint_indices] = compiled.evaluate(samples)[:, compiled.known]
+    driven = np.zeros(N_JOINTS, dtype=bool)
+    driven[compiled.joint_indices] = True
+    # AngleInterpolationAgent lets RHipYawPitch follow LHipYawPitch
+    left, right = JOINT_INDEX['LHipYawPitch'], JOINT_INDEX['RHipYawPitch']
+    targets[:, right] = targets[:, left]
+    driven[right] = driven[left]
+    return targets, driven, int(np.ceil(end / dt))
+
+
+class JointPlant(object):
+    '''joints as first-order actuators: the velocity follows the speed command
+    with time constant tau after `delay` cycles
+    '''
+    def __init__(self, shape, dt=0.02, tau=0.05, delay=CONTROL_DELAY):
+        self.dt = dt
+        self.alpha = min(1.0, dt / tau)
+        self.angle = np.zeros(shape)
+        self.velocity = np.zeros(shape)
+        self.commands = np.zeros((delay + 1,) + shape)
+        self._head = 0
+
+    def step(self, u):
+        commands = self.commands
+        commands[self._head] = u
+        self._head = (self._head + 1) % len(commands)
+        # oldest command is the one delay cycles ago
+        self.velocity += (commands[self._head] - self.velocity) * self.alpha
+        self.angle += self.velocity * self.dt
+        return self.angle
+
+
+def simulate(gains, targets, end, dt=0.02, tau=0.05, delay=CONTROL_DELAY):
+    '''closed loop of every gain set on targets, return scores (n_sets, N_JOINTS)'''
+    Kp, Ki, Kd = [g[:, np.newaxis] for g in gains.T]
+    shape = (len(gains), targets.shape[1])
+    controller = BatchPIDController(dt, shape[0], shape[1], Kp=Kp, Ki=Ki, Kd=Kd, delay=delay)
+    plant = JointPlant(shape, dt, tau, delay)
+    plant.angle[:] = targets[0]
+    squared_error = np.zeros(shape)
+    overshoot = np.zeros(shape)
+    unsettled = np.full(shape, end)
+    upper = targets.max(axis=0)
+    lower = targets.min(axis=0)
+    angle = plant.angle
+    with np.errstate(over='ignore', invalid='ignore'):
+        for k, target in enumerate(targets):
+            u = controller.control(target, angle)
+            angle = plant.step(u)
+            error = angle - target
+            squared_error += error * error
+            np.maximum(overshoot, angle - upper, out=overshoot)
+            np.maximum(overshoot, lower - angle, out=overshoot)
+            if k > end:
+                unsettled[np.abs(error) > SETTLING_TOLERANCE] = k
+        scores = (np.sqrt(squared_error / len(targets)) + OVERSHOOT_WEIGHT * overshoot +
+                  SETTLING_WEIGHT * (unsettled - end) * dt)
+    scores[~np.isfinite(scores)] = np.inf
+    return scores
+
+
+def _simulate_chunk(args):
+    _, gains, motion, dt, tau, delay = args
+    targets, driven, end = reference_trajectory(motion, dt)
+    scores = simulate(gains, targets, end, dt, tau, delay)
+    scores[:, ~driven] = 0
+    return scores
+
+
+def sample_gains(n_sets, seed=0):
+    '''log-uniform random gain sets, the current defaults are the first one'''
+    rng = np.random.RandomState(seed)
+    gains = np.exp(rng.uniform(np.log([1.0, 0.01, 0.01]), np.log([200.0, 20.0, 5.0]), (n_sets, 3)))
+    gains[0] = DEFAULT_GAINS
+    return gains
+
+
+def tune(n_sets=2000, processes=None, dt=0.02, tau=0.05, delay=CONTROL_DELAY, chunk_size=250):
+    '''return (best gains (N_JOINTS, 3), their scores, scores of the default gains)'''
+    gains = sample_gains(n_sets)
+    jobs = [(start, gains[start:start + chunk_size], motion, dt, tau, delay)
+            for start in range(0, n_sets, chunk_size) for motion in MOTIONS]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_simulate_chunk, jobs)
+    scores = np.zeros((n_sets, N_JOINTS))
+    for job, chunk_scores in zip(jobs, results):
+        start = job[0]
+        scores[start:start + len(chunk_scores)] += chunk_scores
+    best = np.argmin(scores, axis=0)
+    joints = np.arange(N_JOINTS)
+    return gains[best], scores[best, joints], scores[0]
+
+
+def save_gains(gains, scores, filename=GAINS_FILE, **model):
+    table = {name: {'Kp': g[0], 'Ki': g[1], 'Kd': g[2], 'score': s}
+             for name, g, s in zip(JOINT_NAMES, gains.tolist(), scores.tolist())}
+    with open(filename, 'w') as f:
+        json.dump({'model': model, 'gains': table}, f, indent=1)
+
+
+if __name__ == '__main__':
+    n_sets = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    model = dict(dt=0.02, tau=0.05, delay=CONTROL_DELAY)
+    gains, scores, default_scores = tune(n_sets, processes, **model)
+    for name, g, s, s0 in zip(JOINT_NAMES, gains, scores, default_scores):
+        print('%-15s Kp %7.2f Ki %6.3f Kd %6.3f  score %.4f (default %.4f)' % ((name,) + tuple(g) + (s, s0)))
+    save_gains(gains, scores, **model)
+    assert np.allclose(np.transpose(load_gains()), gains)
+    print('written to', GAINS_FILE)
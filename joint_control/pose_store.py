@@ -0,0 +1,185 @@
+'''All posture training samples in one columnar, memory-mapped store
+
+The samples of all classes are appended to two raw files:
+
+    <path>.X    float32 (n, n_features), the feature vectors
+    <path>.y    uint8 (n,), the class of each sample
+
+and `<path>.json` holds the class names and n_features. load() maps
+both files with np.memmap and returns (X, y), which go straight into
+scikit-learn, so no per-class lists are built however many samples
+were logged:
+
+    store = PoseStore(POSE_STORE)
+    store.append(features, 'Belly')
+    X, y = store.load()
+    clf.fit(X, y)
+
+The existing per-class directories (pickles from Python 2 or 3, JSON)
+are imported with import_directory(store, 'robot_pose_data_json').
+
+usage: python pose_store.py [directory]
+imports robot_pose_data_converted (or directory) into a new store
+'''
+import json
+import os
+import pickle
+from os import path
+
+import numpy as np
+
+DATA_DIR = path.dirname(path.abspath(__file__))
+POSE_STORE = path.join(DATA_DIR, 'robot_pose_store')
+POSE_DIRECTORIES = ['robot_pose_data', 'robot_pose_data_original', 'robot_pose_data_converted',
+                    'robot_pose_data_json']
+N_FEATURES = 10
+
+
+class PoseStore(object):
+    def __init__(self, path, n_features=N_FEATURES):
+        self.path = path
+        self.meta_file = path + '.json'
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+        else:
+            meta = {'classes': [], 'n_features': n_features}
+        self.classes = meta['classes']
+        self.n_features = meta['n_features']
+
+    def __len__(self):
+        try:
+            n_x = os.path.getsize(self.path + '.X') // (4 * self.n_features)
+            n_y = os.path.getsize(self.path + '.y')
+        except OSError:
+            return 0
+        return min(n_x, n_y)  # an append may have been interrupted
+
+    def _save_meta(self):
+        tmp = self.meta_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'classes': self.classes, 'n_features': self.n_features}, f)
+        os.replace(tmp, self.meta_file)
+
+    def class_index(self, name):
+        '''return the label of class name, new classes are added'''
+        if name not in self.classes:
+            if len(self.classes) >= 256:
+                raise ValueError('a PoseStore holds at most 256 classes')
+            self.classes.append(name)
+            self._save_meta()
+        return self.classes.index(name)
+
+    def append(self, X, y):
+        '''append the samples X (n, n_features) of class y (a name, or names or labels per sample)'''
+        X = np.asarray(X, dtype=np.float32).reshape(-1, self.n_features)
+        if isinstance(y, str):
+            y = np.full(len(X), self.class_index(y), dtype=np.uint8)
+        else:
+            y = np.asarray(y).reshape(-1)
+            if y.dtype.kind in 'US':
+                names, inverse = np.unique(y, return_inverse=True)
+                y = np.array([self.class_index(name) for name in names.tolist()], dtype=np.uint8)[inverse]
+            else:
+                if len(y) and (y.min() < 0 or y.max() >= len(self.classes)):
+                    raise ValueError('labels must be indices of store.classes')
+                y = y.astype(np.uint8)
+        if len(y) != len(X):
+            raise ValueError('%d samples but %d labels' % (len(X), len(y)))
+        n = len(self)
+        # drop the rest of an interrupted append before writing
+        with open(self.path + '.X', 'ab') as f:
+            f.truncate(n * 4 * self.n_features)
+            f.write(X.tobytes())
+        with open(self.path + '.y', 'ab') as f:
+            f.truncate(n)
+            f.write(y.tobytes())
+
+    def load(self, mmap=True):
+        '''return X (n, n_features) float32 and y (n,) uint8, memory-mapped or in memory'''
+        n = len(self)
+        if not n:
+            return np.zeros((0, self.n_features), dtype=np.float32), np.zeros(0, dtype=np.uint8)
+        X = np.memmap(self.path + '.X', dtype=np.float32, mode='r', shape=(n, self.n_features))
+        y = np.memmap(self.path + '.y', dtype=np.uint8, mode='r', shape=(n,))
+        if not mmap:
+            return np.array(X), np.array(y)
+        return X, y
+
+    def counts(self):
+        '''return {class name: number of samples}'''
+        _, y = self.load()
+        return dict(zip(self.classes, np.bincount(y, minlength=len(self.classes)).tolist()))
+
+
+def read_samples(filename):
+    '''return the samples of one class file as float array, JSON or a pickle from Python 2 or 3'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data.lstrip()[:1] == b'[':
+        samples = json.loads(data.decode('utf-8'))
+    else:
+        samples = pickle.loads(data, encoding='latin1')
+    return np.array(samples, dtype=float).reshape(len(samples), -1)
+
+
+def read_directory(directory):
+    '''return {class name: samples} of a directory with one file per class'''
+    return {name: read_samples(path.join(directory, name))
+            for name in sorted(os.listdir(directory)) if not name.startswith('.')}
+
+
+def import_directory(store, directory):
+    '''append all classes of directory to store, in sorted order, return the number of samples'''
+    n = 0
+    for name, samples in read_directory(directory).items():
+        store.append(samples, name)
+        n += len(samples)
+    return n
+
+
+def load_pose_data(store_path=POSE_STORE, directory=path.join(DATA_DIR, 'robot_pose_data_converted')):
+    '''return (X, y) of the store, which is imported from directory first if it is empty'''
+    store = PoseStore(store_path)
+    if not len(store):
+        import_directory(store, directory)
+    return store.load()
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    from timeit import repeat
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else path.join(DATA_DIR, 'robot_pose_data_converted')
+    store = PoseStore(path.join(tempfile.mkdtemp(), 'robot_pose_store'))
+    print('%d samples imported from %s' % (import_directory(store, directory), directory))
+    print(store.counts())
+
+    # all four forms of the training data hold the same samples
+    X, y = store.load()
+    for name in POSE_DIRECTORIES:
+        other = PoseStore(path.join(tempfile.mkdtemp(), 'robot_pose_store'))
+        import_directory(other, path.join(DATA_DIR, name))
+        X2, y2 = other.load()
+        print('%-28s equal: %s' % (name, other.classes == store.classes and np.array_equal(y, y2) and
+                                   np.array_equal(X, X2)))
+
+    # a million logged samples
+    rng = np.random.RandomState(0)
+    big = PoseStore(path.join(tempfile.mkdtemp(), 'robot_pose_store'))
+    for _ in range(10):
+        i = rng.randint(len(X), size=100000)
+        big.append(X[i] + rng.normal(0, 0.01, (len(i), N_FEATURES)), np.array(store.classes)[y[i]])
+    samples = path.join(path.dirname(big.path), 'samples.pkl')
+    with open(samples, 'wb') as f:
+        pickle.dump(big.load()[0].tolist(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_pickle():
+        with open(samples, 'rb') as f:
+            return np.array(pickle.load(f))
+    print('%d samples [ms]: load %.3f, load into memory %.1f, from a pickled list %.1f' % (
+        len(big),
+        min(repeat(lambda: big.load(), number=10, repeat=3)) / 10 * 1e3,
+        min(repeat(lambda: big.load(mmap=False), number=1, repeat=3)) * 1e3,
+        min(repeat(load_pickle, number=1, repeat=3)) * 1e3))
@@ -0,0 +1,165 @@
+'''The posture SVC as plain NumPy arrays
+
+svm.SVC.predict validates its input on every call, which costs far more
+than classifying 10 numbers. CompiledSVC keeps the support vectors, dual
+coefficients and intercepts of a trained rbf or linear SVC and evaluates
+the one-vs-one votes like libsvm:
+
+    decision(i, j) = sum_s coef(s, i, j) K(s, x) + intercept(i, j)
+
+votes for class i if it is > 0, else for j, and the first class with
+the most votes wins. The coefficients of all pairs are arranged in one
+(n_support, n_pairs) matrix, so a batch of samples takes one kernel
+evaluation and one matrix product.
+
+The arrays are exported to an .npz file, which is loaded without
+scikit-learn:
+
+    python posture_classifier.py      # robot_pose.pkl -> robot_pose.npz
+'''
+import pickle
+from os import path
+
+import numpy as np
+
+ROBOT_POSE_PKL = path.join(path.dirname(path.abspath(__file__)), 'robot_pose.pkl')
+ROBOT_POSE_NPZ = path.join(path.dirname(path.abspath(__file__)), 'robot_pose.npz')
+
+
+class CompiledSVC(object):
+    def __init__(self, support_vectors, dual_coef, intercept, n_support, classes, gamma, kernel='rbf'):
+        if kernel not in ('rbf', 'linear'):
+            raise ValueError('kernel %r is not supported' % kernel)
+        self.support_vectors = np.asarray(support_vectors, dtype=float)
+        self.dual_coef = np.asarray(dual_coef, dtype=float)
+        self.intercept = np.asarray(intercept, dtype=float)
+        self.n_support = np.asarray(n_support, dtype=np.intp)
+        self.classes = np.asarray(classes)
+        self.gamma = float(gamma)
+        self.kernel = str(kernel)
+
+        self.sv_squared = np.einsum('ij,ij->i', self.support_vectors, self.support_vectors)
+
+        n_classes = len(self.n_support)
+        starts = np.concatenate(([0], np.cumsum(self.n_support)))
+        pairs = [(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)]
+        # weights[s, p] is the coefficient of support vector s in the decision of pair p
+        self.weights = np.zeros((len(self.support_vectors), len(pairs)))
+        for p, (i, j) in enumerate(pairs):
+            self.weights[starts[i]:starts[i + 1], p] = self.dual_coef[j - 1, starts[i]:starts[i + 1]]
+            self.weights[starts[j]:starts[j + 1], p] = self.dual_coef[i, starts[j]:starts[j + 1]]
+        pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+        # votes = positive @ vote_i + (1 - positive) @ vote_j
+        self.vote_i = np.zeros((len(pairs), n_classes))
+        self.vote_i[np.arange(len(pairs)), pairs[:, 0]] = 1
+        self.vote_j = np.zeros((len(pairs), n_classes))
+        self.vote_j[np.arange(len(pairs)), pairs[:, 1]] = 1
+        self.vote_i -= self.vote_j
+        self.vote_j = self.vote_j.sum(axis=0)
+
+    @classmethod
+    def from_sklearn(cls, clf):
+        if len(clf.classes_) < 3:
+            # for two classes scikit-learn flips the signs of dual_coef_ and intercept_
+            dual_coef, intercept = -clf.dual_coef_, -clf.intercept_
+        else:
+            dual_coef, intercept = clf.dual_coef_, clf.intercept_
+        return cls(clf.support_vectors_, dual_coef, intercept, clf.n_support_, clf.classes_,
+                   clf._gamma, clf.kernel)
+
+    @classmethod
+    def load(cls, filename=ROBOT_POSE_NPZ):
+        with np.load(filename) as f:
+            return cls(f['support_vectors'], f['dual_coef'], f['intercept'], f['n_support'],
+                       f['classes'], f['gamma'], f['kernel'])
+
+    def save(self, filename=ROBOT_POSE_NPZ):
+        np.savez(filename, support_vectors=self.support_vectors, dual_coef=self.dual_coef,
+                 intercept=self.intercept, n_support=self.n_support, classes=self.classes,
+                 gamma=self.gamma, kernel=self.kernel)
+
+    def _kernel(self, X):
+        k = X @ self.support_vectors.T
+        if self.kernel == 'linear':
+            return k
+        # -gamma |x - s|^2 = gamma (2 x.s - x.x - s.s), like libsvm
+        k *= 2.0
+        k -= np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+        k -= self.sv_squared
+        k *= self.gamma
+        return np.exp(k, out=k)
+
+    def decision_function(self, X):
+        '''return the one-vs-one decision values (n_samples, n_pairs)'''
+        d = self._kernel(np.atleast_2d(np.asarray(X, dtype=float))) @ self.weights
+        d += self.intercept
+        return d
+
+    def predict(self, X):
+        '''return the labels of the samples X (n_samples, n_features) like svm.SVC.predict'''
+        votes = (self.decision_function(X) > 0) @ self.vote_i
+        votes += self.vote_j
+        return self.classes[votes.argmax(axis=1)]
+
+    def predict_one(self, x):
+        '''return the label of one feature vector, predict() with fewer array operations'''
+        x = np.ravel(x)
+        k = self.support_vectors @ x
+        if self.kernel == 'rbf':
+            k *= 2.0
+            k -= x @ x
+            k -= self.sv_squared
+            k *= self.gamma
+            np.exp(k, out=k)
+        d = k @ self.weights
+        d += self.intercept
+        votes = (d > 0) @ self.vote_i
+        votes += self.vote_j
+        return self.classes[votes.argmax()]
+
+    def predict_many(self, X, chunk_size=4096):
+        '''predict in chunks of chunk_size samples, for long logged perception streams'''
+        X = np.asarray(X, dtype=float)
+        labels = np.empty(len(X), dtype=self.classes.dtype)
+        for start in range(0, len(X), chunk_size):
+            labels[start:start + chunk_size] = self.predict(X[start:start + chunk_size])
+        return labels
+
+
+def load_posture_classifier(npz=ROBOT_POSE_NPZ, pkl=ROBOT_POSE_PKL):
+    '''return the exported classifier, or compile the pickled SVC if there is no up-to-date export'''
+    if path.exists(npz) and (not path.exists(pkl) or path.getmtime(npz) >= path.getmtime(pkl)):
+        return CompiledSVC.load(npz)
+    with open(pkl, 'rb') as f:
+        return CompiledSVC.from_sklearn(pickle.load(f))
+
+
+if __name__ == '__main__':
+    import sys
+    from timeit import repeat
+    from pose_store import load_pose_data
+
+    with open(ROBOT_POSE_PKL, 'rb') as f:
+        clf = pickle.load(f)
+    compiled = CompiledSVC.from_sklearn(clf)
+    compiled.save(ROBOT_POSE_NPZ)
+    compiled = CompiledSVC.load(ROBOT_POSE_NPZ)
+    print('written to', ROBOT_POSE_NPZ)
+
+    # the training data, and random samples around it and in its range
+    data, _ = load_pose_data()
+    rng = np.random.RandomState(0)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    X = np.vstack([data, data[rng.randint(len(data), size=n)] + rng.normal(0, 0.3, (n, data.shape[1])),
+                   rng.uniform(data.min(axis=0) - 1, data.max(axis=0) + 1, (n, data.shape[1]))])
+    expected = clf.predict(X)
+    labels = compiled.predict_many(X)
+    print('%d samples, %d labels differ from svm.SVC.predict' % (len(X), np.sum(labels != expected)))
+    assert np.array_equal(labels, expected)
+    assert all(compiled.predict_one(x) == label for x, label in zip(X[:2000], expected))
+
+    x = data[0].reshape(1, -1)
+    print('one sample [us]:  svm.SVC %.1f  CompiledSVC %.1f' % tuple(
+        min(repeat(f, number=1000, repeat=5)) * 1e3 for f in (lambda: clf.predict(x), lambda: compiled.predict_one(x))))
+    print('%d samples [ms]: svm.SVC %.1f  CompiledSVC %.1f' % ((len(X),) + tuple(
+        min(repeat(f, number=1, repeat=3)) * 1e3 for f in (lambda: clf.predict(X), lambda: compiled.predict_many(X)))))
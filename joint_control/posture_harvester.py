@@ -0,0 +1,173 @@
+'''Posture training samples collected from running or replayed agents
+
+A PostureRecognitionAgent with a harvester passes the feature vector it
+classifies (eight leg joints, AngleX, AngleY) and the motion its
+MotionPlayer plays to it on every cycle. A sample is only labelled once
+the pose is stable, i.e. no feature moved more than stable_threshold for
+stable_time seconds. Its label is
+
+* the posture set with expect(), or else
+* the posture in which the last motion ended, from motion_postures by
+  the name MotionLibrary gives it, e.g. 'Stand' after rightBellyToStand.
+  It holds from the end of the motion until the robot leaves the stable
+  pose it came to rest in, or else
+* the posture recognized with a confidence of at least min_confidence.
+
+Samples whose features fall into the same cell of a grid with spacing
+`cell` as an earlier sample (also one already in the store) are
+dropped by a spatial hash, so a robot lying still adds one sample:
+
+    agent.harvester = PostureHarvester(PoseStore(POSE_STORE))
+    agent.keyframes = MotionLibrary()['rightBellyToStand']
+    agent.run()
+    agent.harvester.close()
+
+usage: python posture_harvester.py [log]
+harvests from a PostureRecognitionAgent against fake_simspark, or from a
+replay of the spark_log `log`
+'''
+import numpy as np
+
+# posture in which the motions of the MotionLibrary end, hello and
+# wipe_forehead only move the arms
+MOTION_POSTURES = {'leftBackToStand': 'Stand', 'leftBellyToStand': 'Stand',
+                   'rightBackToStand': 'Stand', 'rightBellyToStand': 'Stand'}
+
+
+class SpatialHash(object):
+    '''set of the grid cells with spacing cell which hold a sample'''
+    def __init__(self, cell=0.02):
+        self.cell = cell
+        self.cells = set()
+
+    def __len__(self):
+        return len(self.cells)
+
+    def keys(self, X):
+        '''return the cell keys (bytes) of the samples X (n, n_features)'''
+        cells = np.floor(np.asarray(X, dtype=float) / self.cell).astype(np.int32)
+        return [row.tobytes() for row in np.ascontiguousarray(cells)]
+
+    def update(self, X):
+        self.cells.update(self.keys(X))
+
+    def add(self, x):
+        '''add the cell of sample x, return False if it was taken already'''
+        key = np.floor(x / self.cell).astype(np.int32).tobytes()
+        if key in self.cells:
+            return False
+        self.cells.add(key)
+        return True
+
+
+class PostureHarvester(object):
+    def __init__(self, store, cell=0.02, stable_time=0.5, stable_threshold=0.01, min_confidence=1.0,
+                 flush_size=256, motion_postures=MOTION_POSTURES):
+        self.store = store
+        self.hash = SpatialHash(cell)
+        X, _ = store.load()
+        self.hash.update(X)
+        self.stable_time = stable_time
+        self.stable_threshold = stable_threshold
+        self.min_confidence = min_confidence
+        self.flush_size = flush_size
+        self.motion_postures = motion_postures
+        self.expected = None
+        self.motion = None  # motion played at the last observe()
+        self.motion_posture = None  # posture the last finished motion ended in
+        self.settled = False  # a stable pose was reached after the motion ended
+        self.anchor = None  # features at the start of the current stable period
+        self.anchor_time = 0.0
+        self.samples = []
+        self.labels = []
+        self.collected = 0
+        self.duplicates = 0
+
+    def expect(self, posture):
+        '''label stable poses with posture from now on, None to use the recognized posture'''
+        self.expected = posture
+
+    def final_posture(self, motion):
+        '''return the posture motion ends in, None if it is not known'''
+        return self.motion_postures.get(getattr(motion, 'name', None))
+
+    def stable(self, now, features):
+        if self.anchor is None or np.abs(features - self.anchor).max() > self.stable_threshold:
+            self.anchor = features.copy()
+            self.anchor_time = now
+            if self.settled:
+                # the robot left the pose it came to rest in after the motion
+                self.motion_posture = None
+                self.settled = False
+        return now - self.anchor_time >= self.stable_time
+
+    def observe(self, now, features, posture=None, confidence=0.0, motion=None):
+        '''offer one feature vector with the recognized posture and the motion
+        being played, return True if it was collected
+        '''
+        if motion is not self.motion:
+            # a motion which is replaced by another one did not end
+            self.motion_posture = self.final_posture(self.motion) if motion is None else None
+            self.settled = False
+            self.motion = motion
+        if not self.stable(now, features):
+            return False
+        label = self.expected
+        if label is None and self.motion_posture is not None:
+            label = self.motion_posture
+            self.settled = True
+        if label is None:
+            if posture is None or confidence < self.min_confidence or posture.startswith('unknown'):
+                return False
+            label = posture
+        if not self.hash.add(features):
+            self.duplicates += 1
+            return False
+        self.samples.append(features.copy())
+        self.labels.append(label)
+        self.collected += 1
+        if len(self.samples) >= self.flush_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if self.samples:
+            self.store.append(np.array(self.samples), np.array(self.labels))
+            self.samples = []
+            self.labels = []
+
+    def close(self):
+        self.flush()
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import tempfile
+    sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'software_installation'))
+    from fake_simspark import FakeSimSpark
+    from pose_store import PoseStore, POSE_STORE
+    from recognize_posture import PostureRecognitionAgent
+    from motion_library import MotionLibrary
+
+    # harvested into a copy of the store
+    store = PoseStore(os.path.join(tempfile.mkdtemp(), 'robot_pose_store'))
+    source = PoseStore(POSE_STORE)
+    X, y = source.load()
+    store.append(X, np.array(source.classes)[y])
+    before = len(store)
+    if len(sys.argv) > 1:
+        agent = PostureRecognitionAgent.replay(sys.argv[1])
+        agent.harvester = PostureHarvester(store)
+    else:
+        server = FakeSimSpark(cycles=2000).start()
+        agent = PostureRecognitionAgent(simspark_port=server.port)
+        # ends in Stand, the samples after it are labelled by the motion
+        agent.keyframes = MotionLibrary()['rightBellyToStand']
+        # the PID holds the joints of the hanging robot only within about 0.15 rad
+        agent.harvester = PostureHarvester(store, stable_threshold=0.3)
+    agent.run()
+    agent.harvester.close()
+    print('%d samples collected, %d duplicates dropped, store %d -> %d samples'
+          % (agent.harvester.collected, agent.harvester.duplicates, before, len(store)))
+    print(store.counts())
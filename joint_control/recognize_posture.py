@@ -10,20 +10,24 @@
 
 '''
 
-import pickle
 import numpy as np
+from collections import Counter, deque
 from os import path
 
 # AngleInterpolationAgent wird als Basisklasse für Keyframe-Ausführung benötigt
 from angle_interpolation import AngleInterpolationAgent 
 # keyframes.hello wird nur für das __main__ Beispiel unten benötigt
 from keyframes import hello 
+from spark_agent import JOINT_INDEX
+from posture_classifier import load_posture_classifier
 
 
 # Der Pfad zur Klassifikator-Datei, relativ zum Skript
 # Stelle sicher, dass robot_pose.pkl im selben Verzeichnis wie dieses Skript liegt
 # oder passe den Pfad entsprechend an.
 ROBOT_POSE_CLF_FILE = 'robot_pose.pkl'
+# NumPy export of the classifier, see posture_classifier.py
+ROBOT_POSE_NPZ_FILE = 'robot_pose.npz'
 
 # Die Namen der Haltungen in der exakten Reihenfolge, wie sie beim Training verwendet wurden.
 # Diese Liste ist KRITISCH für die korrekte Interpretation der Klassifikator-Ausgabe.
@@ -36,6 +40,60 @@ ROBOT_POSE_CLF_FILE = 'robot_pose.pkl'
 # Für dieses Beispiel nehme ich eine häufig gesehene Reihenfolge an:
 POSTURE_NAMES = ['Back', 'Belly', 'Crouch', 'Frog', 'HeadBack', 'Knee', 'Left', 'Right', 'Sit', 'Stand', 'StandInit']
 
+# indices of the joint features in perception.joint_angles,
+# RHipYawPitch is taken from LHipYawPitch like in the training data
+POSTURE_FEATURE_INDICES = [JOINT_INDEX[name] for name in
+                           ['LHipYawPitch', 'LHipRoll', 'LHipPitch', 'LKneePitch',
+                            'LHipYawPitch', 'RHipRoll', 'RHipPitch', 'RKneePitch']]
+
+
+class PostureTracker(object):
+    '''runs the classifier only when it is due and filters its labels
+
+    A classification is due every `period` seconds. With a `threshold`,
+    it is only due if a feature (leg joints, IMU angles) moved by more
+    than threshold since the last one, or if that is `max_age` seconds
+    ago. The last `window` labels vote, and the posture only changes when
+    another label has at least `min_votes` of them.
+    '''
+    def __init__(self, period=0.1, threshold=0.05, max_age=1.0, window=5, min_votes=3):
+        self.period = period
+        self.threshold = threshold
+        self.max_age = max_age
+        self.votes = deque(maxlen=window)
+        self.min_votes = min_votes
+        self.label = None
+        self.confidence = 0.0
+        self.last_time = -np.inf  # time of the last classification
+        self.last_features = None
+        self.changed_time = -np.inf  # time at which label was last changed
+
+    def due(self, now, features):
+        elapsed = now - self.last_time
+        if elapsed < self.period:
+            return False
+        if self.threshold is None or self.last_features is None or elapsed >= self.max_age:
+            return True
+        return np.abs(features - self.last_features).max() > self.threshold
+
+    def update(self, now, features, classify):
+        '''classify features if it is due, return the filtered label'''
+        if not self.due(now, features):
+            return self.label
+        self.last_time = now
+        self.last_features = features.copy()
+        self.votes.append(classify(features))
+        majority, count = Counter(self.votes).most_common(1)[0]
+        if self.label is None or (majority != self.label and count >= self.min_votes):
+            self.label = majority
+            self.changed_time = now
+        self.confidence = self.votes.count(self.label) / float(len(self.votes))
+        return self.label
+
+    def age(self, now):
+        '''seconds since the last classification'''
+        return now - self.last_time
+
 
 class PostureRecognitionAgent(AngleInterpolationAgent):
     def __init__(self, simspark_ip='localhost',
@@ -45,6 +103,9 @@ class PostureRecognitionAgent(AngleInterpolationAgent):
                  sync_mode=True):
         super(PostureRecognitionAgent, self).__init__(simspark_ip, simspark_port, teamname, player_id, sync_mode)
         self.posture = 'unknown_init' # Initialer Status
+        self.posture_confidence = 0.0
+        self.posture_tracker = PostureTracker()
+        self.harvester = None  # a PostureHarvester collects training samples, see posture_harvester.py
         self.posture_classifier = None
         self.posture_names_ordered = POSTURE_NAMES # Speichere die geordnete Liste
 
@@ -53,8 +114,9 @@ class PostureRecognitionAgent(AngleInterpolationAgent):
             # Stelle sicher, dass der Pfad korrekt ist, falls sich die Datei nicht im selben Verzeichnis befindet
             script_dir = path.dirname(path.abspath(__file__))
             classifier_path = path.join(script_dir, ROBOT_POSE_CLF_FILE)
-            with open(classifier_path, 'rb') as f:
-                self.posture_classifier = pickle.load(f)
+            # the NumPy export if it is up to date, else the pickled SVC compiled to it
+            self.posture_classifier = load_posture_classifier(path.join(script_dir, ROBOT_POSE_NPZ_FILE),
+                                                              classifier_path)
             print(f"INFO: Haltungserkennungs-Klassifikator '{ROBOT_POSE_CLF_FILE}' erfolgreich geladen.")
         except FileNotFoundError:
             print(f"FEHLER: Klassifikator-Datei '{ROBOT_POSE_CLF_FILE}' nicht unter '{classifier_path}' gefunden.")
@@ -63,7 +125,15 @@ class PostureRecognitionAgent(AngleInterpolationAgent):
 
     def think(self, perception):
         # Erkenne zuerst die aktuelle Haltung
-        current_recognized_posture = self.recognize_posture(perception)
+        # only when it is due, filtered by PostureTracker
+        with self.timed('recognize_posture'):
+            tracker = self.posture_tracker
+            features = self.posture_features(perception)
+            current_recognized_posture = tracker.update(perception.time, features, self.classify_posture)
+            self.posture_confidence = tracker.confidence
+            if self.harvester is not None:
+                self.harvester.observe(perception.time, features, current_recognized_posture,
+                                       self.posture_confidence, self.player.motion)
         
         # Optional: Gib nur aus, wenn sich die Haltung ändert, um die Konsole nicht zu fluten
         if current_recognized_posture != self.posture:
@@ -76,6 +146,14 @@ class PostureRecognitionAgent(AngleInterpolationAgent):
         return super(PostureRecognitionAgent, self).think(perception)
 
     def recognize_posture(self, perception):
+        '''classify the current perception, without the PostureTracker'''
+        return self.classify_posture(self.posture_features(perception))
+
+    def posture_features(self, perception):
+        # leg joints straight from the perception array, followed by [AngleX, AngleY]
+        return np.concatenate((perception.joint_angles[POSTURE_FEATURE_INDICES], perception.imu))
+
+    def classify_posture(self, features_array):
         # Wenn der Klassifikator nicht geladen werden konnte, gib einen Fehlerstatus zurück
         if self.posture_classifier is None:
             return 'unknown_clf_not_loaded'
@@ -88,44 +166,8 @@ class PostureRecognitionAgent(AngleInterpolationAgent):
         # Die restlichen rechten Beingelenke sollten ihre eigenen Werte haben.
 
         try:
-            # Extrahiere Gelenkwinkel aus der Wahrnehmung (Perception)
-            # Verwende .get(key, default_value) um Fehler zu vermeiden, falls ein Gelenk fehlt
-            l_hip_yaw_pitch = perception.joint.get('LHipYawPitch', 0.0)
-            l_hip_roll      = perception.joint.get('LHipRoll', 0.0)
-            l_hip_pitch     = perception.joint.get('LHipPitch', 0.0)
-            l_knee_pitch    = perception.joint.get('LKneePitch', 0.0)
-            
-            r_hip_yaw_pitch = l_hip_yaw_pitch # Gemäß Anweisung
-            r_hip_roll      = perception.joint.get('RHipRoll', 0.0)
-            r_hip_pitch     = perception.joint.get('RHipPitch', 0.0)
-            r_knee_pitch    = perception.joint.get('RKneePitch', 0.0)
-            
-            # Extrahiere Körperwinkel (IMU-Daten)
-            # Die genaue Struktur von perception.imu muss bekannt sein.
-            # Annahme: es ist ein Objekt mit 'angleX' und 'angleY' Attributen oder ein Dict.
-            angle_x = 0.0
-            angle_y = 0.0
-            if hasattr(perception, 'imu') and perception.imu is not None:
-                if isinstance(perception.imu, dict):
-                    angle_x = perception.imu.get('angleX', 0.0)
-                    angle_y = perception.imu.get('angleY', 0.0)
-                else: # Annahme: es ist ein Objekt mit Attributen
-                    angle_x = getattr(perception.imu, 'angleX', 0.0)
-                    angle_y = getattr(perception.imu, 'angleY', 0.0)
-            
-            # Stelle die Features als NumPy-Array in der korrekten Reihenfolge zusammen
-            features_array = np.array([
-                l_hip_yaw_pitch, l_hip_roll, l_hip_pitch, l_knee_pitch,
-                r_hip_yaw_pitch, r_hip_roll, r_hip_pitch, r_knee_pitch,
-                angle_x, angle_y
-            ], dtype=np.float64) # Stelle sicher, dass es Float64 ist, wie von Scikit-learn erwartet
-
-            # Das Modell erwartet eine 2D-Array Eingabe (auch für ein einzelnes Sample)
-            features_reshaped = features_array.reshape(1, -1)
-            
-            # Mache eine Vorhersage mit dem geladenen Klassifikator
-            predicted_label_index_array = self.posture_classifier.predict(features_reshaped)
-            predicted_label_index = predicted_label_index_array[0] # predict gibt ein Array zurück
+            # one sample without the 2D reshape and validation of svm.SVC.predict
+            predicted_label_index = self.posture_classifier.predict_one(features_array)
             
             # Konvertiere den vorhergesagten Index zurück in den Namen der Haltung
             if 0 <= predicted_label_index < len(self.posture_names_ordered):
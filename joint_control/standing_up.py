@@ -7,6 +7,7 @@
 '''
 
 from recognize_posture import PostureRecognitionAgent # Erbt von dieser Klasse
+from motion_library import MotionLibrary, MOTIONS_FILE
 
 # Importiere hier ALLE Keyframe-Bewegungen, die für das Aufstehen benötigt werden.
 # Basierend auf deiner keyframes-Ordnerstruktur:
@@ -61,6 +62,8 @@ class StandingUpAgent(PostureRecognitionAgent):
         # oder eine zusätzliche Logik bräuchten, um die Seite zu bestimmen (z.B. basierend auf den letzten Gelenkbewegungen).
         # Vorerst wählen wir eine Standardseite oder du musst dies erweitern.
         self.preferred_stand_side = "right" # oder "left", oder dynamisch bestimmen
+        # each stand up motion is compiled once, not rebuilt on every fall
+        self.motions = MotionLibrary(MOTIONS_FILE)
 
     def think(self, perception):
         action = super(StandingUpAgent, self).think(perception)
@@ -80,30 +83,30 @@ class StandingUpAgent(PostureRecognitionAgent):
         if current_posture == 'Belly':
             print(f"INFO StandingUpAgent: Haltung ist '{current_posture}'. Wähle Aufstehbewegung vom Bauch.")
             if self.preferred_stand_side == "right" and rightBellyToStand:
-                stand_up_motion_to_execute = rightBellyToStand()
+                stand_up_motion_to_execute = self.motions['rightBellyToStand']
             elif self.preferred_stand_side == "left" and leftBellyToStand:
-                stand_up_motion_to_execute = leftBellyToStand()
+                stand_up_motion_to_execute = self.motions['leftBellyToStand']
             elif rightBellyToStand: # Fallback, falls preferred_stand_side nicht passt, aber einer da ist
                 print(f"WARNUNG StandingUpAgent: Bevorzugte Seite '{self.preferred_stand_side}' für Belly nicht verfügbar, nutze rechten Keyframe.")
-                stand_up_motion_to_execute = rightBellyToStand()
+                stand_up_motion_to_execute = self.motions['rightBellyToStand']
             elif leftBellyToStand:
                 print(f"WARNUNG StandingUpAgent: Bevorzugte Seite '{self.preferred_stand_side}' für Belly nicht verfügbar, nutze linken Keyframe.")
-                stand_up_motion_to_execute = leftBellyToStand()
+                stand_up_motion_to_execute = self.motions['leftBellyToStand']
             else:
                 print(f"WARNUNG StandingUpAgent: Keine 'BellyToStand' Keyframes verfügbar.")
         
         elif current_posture == 'Back':
             print(f"INFO StandingUpAgent: Haltung ist '{current_posture}'. Wähle Aufstehbewegung vom Rücken.")
             if self.preferred_stand_side == "right" and rightBackToStand:
-                stand_up_motion_to_execute = rightBackToStand()
+                stand_up_motion_to_execute = self.motions['rightBackToStand']
             elif self.preferred_stand_side == "left" and leftBackToStand:
-                stand_up_motion_to_execute = leftBackToStand()
+                stand_up_motion_to_execute = self.motions['leftBackToStand']
             elif rightBackToStand:
                 print(f"WARNUNG StandingUpAgent: Bevorzugte Seite '{self.preferred_stand_side}' für Back nicht verfügbar, nutze rechten Keyframe.")
-                stand_up_motion_to_execute = rightBackToStand()
+                stand_up_motion_to_execute = self.motions['rightBackToStand']
             elif leftBackToStand:
                 print(f"WARNUNG StandingUpAgent: Bevorzugte Seite '{self.preferred_stand_side}' für Back nicht verfügbar, nutze linken Keyframe.")
-                stand_up_motion_to_execute = leftBackToStand()
+                stand_up_motion_to_execute = self.motions['leftBackToStand']
             else:
                 print(f"WARNUNG StandingUpAgent: Keine 'BackToStand' Keyframes verfügbar.")
 
@@ -119,7 +122,7 @@ class StandingUpAgent(PostureRecognitionAgent):
         #     # Hier Logik, um z.B. leftBellyToStand oder leftBackToStand zu nutzen,
         #     # oder eine spezielle "fromSide" Bewegung.
         #     if leftBellyToStand: # Annahme: von der Seite erst auf den Bauch
-        #         stand_up_motion_to_execute = leftBellyToStand() # Oder eine Rollbewegung
+        #         stand_up_motion_to_execute = self.motions['leftBellyToStand'] # Oder eine Rollbewegung
         #     else:
         #         print(f"WARNUNG StandingUpAgent: Keine passende Aktion für Haltung '{current_posture}'.")
 
@@ -0,0 +1,202 @@
+'''Keyframe motions played faster within the velocity and acceleration limits
+
+Played at rate r, a motion f(tau) becomes f(r t): the joint velocities
+are scaled by r and the accelerations by r^2. Each segment of a compiled
+motion is a cubic a + b u + c u^2 + d u^3 in u = (tau - t0) / T, so
+
+    velocity     = (b + 2 c u + 3 d u^2) / T
+    acceleration = (2 c + 6 d u) / T^2
+
+peak at the ends of the segment or at u = -c / (3 d). From these peaks
+max_rate() computes the fastest rate at which no joint exceeds
+margin * its limit, and time_scaled() returns the motion played at that
+rate or a slower one. A motion without movement has no finite max_rate,
+it is returned unscaled.
+
+adaptive_time_scaled() computes such a rate for each interval between
+the key times of the motion, so parts with slow movements are played
+faster than the critical ones. All joints share one time warp and stay
+in sync. Where the rate changes, the velocities jump by
+|f'(tau)| * (r1 - r0), which is limited to what the acceleration limit
+allows within one control cycle dt:
+
+    agent.keyframes = time_scaled(library['rightBellyToStand'])
+    agent.keyframes = adaptive_time_scaled(library['rightBellyToStand'], rate=3.0)
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'software_installation'))
+
+import numpy as np
+
+from spark_agent import JOINT_NAMES
+
+# rad/s from the NAO H25 datasheet
+MAX_JOINT_VELOCITY = np.array([{
+    'HeadYaw': 8.26794, 'HeadPitch': 7.19407,
+    'ShoulderPitch': 8.26794, 'ShoulderRoll': 7.19407, 'ElbowYaw': 8.26794, 'ElbowRoll': 7.19407,
+    'HipYawPitch': 4.16174, 'HipRoll': 4.16174, 'HipPitch': 6.40239,
+    'KneePitch': 6.40239, 'AnklePitch': 6.40239, 'AnkleRoll': 4.16174,
+}[name if name.startswith('Head') else name[1:]] for name in JOINT_NAMES])
+# rad/s^2, not specified for the NAO, above the peaks of 12 - 40 in the shipped motions
+MAX_JOINT_ACCELERATION = np.full(len(JOINT_NAMES), 60.0)
+
+
+def joint_limits(motion, velocity_limits=MAX_JOINT_VELOCITY, acceleration_limits=MAX_JOINT_ACCELERATION):
+    '''return the limits in motion.names order, joints not in JOINT_NAMES are not limited'''
+    velocity = np.full(len(motion.names), np.inf)
+    acceleration = np.full(len(motion.names), np.inf)
+    velocity[motion.known] = velocity_limits[motion.joint_indices]
+    acceleration[motion.known] = acceleration_limits[motion.joint_indices]
+    return velocity, acceleration
+
+
+def window_peaks(motion, edges):
+    '''return the peak |velocity| and |acceleration| of each joint in the
+    time windows [edges[i], edges[i + 1]], both of shape (len(edges) - 1, len(motion.names))
+    '''
+    rows = motion.table[1:]
+    start, inv, c1, c2, c3 = rows[:, 0], rows[:, 1], rows[:, 3], rows[:, 4], rows[:, 5]
+    edges = np.asarray(edges, dtype=float)[:, np.newaxis]
+    # part of each segment (columns) inside each window (rows) in u
+    u = np.clip((edges - start) * inv, 0.0, 1.0)
+    ua, ub = u[:-1], u[1:]
+    inside = ub > ua
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = np.where(c3 != 0, -c2 / (3 * c3), -1.0)
+
+    def velocity(u):
+        return np.abs((c1 + (2 * c2 + 3 * c3 * u) * u) * inv)
+
+    v = np.maximum(velocity(ua), velocity(ub))
+    at_vertex = inside & (vertex > ua) & (vertex < ub)
+    v = np.where(at_vertex, np.maximum(v, velocity(np.clip(vertex, 0.0, 1.0))), v)
+    a = np.maximum(np.abs(2 * c2 + 6 * c3 * ua), np.abs(2 * c2 + 6 * c3 * ub)) * inv * inv
+    v[~inside] = 0.0
+    a[~inside] = 0.0
+    # rows are sorted by joint
+    first_rows = np.flatnonzero(np.diff(motion.row_joints, prepend=-1))
+    return np.maximum.reduceat(v, first_rows, axis=1), np.maximum.reduceat(a, first_rows, axis=1)
+
+
+def peak_rates(motion):
+    '''return the peak |velocity| and |acceleration| of each joint at rate 1'''
+    v, a = window_peaks(motion, [motion.t_min, motion.t_max])
+    return v[0], a[0]
+
+
+def _feasible_rates(v, a, velocity_limits, acceleration_limits, margin):
+    with np.errstate(divide='ignore'):
+        rate = np.minimum(margin * velocity_limits / v, np.sqrt(margin * acceleration_limits / a))
+    return rate.min(axis=-1)
+
+
+def max_rate(motion, margin=0.8, velocity_limits=MAX_JOINT_VELOCITY, acceleration_limits=MAX_JOINT_ACCELERATION):
+    '''return the fastest rate at which no joint exceeds margin * its limits'''
+    v, a = peak_rates(motion)
+    return _feasible_rates(v, a, *joint_limits(motion, velocity_limits, acceleration_limits), margin=margin)
+
+
+def _check_compiled(motion):
+    if isinstance(motion, TimeWarpedKeyframes):
+        raise TypeError('the motion is already time warped, scale the CompiledKeyframes it plays instead')
+
+
+def time_scaled(motion, rate=np.inf, margin=0.8, **limits):
+    '''return the CompiledKeyframes motion played at rate, or slower if rate would exceed the limits'''
+    _check_compiled(motion)
+    rate = min(rate, max_rate(motion, margin, **limits))
+    if not np.isfinite(rate) or rate <= 0:
+        # static motion (or no rate within the limits), scaling would only divide by inf or 0
+        return motion
+    return motion.scaled(rate)
+
+
+class TimeWarpedKeyframes(object):
+    '''compiled keyframes played on the time warp tau(t) = np.interp(t, times, taus)
+
+    It has no segment table, so it cannot be time scaled again.
+    '''
+    def __init__(self, motion, times, taus):
+        self.motion = motion
+        self.times = times
+        self.taus = taus
+        self.name = motion.name
+        self.names = motion.names
+        self.indices = motion.indices
+        self.known = motion.known
+        self.joint_indices = motion.joint_indices
+        self.extra_names = motion.extra_names
+        self.t_min = float(np.interp(motion.t_min, taus, times))
+        self.t_max = float(times[-1])
+
+    @property
+    def duration(self):
+        return self.t_max
+
+    def evaluate(self, t):
+        return self.motion.evaluate(np.interp(t, self.times, self.taus))
+
+    def to_dict(self, t):
+        return dict(zip(self.names, self.evaluate(t).tolist()))
+
+
+def adaptive_time_scaled(motion, rate=np.inf, dt=0.02, margin=0.8,
+                         velocity_limits=MAX_JOINT_VELOCITY, acceleration_limits=MAX_JOINT_ACCELERATION):
+    '''return the CompiledKeyframes motion with a rate of at most rate between each pair of key times'''
+    _check_compiled(motion)
+    limits = joint_limits(motion, velocity_limits, acceleration_limits)
+    key_times = motion.table[1:, 0]
+    edges = np.unique(key_times[(key_times >= motion.t_min) & (key_times <= motion.t_max)])
+    if len(edges) < 2:
+        return time_scaled(motion, rate, margin, velocity_limits=velocity_limits,
+                           acceleration_limits=acceleration_limits)
+    v, a = window_peaks(motion, edges)
+    rates = np.minimum(_feasible_rates(v, a, *limits, margin=margin), rate)
+    # windows without movement are played unscaled like static motions in time_scaled
+    rates[~np.isfinite(rates) | (rates <= 0)] = 1.0
+    # bound the velocity steps where the rate changes, by going over the windows forth and back
+    speed = np.maximum(np.abs(motion.velocity(edges[1:-1])), np.abs(motion.velocity(edges[1:-1] - 1e-9)))
+    with np.errstate(divide='ignore'):
+        steps = (margin * limits[1] * dt / speed).min(axis=1)
+    for k in range(len(rates) - 1):
+        rates[k + 1] = min(rates[k + 1], rates[k] + steps[k])
+    for k in range(len(rates) - 2, -1, -1):
+        rates[k] = min(rates[k], rates[k + 1] + steps[k])
+    # the lead in before the first key is played at the rate of the first window
+    taus = np.concatenate(([0.0], edges))
+    times = np.concatenate(([0.0], np.cumsum(np.diff(taus) / np.concatenate((rates[:1], rates)))))
+    return TimeWarpedKeyframes(motion, times, taus)
+
+
+if __name__ == '__main__':
+    from motion_library import MotionLibrary, MOTIONS
+    library = MotionLibrary()
+    print('%-20s %8s %8s %8s %10s %10s' % ('motion', 'duration', 'rate', 'uniform', 'adaptive', 'max rate 3'))
+    for name in MOTIONS:
+        motion = library[name]
+        uniform = time_scaled(motion)
+        adaptive = adaptive_time_scaled(motion)
+        capped = adaptive_time_scaled(motion, rate=3.0)
+        print('%-20s %7.2fs %8.2f %7.2fs %9.2fs %9.2fs' % (
+            name, motion.duration, max_rate(motion), uniform.duration, adaptive.duration, capped.duration))
+        # no joint of the scaled motions exceeds the limits
+        for scaled in (uniform, adaptive):
+            t = np.arange(0.0, scaled.duration, 0.001)
+            angles = scaled.evaluate(t)[:, motion.known]
+            velocity = np.abs(np.diff(angles, axis=0)).max(axis=0) / 0.001
+            assert np.all(velocity <= 0.8 * MAX_JOINT_VELOCITY[motion.joint_indices] * 1.01), name
+        try:
+            time_scaled(adaptive)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('a time warped motion was scaled again')
+
+    # a static motion, all keys equal, is played unscaled instead of evaluating to nan
+    static = library[MOTIONS[0]].scaled(1.0)
+    static.table[1:, 2:] = 0.0
+    assert max_rate(static) == np.inf
+    for scaled in (time_scaled(static), adaptive_time_scaled(static)):
+        assert scaled.duration == static.duration, scaled.duration
+        assert np.all(np.isfinite(scaled.evaluate(np.linspace(0.0, scaled.duration, 50))))
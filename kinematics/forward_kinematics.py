@@ -20,55 +20,44 @@ import os
 import sys
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'joint_control'))
 
+import numpy as np
 from numpy import sin, cos, pi, deg2rad
-from numpy.matlib import matrix, identity
 
 from recognize_posture import PostureRecognitionAgent
+from kinematic_tree import KinematicTree
+from kinematic_tree import (NECK_OFFSET_Z, SHOULDER_OFFSET_Y, SHOULDER_OFFSET_Z, UPPER_ARM_LENGTH, ELBOW_OFFSET_Y,
+                            LOWER_ARM_LENGTH, HAND_OFFSET_X, HAND_OFFSET_Z, HIP_OFFSET_Y, HIP_OFFSET_Z,
+                            THIGH_LENGTH, TIBIA_LENGTH, FOOT_HEIGHT)
 
 def Rx(angle_rad):
     c = cos(angle_rad)
     s = sin(angle_rad)
-    return matrix([[1, 0, 0, 0],
-                   [0, c, -s, 0],
-                   [0, s,  c, 0],
-                   [0, 0,  0, 1]], dtype=float)
+    return np.array([[1, 0, 0, 0],
+                     [0, c, -s, 0],
+                     [0, s,  c, 0],
+                     [0, 0,  0, 1]], dtype=float)
 
 def Ry(angle_rad):
     c = cos(angle_rad)
     s = sin(angle_rad)
-    return matrix([[c, 0, s, 0],
-                   [0, 1, 0, 0],
-                   [-s,0, c, 0],
-                   [0, 0, 0, 1]], dtype=float)
+    return np.array([[c, 0, s, 0],
+                     [0, 1, 0, 0],
+                     [-s,0, c, 0],
+                     [0, 0, 0, 1]], dtype=float)
 
 def Rz(angle_rad):
     c = cos(angle_rad)
     s = sin(angle_rad)
-    return matrix([[c, -s,0, 0],
-                   [s,  c, 0, 0],
-                   [0, 0,  1, 0],
-                   [0, 0,  0, 1]], dtype=float)
+    return np.array([[c, -s,0, 0],
+                     [s,  c, 0, 0],
+                     [0, 0,  1, 0],
+                     [0, 0,  0, 1]], dtype=float)
 
 def Trans(x, y, z):
-    return matrix([[1, 0, 0, x],
-                   [0, 1, 0, y],
-                   [0, 0, 1, z],
-                   [0, 0, 0, 1]], dtype=float)
-
-NECK_OFFSET_Z = 0.1265
-SHOULDER_OFFSET_Y = 0.098
-SHOULDER_OFFSET_Z = 0.100
-UPPER_ARM_LENGTH = 0.105
-ELBOW_OFFSET_Y = 0.015
-LOWER_ARM_LENGTH = 0.05595
-HAND_OFFSET_X = 0.05775
-HAND_OFFSET_Z = 0.01231
-
-HIP_OFFSET_Y = 0.050
-HIP_OFFSET_Z = 0.085
-THIGH_LENGTH = 0.100
-TIBIA_LENGTH = 0.10290
-FOOT_HEIGHT = 0.04519
+    return np.array([[1, 0, 0, x],
+                     [0, 1, 0, y],
+                     [0, 0, 1, z],
+                     [0, 0, 0, 1]], dtype=float)
 
 
 class ForwardKinematicsAgent(PostureRecognitionAgent):
@@ -80,85 +69,39 @@ class ForwardKinematicsAgent(PostureRecognitionAgent):
         super(ForwardKinematicsAgent, self).__init__(simspark_ip, simspark_port, teamname, player_id, sync_mode)
         
         self.joint_names.extend(['LFoot', 'RFoot', 'LArmEffector', 'RArmEffector'])
-        self.transforms = {n: identity(4) for n in self.joint_names}
-
-        self.chains = {
-            'Head': ['HeadYaw', 'HeadPitch'],
-            'LArm': ['LShoulderPitch', 'LShoulderRoll', 'LElbowYaw', 'LElbowRoll', 'LWristYaw', 'LArmEffector'],
-            'RArm': ['RShoulderPitch', 'RShoulderRoll', 'RElbowYaw', 'RElbowRoll', 'RWristYaw', 'RArmEffector'],
-            'LLeg': ['LHipYawPitch', 'LHipRoll', 'LHipPitch', 'LKneePitch', 'LAnklePitch', 'LAnkleRoll', 'LFoot'],
-            'RLeg': ['RHipYawPitch', 'RHipRoll', 'RHipPitch', 'RKneePitch', 'RAnklePitch', 'RAnkleRoll', 'RFoot']
-        }
+        # all links of the NAO in static arrays, self.transforms are views of its buffer
+        self.kinematics = KinematicTree()
+        self.transforms = self.kinematics.transforms
+        self.chains = self.kinematics.chains
+        # joints which moved less than this since their last update keep their transforms,
+        # below the resolution of 0.01 degrees of the perceived angles; None recomputes all links
+        self.fk_tolerance = 1e-4
 
     def think(self, perception):
-        self.forward_kinematics(perception.joint)
+        with self.timed('forward_kinematics'):
+            self.forward_kinematics(perception.joint_angles)
         return super(ForwardKinematicsAgent, self).think(perception)
 
     def local_trans(self, joint_name, joint_angle):
-        T = identity(4)
-        if joint_name == 'HeadYaw':
-            T = Trans(0, 0, NECK_OFFSET_Z) * Rz(joint_angle)
-        elif joint_name == 'HeadPitch':
-            T = Ry(joint_angle)
-        elif joint_name == 'LShoulderPitch':
-            T = Trans(0, SHOULDER_OFFSET_Y, SHOULDER_OFFSET_Z) * Ry(joint_angle)
-        elif joint_name == 'LShoulderRoll':
-            T = Rz(joint_angle)
-        elif joint_name == 'LElbowYaw':
-            T = Trans(UPPER_ARM_LENGTH, ELBOW_OFFSET_Y, 0) * Rx(joint_angle)
-        elif joint_name == 'LElbowRoll':
-            T = Rz(joint_angle)
-        elif joint_name == 'LWristYaw':
-            T = Trans(LOWER_ARM_LENGTH, 0, 0) * Rx(joint_angle)
-        elif joint_name == 'LArmEffector':
-             T = Trans(HAND_OFFSET_X, 0, -HAND_OFFSET_Z)
-        elif joint_name == 'RShoulderPitch':
-            T = Trans(0, -SHOULDER_OFFSET_Y, SHOULDER_OFFSET_Z) * Ry(joint_angle)
-        elif joint_name == 'RShoulderRoll':
-            T = Rz(joint_angle)
-        elif joint_name == 'RElbowYaw':
-            T = Trans(UPPER_ARM_LENGTH, -ELBOW_OFFSET_Y, 0) * Rx(joint_angle)
-        elif joint_name == 'RElbowRoll':
-            T = Rz(joint_angle)
-        elif joint_name == 'RWristYaw':
-            T = Trans(LOWER_ARM_LENGTH, 0, 0) * Rx(joint_angle)
-        elif joint_name == 'RArmEffector':
-             T = Trans(HAND_OFFSET_X, 0, -HAND_OFFSET_Z)
-        elif joint_name == 'LHipYawPitch':
-            T = Trans(0, HIP_OFFSET_Y, -HIP_OFFSET_Z) * Rz(joint_angle)
-        elif joint_name == 'LHipRoll':
-            T = Rx(joint_angle)
-        elif joint_name == 'LHipPitch':
-            T = Ry(joint_angle)
-        elif joint_name == 'LKneePitch':
-            T = Trans(0, 0, -THIGH_LENGTH) * Ry(joint_angle)
-        elif joint_name == 'LAnklePitch':
-            T = Trans(0, 0, -TIBIA_LENGTH) * Ry(joint_angle)
-        elif joint_name == 'LAnkleRoll':
-            T = Rx(joint_angle)
-        elif joint_name == 'LFoot':
-            T = Trans(0, 0, -FOOT_HEIGHT)
-        elif joint_name == 'RHipYawPitch':
-            T = Trans(0, -HIP_OFFSET_Y, -HIP_OFFSET_Z) * Rz(joint_angle)
-        elif joint_name == 'RHipRoll':
-            T = Rx(joint_angle)
-        elif joint_name == 'RHipPitch':
-            T = Ry(joint_angle)
-        elif joint_name == 'RKneePitch':
-            T = Trans(0, 0, -THIGH_LENGTH) * Ry(joint_angle)
-        elif joint_name == 'RAnklePitch':
-            T = Trans(0, 0, -TIBIA_LENGTH) * Ry(joint_angle)
-        elif joint_name == 'RAnkleRoll':
-            T = Rx(joint_angle)
-        elif joint_name == 'RFoot':
-            T = Trans(0, 0, -FOOT_HEIGHT)
-        return T
+        '''calculate local transformation of one joint
+
+        :param str joint_name: the name of joint
+        :param float joint_angle: the angle of joint in radians
+        :return: transformation
+        :rtype: 4x4 ndarray
+        '''
+        return self.kinematics.local_transform(joint_name, joint_angle)
 
     def forward_kinematics(self, joints):
-        for chain_name, chain_joints in self.chains.items():
-            T_global = identity(4)
-            for joint in chain_joints:
-                angle = joints.get(joint, 0.0)
-                Tl = self.local_trans(joint, angle)
-                T_global = T_global * Tl
-                self.transforms[joint] = T_global
\ No newline at end of file
+        '''forward kinematics
+
+        :param joints: the angles in JOINT_NAMES order, or a {joint name: angle} mapping
+        '''
+        n_links = len(self.kinematics.names)
+        if self.fk_tolerance is None:
+            self.kinematics.forward(joints)
+            computed = n_links
+        else:
+            computed = self.kinematics.forward_incremental(joints, self.fk_tolerance)
+        self.count('fk_links_computed', computed)
+        self.count('fk_links_skipped', n_links - computed)
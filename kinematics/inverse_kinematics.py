@@ -7,127 +7,102 @@
        http://doc.aldebaran.com/2-1/family/nao_h21/links_h21.html
     2. use the results of inverse kinematics to control NAO's legs (in InverseKinematicsAgent.set_transforms)
        and test your inverse kinematics implementation.
+
+usage: python inverse_kinematics.py [check]
+check runs set_transforms on the Head and LLeg against fake_simspark instead of a server
 '''
 
 
+import sys
+
 import numpy as np
-from math import acos, asin, atan2, sqrt, pi, degrees
+from math import degrees
 
 from forward_kinematics import ForwardKinematicsAgent, Trans, Rx, Ry, Rz
 from forward_kinematics import THIGH_LENGTH, TIBIA_LENGTH, HIP_OFFSET_Y, HIP_OFFSET_Z, FOOT_HEIGHT
+from leg_ik import LegIK, LEG_JOINTS
+from jacobian_ik import JacobianIK
+from spark_agent import JOINT_INDEX
 
 class InverseKinematicsAgent(ForwardKinematicsAgent):
-    def inverse_kinematics(self, effector_name, transform_torso_to_foot):
-        joint_angles_rad = [0.0] * 6
+    def __init__(self, simspark_ip='localhost',
+                 simspark_port=3100,
+                 teamname='DAInamite',
+                 player_id=0,
+                 sync_mode=True):
+        super(InverseKinematicsAgent, self).__init__(simspark_ip, simspark_port, teamname, player_id, sync_mode)
+        # closed form for the legs, damped least squares for the other chains
+        self.leg_ik = {leg: LegIK(leg) for leg in LEG_JOINTS}
+        self.jacobian_ik = JacobianIK(self.kinematics)
 
-        if effector_name != 'LLeg' and effector_name != 'RLeg':
-            print(f"Inverse Kinematics not implemented for {effector_name}")
+    def inverse_kinematics(self, effector_name, transform_torso_to_foot):
+        '''return the angles of the joints of chain effector_name which move its end to
+        transform_torso_to_foot, the other chains start from the perceived angles
+        '''
+        if effector_name in self.leg_ik:
+            leg_ik = self.leg_ik[effector_name]
+            joint_angles_rad, reachable = leg_ik.solve_one(transform_torso_to_foot)
+            if not reachable:
+                print(f"Target of {effector_name} is not reachable, moving towards it within the joint limits")
+                joint_angles_rad = np.clip(joint_angles_rad, leg_ik.limits[:, 0], leg_ik.limits[:, 1]).tolist()
             return joint_angles_rad
-
-        l_upper_leg = THIGH_LENGTH
-        l_lower_leg = TIBIA_LENGTH
-        
-        current_hip_offset_y = HIP_OFFSET_Y
-        if effector_name == 'RLeg':
-            current_hip_offset_y = -HIP_OFFSET_Y
-
-        T_torso_to_hip_yaw_pitch_origin = Trans(0, current_hip_offset_y, -HIP_OFFSET_Z)
-        T_hip_yaw_pitch_origin_to_foot = np.linalg.inv(T_torso_to_hip_yaw_pitch_origin) * transform_torso_to_foot
-        
-        p_AR_H0 = np.array(T_hip_yaw_pitch_origin_to_foot[0:3, 3]).flatten()
-
-        rot_angle_hip_ortho = pi/4
-        if effector_name == 'RLeg':
-            rot_angle_hip_ortho = -pi/4
-        
-        Rx_hip_ortho_mat = np.array(Rx(rot_angle_hip_ortho)[0:3, 0:3])
-
-        p_AR_H_ortho = Rx_hip_ortho_mat @ p_AR_H0
-        x, y, z = p_AR_H_ortho[0], p_AR_H_ortho[1], p_AR_H_ortho[2]
-
-        l_trans_sq = x*x + y*y + z*z
-        l_trans = sqrt(l_trans_sq)
-
-        cos_gamma_knee_arg = (l_upper_leg**2 + l_lower_leg**2 - l_trans_sq) / (2 * l_upper_leg * l_lower_leg)
-        if cos_gamma_knee_arg > 1.0: cos_gamma_knee_arg = 1.0
-        if cos_gamma_knee_arg < -1.0: cos_gamma_knee_arg = -1.0
-        gamma_knee = acos(cos_gamma_knee_arg)
-        delta_knee = gamma_knee # Aldebaran Doku: positiver Winkel ist Beugung
-        joint_angles_rad[3] = delta_knee
-
-        val_acos_foot1_arg = (l_lower_leg**2 + l_trans_sq - l_upper_leg**2) / (2 * l_lower_leg * l_trans)
-        if l_trans == 0: # Vermeide Division durch Null, falls Fuß am Hüft-Ursprung
-             val_acos_foot1_arg = 0 # Führt zu pi/2, was wahrscheinlich nicht ideal ist, aber Singularität vermeidet
-        elif val_acos_foot1_arg > 1.0: val_acos_foot1_arg = 1.0
-        elif val_acos_foot1_arg < -1.0: val_acos_foot1_arg = -1.0
-        delta_foot_pitch1 = acos(val_acos_foot1_arg)
-
-        delta_foot_pitch2 = atan2(x, sqrt(y**2 + z**2) if (y**2 + z**2) > 1e-9 else 1e-9) # Vermeide sqrt(0)
-        delta_foot_roll = atan2(y, z if abs(z) > 1e-9 else 1e-9 * np.sign(z) if z!=0 else 1e-9 ) #Vermeide atan2(y,0) für z=0
-
-        joint_angles_rad[4] = -(delta_foot_pitch1 + delta_foot_pitch2) # NAO Konvention: negativer Pitch neigt Fuß nach unten
-        joint_angles_rad[5] = delta_foot_roll                    
-        
-        R_H0_AR_original = np.array(T_hip_yaw_pitch_origin_to_foot[0:3, 0:3])
-        R_H_ortho_AR = Rx_hip_ortho_mat @ R_H0_AR_original
-        
-        R_Thigh_Knee = np.array(Ry(delta_knee)[0:3,0:3])
-        R_Knee_AnkleP = np.array(Ry(joint_angles_rad[4])[0:3,0:3])
-        R_AnkleP_AnkleR = np.array(Rx(joint_angles_rad[5])[0:3,0:3])
-        
-        R_Thigh_AR = R_Thigh_Knee @ R_Knee_AnkleP @ R_AnkleP_AnkleR
-
-        R_HT = R_H_ortho_AR @ np.linalg.inv(R_Thigh_AR)
-
-        # Euler-Winkel-Extraktion aus R_HT (Z-X-Y Reihenfolge für HipYawPitch, HipRoll', HipPitch')
-        # R_HT = Rz(delta_hip_yaw) * Rx(delta_hip_roll_prime) * Ry(delta_hip_pitch)
-        
-        # sin(roll') = R_HT[2,1]
-        sin_delta_hip_roll_prime_val = R_HT[2,1]
-        if sin_delta_hip_roll_prime_val > 1.0: sin_delta_hip_roll_prime_val = 1.0
-        if sin_delta_hip_roll_prime_val < -1.0: sin_delta_hip_roll_prime_val = -1.0
-        delta_hip_roll_prime = asin(sin_delta_hip_roll_prime_val)
-
-        cos_delta_hip_roll_prime = cos(delta_hip_roll_prime)
-
-        if abs(cos_delta_hip_roll_prime) < 1e-6: # Gimbal Lock Fall
-            delta_hip_yaw = 0 # Kann nicht eindeutig bestimmt werden, setze zu 0
-            delta_hip_pitch = atan2(R_HT[0,2], R_HT[0,0]) # Oder eine andere Konvention
-        else:
-            delta_hip_pitch = atan2(-R_HT[2,0] / cos_delta_hip_roll_prime, R_HT[2,2] / cos_delta_hip_roll_prime)
-            delta_hip_yaw = atan2(-R_HT[0,1] / cos_delta_hip_roll_prime, R_HT[1,1] / cos_delta_hip_roll_prime)
-
-        joint_angles_rad[0] = delta_hip_yaw     
-        joint_angles_rad[1] = delta_hip_roll_prime - rot_angle_hip_ortho 
-        joint_angles_rad[2] = delta_hip_pitch  
-
-        if effector_name == 'RLeg':
-            joint_angles_rad[0] *= -1 
-            joint_angles_rad[1] *= -1 
-            joint_angles_rad[5] *= -1 
-            
-        return joint_angles_rad
+        if effector_name not in self.jacobian_ik.chains:
+            print(f"Inverse Kinematics not implemented for {effector_name}")
+            return []
+        joint_angles_rad, error, iterations = self.jacobian_ik.solve(
+            effector_name, transform_torso_to_foot, self.perception.joint_angles)
+        if error == np.inf:
+            print(f"Joints of {effector_name} cannot move it towards the target")
+            return []
+        if error > self.jacobian_ik.tolerance:
+            print(f"Target of {effector_name} not reached, {error:.4f} m left after {iterations} iterations")
+        return joint_angles_rad.tolist()
 
     def set_transforms(self, effector_name, transform):
-        joint_angles_rad = self.inverse_kinematics(effector_name, transform)
-        
-        joint_angles_deg = [degrees(angle) for angle in joint_angles_rad]
-        print(f"Calculated angles for {effector_name} (deg): {joint_angles_deg}")
-
-        if effector_name == 'LLeg':
-            leg_joint_names = ['LHipYawPitch', 'LHipRoll', 'LHipPitch', 'LKneePitch', 'LAnklePitch', 'LAnkleRoll']
-        elif effector_name == 'RLeg':
-            leg_joint_names = ['RHipYawPitch', 'RHipRoll', 'RHipPitch', 'RKneePitch', 'RAnklePitch', 'RAnkleRoll']
-        else:
-            return
-
-        if joint_angles_rad:
-            values_for_keyframes = [joint_angles_rad]
-            times_for_keyframes = [[1.0] * len(joint_angles_rad)] 
-            self.keyframes = (leg_joint_names, values_for_keyframes, times_for_keyframes)
+        self.set_body_transforms({effector_name: transform})
+
+    def set_body_transforms(self, transforms):
+        '''move the ends of several chains {effector name: transform} in one motion'''
+        names, times, keys = [], [], []
+        for effector_name, transform in transforms.items():
+            joint_angles_rad = self.inverse_kinematics(effector_name, transform)
+            if not joint_angles_rad:
+                continue
+            joint_angles_deg = [degrees(angle) for angle in joint_angles_rad]
+            print(f"Calculated angles for {effector_name} (deg): {joint_angles_deg}")
+
+            # one key per joint after 1s, in the (names, times, keys) format of the keyframes
+            names.extend(self.jacobian_ik.chains[effector_name].joint_names)
+            times.extend([1.0] for _ in joint_angles_rad)
+            keys.extend([[angle, [3, 0.0, 0.0], [3, 0.0, 0.0]]] for angle in joint_angles_rad)
+        if names:
+            self.keyframes = (names, times, keys)
+
+
+def check_set_transforms(agent):
+    '''set_transforms of a pose reached by forward kinematics has to give back its angles'''
+    joint_angles = np.zeros(len(agent.perception.joint_angles))
+    for name, angle in [('HeadYaw', 0.4), ('HeadPitch', -0.3), ('LHipYawPitch', -0.2), ('LHipRoll', 0.1),
+                        ('LHipPitch', -0.4), ('LKneePitch', 0.8), ('LAnklePitch', -0.4), ('LAnkleRoll', -0.1)]:
+        joint_angles[JOINT_INDEX[name]] = angle
+    targets = agent.kinematics.forward(joint_angles).copy()
+    for effector_name in ('Head', 'LLeg'):
+        chain = agent.jacobian_ik.chains[effector_name]
+        agent.set_transforms(effector_name, targets[chain.links[-1]])
+        names, times, keys = agent.keyframes
+        angles = [key[0][0] for key in keys]
+        expected = joint_angles[chain.joint_indices]
+        assert names == chain.joint_names and np.allclose(angles, expected, atol=1e-3), (effector_name, angles)
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['check']:
+        # offline against fake_simspark
+        from fake_simspark import FakeSimSpark
+        check_set_transforms(InverseKinematicsAgent(simspark_port=FakeSimSpark().start().port))
+        print('set_transforms reproduces the Head and LLeg angles')
+        sys.exit()
+
     agent = InverseKinematicsAgent()
     
     target_x_torso = 0.0
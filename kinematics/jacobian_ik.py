@@ -0,0 +1,225 @@
+'''Damped least squares inverse kinematics for every chain of the kinematic tree
+
+For the actuated joints of a chain with world axes z_i at the positions
+p_i, the Jacobian of the effector at p_e is analytic:
+
+    J_i = [z_i x (p_e - p_i); w z_i]
+
+The position error and, weighted with w, the rotation error
+0.5 sum_j R_e[:, j] x R_t[:, j] are reduced by steps
+
+    dq = J^T (J J^T + damping^2 I)^-1 e
+
+which stay bounded near singularities, e.g. a stretched arm. After each
+step the angles are clamped to the JOINT_LIMITS of spark_agent. The
+iteration starts at the current angles, so in a control loop a few steps
+follow a moving target, and it stops at max_iterations or when
+time_budget seconds have passed:
+
+    ik = JacobianIK(tree)
+    angles, error, iterations = ik.solve('LArm', target, perception.joint_angles)
+
+The arms have four actuated joints (the SimSpark NAO has no wrist yaw),
+so with the default orientation_weight of 0 only the position of the
+effector is reached. The head joints do not move the head position, the
+Head chain has the orientation weight CHAIN_ORIENTATION_WEIGHTS['Head'].
+A chain whose joints cannot move the weighted error at all (its Jacobian
+has less than full rank at a generic pose) is not solved, solve returns
+the start angles with an error of inf.
+
+usage: python jacobian_ik.py [n]
+solves n random reachable targets of each chain
+'''
+from time import perf_counter
+
+import numpy as np
+
+from kinematic_tree import KinematicTree
+from spark_agent import JOINT_INDEX, JOINT_LIMITS
+
+# default orientation weights of chains which are pointed rather than placed
+CHAIN_ORIENTATION_WEIGHTS = {'Head': 1.0}
+
+class IKChain(object):
+    '''arrays and buffers of one chain of a KinematicTree'''
+    def __init__(self, tree, chain):
+        self.name = chain
+        self.links = np.array([tree.index[name] for name in tree.chains[chain]], dtype=np.intp)
+        names = [tree.names[i] for i in self.links]
+        # actuated: perceived joints with an axis, the others keep angle 0
+        self.actuated = np.array([name in JOINT_INDEX and tree.axes[i].any() for name, i in zip(names, self.links)])
+        self.joint_names = [name for name, actuated in zip(names, self.actuated) if actuated]
+        self.joint_indices = np.array([JOINT_INDEX[name] for name in self.joint_names], dtype=np.intp)
+        self.lower, self.upper = np.array([JOINT_LIMITS[name] for name in self.joint_names]).T
+        self.axes = tree.axes[self.links][self.actuated]
+        self.basis = tree.basis[self.links]
+        k = len(self.links)
+        self.angles = np.zeros(k)
+        self.weights = np.zeros((k, 1, 3))
+        self.weights[:, 0, 0] = 1.0
+        self.local = np.empty((k, 4, 4))
+        self.transforms = np.empty((k, 4, 4))
+
+    def forward(self, q):
+        '''compute the transforms of the chain links for the actuated angles q, return the effector'''
+        self.angles[self.actuated] = q
+        np.sin(self.angles, out=self.weights[:, 0, 1])
+        np.cos(self.angles, out=self.weights[:, 0, 2])
+        np.subtract(1.0, self.weights[:, 0, 2], out=self.weights[:, 0, 2])
+        np.matmul(self.weights, self.basis, out=self.local.reshape(-1, 1, 16))
+        T = self.transforms
+        T[0] = self.local[0]
+        for i in range(1, len(T)):
+            np.matmul(T[i - 1], self.local[i], out=T[i])
+        return T[-1]
+
+
+class JacobianIK(object):
+    def __init__(self, tree=None, damping=0.01, orientation_weight=0.0, tolerance=1e-4,
+                 max_iterations=50, time_budget=0.002):
+        self.tree = tree or KinematicTree()
+        self.chains = {chain: IKChain(self.tree, chain) for chain in self.tree.chains}
+        self.damping = damping
+        self.orientation_weight = orientation_weight
+        self.orientation_weights = dict(CHAIN_ORIENTATION_WEIGHTS)
+        self._controllable = {}
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+
+    def error(self, effector, target, orientation_weight):
+        '''return the position error and the weighted rotation error (6,) of effector to target'''
+        e = np.empty(6)
+        e[:3] = target[:3, 3] - effector[:3, 3]
+        if orientation_weight:
+            e[3:] = np.cross(effector[:3, :3].T, target[:3, :3].T).sum(axis=0) * (0.5 * orientation_weight)
+        else:
+            e[3:] = 0.0
+        return e
+
+    def jacobian(self, ik_chain, orientation_weight):
+        '''return the Jacobian (6, n_actuated) at the last ik_chain.forward()'''
+        T = ik_chain.transforms
+        joints = T[ik_chain.actuated]
+        z = np.einsum('kij,kj->ki', joints[:, :3, :3], ik_chain.axes)
+        J = np.empty((6, len(z)))
+        J[:3] = np.cross(z, T[-1, :3, 3] - joints[:, :3, 3]).T
+        J[3:] = z.T * orientation_weight
+        return J
+
+    def controllable(self, chain, orientation):
+        '''return True if the Jacobian of chain has full rank at a generic pose, for the position
+        rows only or with the orientation rows
+        '''
+        key = (chain, bool(orientation))
+        if key not in self._controllable:
+            ik_chain = self.chains[chain]
+            # away from the zero pose and the limits, where the arms are stretched
+            ik_chain.forward(ik_chain.lower + 0.37 * (ik_chain.upper - ik_chain.lower))
+            J = self.jacobian(ik_chain, 1.0)[:6 if orientation else 3]
+            self._controllable[key] = np.linalg.matrix_rank(J, 1e-9) == min(J.shape)
+        return self._controllable[key]
+
+    def solve(self, chain, target, joint_angles=None, orientation_weight=None, max_iterations=None,
+              time_budget=None, deadline=None):
+        '''return the actuated angles of chain which move its effector to target (4, 4) in torso
+        coordinates, the remaining error and the number of iterations. joint_angles in JOINT_NAMES
+        order are the start, e.g. perception.joint_angles.
+        '''
+        ik_chain = self.chains[chain]
+        target = np.asarray(target, dtype=float)
+        if orientation_weight is None:
+            w = self.orientation_weights.get(chain, self.orientation_weight)
+        else:
+            w = orientation_weight
+        if max_iterations is None:
+            max_iterations = self.max_iterations
+        if deadline is None:
+            deadline = perf_counter() + (self.time_budget if time_budget is None else time_budget)
+        if joint_angles is None:
+            q = np.zeros(len(ik_chain.joint_names))
+        else:
+            q = np.asarray(joint_angles, dtype=float)[ik_chain.joint_indices]
+        q = np.clip(q, ik_chain.lower, ik_chain.upper)
+        if not self.controllable(chain, w):
+            # a zero error would only mean that the joints do not change it
+            return q, np.inf, 0
+        rows = slice(0, 6 if w else 3)
+        damping = self.damping ** 2 * np.identity(rows.stop)
+
+        e = self.error(ik_chain.forward(q), target, w)
+        error = np.linalg.norm(e)
+        best, best_error = q, error
+        iterations = 0
+        while error > self.tolerance and iterations < max_iterations and perf_counter() < deadline:
+            J = self.jacobian(ik_chain, w)[rows]
+            dq = J.T @ np.linalg.solve(J @ J.T + damping, e[rows])
+            q = np.clip(q + dq, ik_chain.lower, ik_chain.upper)
+            e = self.error(ik_chain.forward(q), target, w)
+            error = np.linalg.norm(e)
+            iterations += 1
+            if error < best_error:
+                best, best_error = q, error
+        return best, best_error, iterations
+
+    def solve_all(self, targets, joint_angles=None, time_budget=None, **kwargs):
+        '''solve {chain: target} within one time budget, return {chain: (angles, error, iterations)}.
+        The chains of the tree do not share joints, so each is solved on its own.
+        '''
+        deadline = perf_counter() + (self.time_budget if time_budget is None else time_budget)
+        return {chain: self.solve(chain, target, joint_angles, deadline=deadline, **kwargs)
+                for chain, target in targets.items()}
+
+
+if __name__ == '__main__':
+    import sys
+    from spark_agent import N_JOINTS
+    from leg_ik import LegIK, LEG_JOINTS
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    tree = KinematicTree()
+    ik = JacobianIK(tree, time_budget=0.02)
+    rng = np.random.RandomState(0)
+    for chain, ik_chain in ik.chains.items():
+        # the default weights, the head is pointed and the other chains reach a position
+        errors, iterations, times = [], [], []
+        for _ in range(n):
+            # a reachable target, solved from a start pose up to 0.5 rad away from it
+            joint_angles = np.zeros(N_JOINTS)
+            joint_angles[ik_chain.joint_indices] = rng.uniform(ik_chain.lower, ik_chain.upper)
+            target = tree.forward(joint_angles)[ik_chain.links[-1]].copy()
+            start = joint_angles.copy()
+            start[ik_chain.joint_indices] = np.clip(
+                start[ik_chain.joint_indices] + rng.uniform(-0.5, 0.5, len(ik_chain.joint_names)),
+                ik_chain.lower, ik_chain.upper)
+            t0 = perf_counter()
+            q, error, k = ik.solve(chain, target, start)
+            times.append(perf_counter() - t0)
+            assert np.all(q >= ik_chain.lower) and np.all(q <= ik_chain.upper)
+            errors.append(error)
+            iterations.append(k)
+        errors = np.array(errors)
+        print('%-5s %d joints: %.1f%% below %.0e, median error %.1e, %.1f iterations, %.2f ms per solve' % (
+            chain, len(ik_chain.joint_names), 100 * np.mean(errors <= ik.tolerance), ik.tolerance,
+            np.median(errors), np.mean(iterations), 1e3 * np.mean(times)))
+
+    # without orientation the head joints change nothing, which is not a solution
+    target = tree.forward(np.zeros(N_JOINTS))[ik.chains['Head'].links[-1]].copy()
+    assert ik.solve('Head', target, np.zeros(N_JOINTS), orientation_weight=0.0)[1] == np.inf
+    assert all(ik.controllable(chain, chain == 'Head') for chain in ik.chains)
+
+    # the budget is kept
+    t0 = perf_counter()
+    far = np.identity(4)
+    far[:3, 3] = (1.0, 0.5, 0.0)
+    ik.solve('LArm', far, None, max_iterations=10 ** 6, time_budget=0.005)
+    print('unreachable target stopped after %.1f ms of a 5 ms budget' % (1e3 * (perf_counter() - t0)))
+
+    # a leg target, against the closed form
+    joint_angles = np.zeros(N_JOINTS)
+    names = LEG_JOINTS['LLeg']
+    joint_angles[[JOINT_INDEX[name] for name in names]] = [0.1, 0.2, -0.5, 0.9, -0.4, -0.1]
+    target = tree.forward(joint_angles)[tree.index['LFoot']].copy()
+    q, error, k = ik.solve('LLeg', target, np.zeros(N_JOINTS), orientation_weight=1.0)
+    print('LLeg pose error %.1e after %d iterations, closed form differs by %.1e rad' % (
+        error, k, np.abs(q - LegIK('LLeg').solve_one(target)[0]).max()))
@@ -0,0 +1,356 @@
+'''The kinematic tree of the NAO as static arrays
+
+Every link has a parent (-1 for the torso), a fixed offset to the parent
+and the axis of its joint (zero for fixed links such as the feet), so
+
+    local(link) = Trans(offset) * R(axis, angle)
+    T(link) = T(parent) * local(link)
+
+The rotations of all links come from Rodrigues' formula
+R = I + sin(a) K + (1 - cos(a)) K^2 with the cross product matrices K of
+the axes in one go. The links are sorted by depth, so each level of the
+tree is a slice and is composed with its parents by one batched matmul:
+7 levels instead of 28 matrix products. The transforms are written into
+the preallocated buffer `transforms_array` (n_links, 4, 4), and the
+dict `transforms` holds views of it by link name.
+
+forward_incremental() keeps the transforms of the links whose joints
+did not move by more than a tolerance. Below the first moved joint of a
+chain it multiplies the cached prefix with the local transforms of the
+suffix, link by link. It falls back to all levels when that would take
+more matmuls.
+
+For offline analyses the same levels are evaluated for many joint
+configurations at once, without an agent or simulator:
+
+    T = batch_forward_kinematics(angles)        # (N, 22) -> (N, n_links, 4, 4)
+    for T in iter_forward_kinematics(log, 1024):  # long logs in chunks
+        ...
+
+usage: python kinematic_tree.py
+checks the batched against the single evaluation on the keyframe motions
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'software_installation'))
+
+import numpy as np
+
+from spark_agent import JOINT_INDEX
+
+NECK_OFFSET_Z = 0.1265
+SHOULDER_OFFSET_Y = 0.098
+SHOULDER_OFFSET_Z = 0.100
+UPPER_ARM_LENGTH = 0.105
+ELBOW_OFFSET_Y = 0.015
+LOWER_ARM_LENGTH = 0.05595
+HAND_OFFSET_X = 0.05775
+HAND_OFFSET_Z = 0.01231
+
+HIP_OFFSET_Y = 0.050
+HIP_OFFSET_Z = 0.085
+THIGH_LENGTH = 0.100
+TIBIA_LENGTH = 0.10290
+FOOT_HEIGHT = 0.04519
+
+AXES = {'x': (1.0, 0.0, 0.0), 'y': (0.0, 1.0, 0.0), 'z': (0.0, 0.0, 1.0), None: (0.0, 0.0, 0.0)}
+
+
+def _arm(side, y):
+    return [(side + 'ShoulderPitch', (0, y * SHOULDER_OFFSET_Y, SHOULDER_OFFSET_Z), 'y'),
+            (side + 'ShoulderRoll', (0, 0, 0), 'z'),
+            (side + 'ElbowYaw', (UPPER_ARM_LENGTH, y * ELBOW_OFFSET_Y, 0), 'x'),
+            (side + 'ElbowRoll', (0, 0, 0), 'z'),
+            (side + 'WristYaw', (LOWER_ARM_LENGTH, 0, 0), 'x'),
+            (side + 'ArmEffector', (HAND_OFFSET_X, 0, -HAND_OFFSET_Z), None)]
+
+
+def _leg(side, y):
+    return [(side + 'HipYawPitch', (0, y * HIP_OFFSET_Y, -HIP_OFFSET_Z), 'z'),
+            (side + 'HipRoll', (0, 0, 0), 'x'),
+            (side + 'HipPitch', (0, 0, 0), 'y'),
+            (side + 'KneePitch', (0, 0, -THIGH_LENGTH), 'y'),
+            (side + 'AnklePitch', (0, 0, -TIBIA_LENGTH), 'y'),
+            (side + 'AnkleRoll', (0, 0, 0), 'x'),
+            (side + 'Foot', (0, 0, -FOOT_HEIGHT), None)]
+
+
+# chain -> links (name, offset to the previous link, joint axis) from the torso outwards
+NAO_CHAINS = {
+    'Head': [('HeadYaw', (0, 0, NECK_OFFSET_Z), 'z'), ('HeadPitch', (0, 0, 0), 'y')],
+    'LArm': _arm('L', 1),
+    'RArm': _arm('R', -1),
+    'LLeg': _leg('L', 1),
+    'RLeg': _leg('R', -1),
+}
+
+
+def cross_matrices(axes):
+    '''return the cross product matrices K (n, 3, 3) of the axes (n, 3), K v = axis x v'''
+    x, y, z = np.asarray(axes, dtype=float).T
+    zero = np.zeros_like(x)
+    return np.stack([np.stack([zero, -z, y], axis=-1),
+                     np.stack([z, zero, -x], axis=-1),
+                     np.stack([-y, x, zero], axis=-1)], axis=-2)
+
+
+class KinematicTree(object):
+    def __init__(self, chains=NAO_CHAINS):
+        links = []  # (depth, name, parent name, offset, axis)
+        for chain in chains.values():
+            parent = None
+            for depth, (name, offset, axis) in enumerate(chain):
+                links.append((depth, name, parent, offset, axis))
+                parent = name
+        links.sort(key=lambda link: link[0])  # stable, keeps the chain order within a level
+        self.names = [link[1] for link in links]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.chains = {chain: [name for name, _, _ in chain_links] for chain, chain_links in chains.items()}
+        self.parents = np.array([self.index[link[2]] if link[2] else -1 for link in links], dtype=np.intp)
+        self.offsets = np.array([link[3] for link in links], dtype=float)
+        self.axes = np.array([AXES[link[4]] for link in links])
+        n = len(links)
+
+        # R = I + sin(a) K + (1 - cos(a)) K^2
+        self.K = cross_matrices(self.axes)
+        self.K2 = self.K @ self.K
+        self.local = np.zeros((n, 4, 4))
+        self.local[:, :3, 3] = self.offsets
+        self.local[:, 3, 3] = 1.0
+        self.rotations = self.local[:, :3, :3]
+        # identity until the first forward(), like the transforms of the agent before
+        self.transforms_array = np.tile(np.identity(4), (n, 1, 1))
+        self.transforms = {name: self.transforms_array[i] for i, name in enumerate(self.names)}
+
+        # (start, end, parents) of each level, parents is None for the links at the torso and a
+        # slice instead of an index array where they are consecutive, which saves a gather
+        depths = [link[0] for link in links]
+        self.levels = []
+        for depth in range(max(depths) + 1):
+            start, end = depths.index(depth), n - depths[::-1].index(depth)
+            parents = self.parents[start:end] if depth else None
+            if depth and np.all(np.diff(parents) == 1):
+                parents = slice(parents[0], parents[-1] + 1)
+            self.levels.append((start, end, parents))
+
+        # the local transforms of a batch are [1, sin(a), 1 - cos(a)] @ basis, one matmul
+        self.basis = np.zeros((n, 3, 4, 4))
+        self.basis[:, 0] = self.local
+        self.basis[:, 0, :3, :3] = np.identity(3)
+        self.basis[:, 1, :3, :3] = self.K
+        self.basis[:, 2, :3, :3] = self.K2
+        self.basis = self.basis.reshape(n, 3, 16)
+
+        # chain, depth and views of each link for the incremental update
+        self.chain_links = {chain: [self.index[name] for name in names] for chain, names in self.chains.items()}
+        self.link_chain = [None] * n
+        self.link_depth = [0] * n
+        for chain, chain_links in self.chain_links.items():
+            for depth, i in enumerate(chain_links):
+                self.link_chain[i] = chain
+                self.link_depth[i] = depth
+        self.transform_views = list(self.transforms_array)
+        self.local_views = list(self.local)
+
+        # links whose angle is perceived, the others (fixed, LWristYaw) stay at 0
+        self.angles = np.zeros(n)
+        self.new_angles = np.zeros(n)
+        self.cached = False  # transforms_array holds the transforms of self.angles
+        self.perceived = np.array([name in JOINT_INDEX and self.axes[i].any() for i, name in enumerate(self.names)])
+        self.joint_indices = np.array([JOINT_INDEX[name] for name in np.array(self.names)[self.perceived]],
+                                      dtype=np.intp)
+
+    def set_angles(self, joints, out=None):
+        '''take the angles from an array in JOINT_NAMES order or a {joint name: angle} mapping'''
+        if out is None:
+            out = self.angles
+            self.cached = False
+        if isinstance(joints, np.ndarray):
+            out[self.perceived] = joints[self.joint_indices]
+        else:
+            for i, name in enumerate(self.names):
+                out[i] = joints.get(name, 0.0)
+        return out
+
+    def local_transforms(self):
+        '''compute the local transforms of all links from self.angles into self.local'''
+        s = np.sin(self.angles)[:, np.newaxis, np.newaxis]
+        c = np.cos(self.angles)[:, np.newaxis, np.newaxis]
+        R = self.rotations
+        np.multiply(self.K, s, out=R)
+        R += self.K2 * (1.0 - c)
+        R[:, 0, 0] += 1.0
+        R[:, 1, 1] += 1.0
+        R[:, 2, 2] += 1.0
+        return self.local
+
+    def forward(self, joints=None):
+        '''compute the transforms of all links in torso coordinates, return transforms_array'''
+        if joints is not None:
+            self.set_angles(joints)
+        self.local_transforms()
+        return self._compose()
+
+    def _compose(self):
+        '''compose the transforms of all links from self.local, level by level'''
+        local = self.local
+        T = self.transforms_array
+        for start, end, parents in self.levels:
+            if parents is None:
+                T[start:end] = local[start:end]
+            else:
+                np.matmul(T[parents], local[start:end], out=T[start:end])
+        self.cached = True
+        return T
+
+    def forward_incremental(self, joints, tolerance=1e-4):
+        '''update the transforms of the links whose joint or a joint above them in the chain moved
+        more than tolerance since their last update, the others keep their cached transforms.
+        Return the number of links which were computed.
+        '''
+        if not self.cached:
+            self.forward(joints)
+            return len(self.names)
+        new = self.set_angles(joints, self.new_angles)
+        moved = np.flatnonzero(np.abs(new - self.angles) > tolerance)
+        if not len(moved):
+            return 0
+        # only the moved joints take the new angle, so small drifts add up until they exceed tolerance
+        self.angles[moved] = new[moved]
+        # links are sorted by depth, so the first moved link of a chain is the highest one
+        first = {}
+        for i in moved.tolist():
+            first.setdefault(self.link_chain[i], self.link_depth[i])
+        computed = sum(len(self.chain_links[chain]) - depth for chain, depth in first.items())
+        if computed > len(self.levels):
+            # walking the chains takes one matmul per link, composing all links one per level
+            self.local_transforms()
+            self._compose()
+            return len(self.names)
+
+        weights = np.empty((len(moved), 1, 3))
+        weights[:, 0, 0] = 1.0
+        weights[:, 0, 1] = np.sin(new[moved])
+        weights[:, 0, 2] = 1.0 - np.cos(new[moved])
+        self.local[moved] = np.matmul(weights, self.basis[moved]).reshape(-1, 4, 4)
+        # recompute the suffix of each chain below its first moved joint on the cached prefix
+        T = self.transform_views
+        local = self.local_views
+        for chain, depth in first.items():
+            links = self.chain_links[chain]
+            if depth == 0:
+                T[links[0]][...] = local[links[0]]
+                depth = 1
+            for k in range(depth, len(links)):
+                np.matmul(T[links[k - 1]], local[links[k]], out=T[links[k]])
+        return computed
+
+    def link_angles(self, joint_angles):
+        '''return the link angles (N, n_links) of joint angles (N, n_joints) in JOINT_NAMES order'''
+        joint_angles = np.asarray(joint_angles, dtype=float)
+        angles = np.zeros((len(joint_angles), len(self.names)))
+        angles[:, self.perceived] = joint_angles[:, self.joint_indices]
+        return angles
+
+    def forward_batch(self, joint_angles, out=None, chunk_size=1024):
+        '''compute the transforms (N, n_links, 4, 4) of joint angles (N, n_joints) in JOINT_NAMES order,
+        into out if given. The work is done in chunks, which stay in the cache.
+        '''
+        joint_angles = np.asarray(joint_angles, dtype=float)
+        if out is None:
+            out = np.empty((len(joint_angles), len(self.names), 4, 4))
+        for start in range(0, len(joint_angles), chunk_size):
+            self._forward_chunk(joint_angles[start:start + chunk_size], out[start:start + chunk_size])
+        return out
+
+    def _forward_chunk(self, joint_angles, out):
+        angles = self.link_angles(joint_angles)
+        weights = np.empty(angles.shape + (1, 3))
+        weights[..., 0, 0] = 1.0
+        np.sin(angles, out=weights[..., 0, 1])
+        np.cos(angles, out=weights[..., 0, 2])
+        np.subtract(1.0, weights[..., 0, 2], out=weights[..., 0, 2])
+        local = np.matmul(weights, self.basis).reshape(out.shape)
+        for start, end, parents in self.levels:
+            if parents is None:
+                out[:, start:end] = local[:, start:end]
+            else:
+                np.matmul(out[:, parents], local[:, start:end], out=out[:, start:end])
+
+    def iter_forward(self, joint_angles, chunk_size=1024):
+        '''yield the transforms of joint angles in chunks of chunk_size configurations.
+        joint_angles is an (N, n_joints) array (also memory-mapped) or an iterable of
+        angle vectors, e.g. perception.joint_angles of a log. The yielded array is
+        reused for the next chunk, so memory stays bounded however long the log is.
+        '''
+        buffer = np.empty((chunk_size, len(self.names), 4, 4))
+        if isinstance(joint_angles, np.ndarray):
+            for start in range(0, len(joint_angles), chunk_size):
+                chunk = joint_angles[start:start + chunk_size]
+                yield self.forward_batch(chunk, buffer[:len(chunk)], chunk_size)
+            return
+        chunk = []
+        for angles in joint_angles:
+            chunk.append(angles)
+            if len(chunk) == chunk_size:
+                yield self.forward_batch(chunk, buffer, chunk_size)
+                chunk = []
+        if chunk:
+            yield self.forward_batch(chunk, buffer[:len(chunk)], chunk_size)
+
+    def local_transform(self, name, angle):
+        '''return the local transform (4, 4) of link name at angle'''
+        i = self.index[name]
+        K = self.K[i]
+        T = np.identity(4)
+        T[:3, :3] += np.sin(angle) * K + (1.0 - np.cos(angle)) * self.K2[i]
+        T[:3, 3] = self.offsets[i]
+        return T
+
+
+def batch_forward_kinematics(joint_angles, tree=None):
+    '''return the transforms (N, n_links, 4, 4) of joint angles (N, n_joints) in JOINT_NAMES order'''
+    return (tree or KinematicTree()).forward_batch(joint_angles)
+
+
+def iter_forward_kinematics(joint_angles, chunk_size=1024, tree=None):
+    '''yield the transforms of joint angles in chunks, see KinematicTree.iter_forward'''
+    return (tree or KinematicTree()).iter_forward(joint_angles, chunk_size)
+
+
+if __name__ == '__main__':
+    from timeit import repeat
+    sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'joint_control'))
+    from motion_library import MotionLibrary, MOTIONS
+    from spark_agent import N_JOINTS
+
+    tree = KinematicTree()
+    # every link starts at the identity, forward_incremental overwrites them all on its first call
+    assert all(np.array_equal(T, np.identity(4)) for T in tree.transforms.values())
+    tree.forward_incremental(np.zeros(N_JOINTS))
+    assert np.array_equal(tree.transforms_array, KinematicTree().forward(np.zeros(N_JOINTS)))
+    library = MotionLibrary()
+    for name in MOTIONS:
+        motion = library[name]
+        t = np.arange(motion.t_min, motion.t_max, 0.001)
+        joint_angles = np.zeros((len(t), N_JOINTS))
+        joint_angles[:, motion.joint_indices] = motion.evaluate(t)[:, motion.known]
+        T = batch_forward_kinematics(joint_angles, tree)
+        # the same in chunks, from a stream of rows and one configuration at a time
+        chunked = np.concatenate([c.copy() for c in tree.iter_forward(joint_angles, 500)])
+        streamed = np.concatenate([c.copy() for c in tree.iter_forward(iter(joint_angles), 333)])
+        single = np.array([tree.forward(angles).copy() for angles in joint_angles[::50]])
+        assert np.array_equal(T, chunked) and np.array_equal(T, streamed)
+        assert np.abs(T[::50] - single).max() < 1e-12, name
+        feet = T[:, [tree.index['LFoot'], tree.index['RFoot']], 2, 3]
+        hand = T[:, tree.index['RArmEffector'], :3, 3]
+        print('%-20s %6d configurations, foot height difference %.3f..%.3f m, right hand path %.3f m' % (
+            name, len(t), (feet[:, 0] - feet[:, 1]).min(), (feet[:, 0] - feet[:, 1]).max(),
+            np.linalg.norm(np.diff(hand, axis=0), axis=1).sum()))
+
+    joint_angles = np.random.RandomState(0).uniform(-1, 1, (100000, N_JOINTS))
+    print('%d configurations [ms]: batched %.1f, chunks of 1024 %.1f, one at a time %.1f (extrapolated)' % (
+        len(joint_angles),
+        min(repeat(lambda: tree.forward_batch(joint_angles), number=1, repeat=3)) * 1e3,
+        min(repeat(lambda: sum(1 for _ in tree.iter_forward(joint_angles)), number=1, repeat=3)) * 1e3,
+        min(repeat(lambda: [tree.forward(a) for a in joint_angles[:1000]], number=1, repeat=3)) * 1e5))
@@ -0,0 +1,233 @@
+'''Closed-form inverse kinematics of the NAO legs, for batches of targets
+
+The legs of kinematic_tree.py are
+
+    T = Trans(0, +-HIP_OFFSET_Y, -HIP_OFFSET_Z) Rz(q0) Rx(q1) Ry(q2) Trans(0, 0, -THIGH_LENGTH)
+        Ry(q3) Trans(0, 0, -TIBIA_LENGTH) Ry(q4) Rx(q5) Trans(0, 0, -FOOT_HEIGHT)
+
+Without the fixed offsets at both ends, the target gives the ankle pose
+(R, a) relative to the hip. The hip seen from the ankle is p = -R^T a,
+which only depends on the knee and the ankle:
+
+    q5 = atan2(p_y, p_z)                                  ankle roll
+    cos q3 = (|p|^2 - L1^2 - L2^2) / (2 L1 L2)            knee
+    q4 = angle(w) - angle(v)                              ankle pitch
+
+with angle(u) = atan2(u_x, u_z), v = (p_x, 0, |(p_y, p_z)|) and
+w = (-L1 sin q3, 0, L1 cos q3 + L2). The remaining hip rotation
+H = R Rx(-q5) Ry(-(q3 + q4)) = Rz(q0) Rx(q1) Ry(q2) gives
+
+    q1 = asin(H21), q2 = atan2(-H20, H22), q0 = atan2(-H01, H11)
+
+No matrix is inverted. All targets of a batch (N, 4, 4) are solved at
+once with ufuncs writing into work buffers of the solver, so solving the
+same number of targets again allocates nothing. solve_one() evaluates the
+same formulas with scalar math for the single targets of a control loop:
+
+    ik = LegIK('LLeg')
+    angles, reachable = ik.solve(targets)       # (N, 6), (N,)
+    angles, reachable = ik.solve_one(target)    # 6 angles, bool
+
+A target is reachable if the knee can bend to its distance and all
+angles are within LEG_JOINT_LIMITS. For the others, the leg is stretched
+or folded towards the target.
+
+usage: python leg_ik.py [n]
+round trip of n random leg configurations through FK and IK
+'''
+from math import acos, asin, atan2, cos, hypot, sin
+
+import numpy as np
+
+from kinematic_tree import HIP_OFFSET_Y, HIP_OFFSET_Z, THIGH_LENGTH, TIBIA_LENGTH, FOOT_HEIGHT
+from spark_agent import JOINT_LIMITS
+
+LEG_JOINTS = {
+    'LLeg': ['LHipYawPitch', 'LHipRoll', 'LHipPitch', 'LKneePitch', 'LAnklePitch', 'LAnkleRoll'],
+    'RLeg': ['RHipYawPitch', 'RHipRoll', 'RHipPitch', 'RKneePitch', 'RAnklePitch', 'RAnkleRoll'],
+}
+
+# rad, the rows follow LEG_JOINTS
+LEG_JOINT_LIMITS = {leg: np.array([JOINT_LIMITS[name] for name in names])
+                    for leg, names in LEG_JOINTS.items()}
+
+
+class LegIK(object):
+    def __init__(self, leg='LLeg', capacity=1):
+        if leg not in LEG_JOINTS:
+            raise ValueError('no inverse kinematics for %r, only for %s' % (leg, ', '.join(LEG_JOINTS)))
+        self.leg = leg
+        self.joint_names = LEG_JOINTS[leg]
+        self.limits = LEG_JOINT_LIMITS[leg]
+        self.hip = np.array([0.0, (1 if leg == 'LLeg' else -1) * HIP_OFFSET_Y, -HIP_OFFSET_Z])
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.q = np.empty((6, capacity))  # angles row by row, solve() returns the transposed view
+        self.ankle = np.empty((capacity, 1, 3))
+        self.hip_from_ankle = np.empty((capacity, 1, 3))
+        self.angle = np.empty((2, capacity))  # q5, q3 + q4
+        self.cos = np.empty((2, capacity))
+        self.sin = np.empty((2, capacity))
+        self.M = np.zeros((capacity, 3, 2))  # columns (0, c5, -s5) and (0, s5, c5)
+        self.RM = np.empty((capacity, 3, 2))
+        self.work = np.empty((6, capacity))
+        self.reachable = np.empty(capacity, dtype=bool)
+        self.flags = np.empty((6, capacity), dtype=bool)
+        self.flag = np.empty(capacity, dtype=bool)
+
+    def solve(self, targets):
+        '''return the angles (N, 6) in self.joint_names order and the reachability (N,) of the
+        foot transforms targets (N, 4, 4) in torso coordinates. Both are views of buffers which
+        are overwritten by the next call.
+        '''
+        targets = np.asarray(targets, dtype=float)
+        n = len(targets)
+        if n > self.capacity:
+            self._allocate(n)
+        R = targets[:, :3, :3]
+        q = self.q[:, :n]
+        d2, t, u, h, H20, H22 = self.work[:, :n]
+        L1, L2 = THIGH_LENGTH, TIBIA_LENGTH
+
+        # ankle relative to the hip a = position + FOOT_HEIGHT R e_z - hip, and the hip seen
+        # from the ankle p = -R^T a, computed as -a R
+        a = self.ankle[:n]
+        np.multiply(targets[:, np.newaxis, :3, 2], FOOT_HEIGHT, out=a)
+        a += targets[:, np.newaxis, :3, 3]
+        a -= self.hip
+        P = self.hip_from_ankle[:n]
+        np.matmul(a, R, out=P)
+        np.negative(P, out=P)
+        p = P[:, 0, :]
+
+        np.arctan2(p[:, 1], p[:, 2], out=q[5])
+
+        # knee from the distance of hip and ankle
+        np.einsum('ij,ij->i', p, p, out=d2)
+        c3 = d2
+        c3 -= L1 * L1 + L2 * L2
+        c3 /= 2 * L1 * L2
+        reachable = self.reachable[:n]
+        np.abs(c3, out=t)
+        np.less_equal(t, 1.0, out=reachable)
+        np.clip(c3, -1.0, 1.0, out=c3)
+        np.arccos(c3, out=q[3])
+
+        # ankle pitch = angle(w) - angle(v)
+        np.hypot(p[:, 1], p[:, 2], out=t)
+        np.arctan2(p[:, 0], t, out=h)
+        np.sin(q[3], out=u)
+        u *= -L1
+        c3 *= L1
+        c3 += L2
+        np.arctan2(u, c3, out=q[4])
+        q[4] -= h
+
+        # hip from H = R Rx(-q5) Ry(-(q3 + q4)), with R (0, c5, -s5) = (H01, H11, H21) and
+        # R2 (0, s5, c5) = u: H20 = R20 cos(q3 + q4) + u sin(q3 + q4), H22 = u cos - R20 sin
+        angle, cos, sin = self.angle[:, :n], self.cos[:, :n], self.sin[:, :n]
+        angle[0] = q[5]
+        np.add(q[3], q[4], out=angle[1])
+        np.cos(angle, out=cos)
+        np.sin(angle, out=sin)
+        M = self.M[:n]
+        M[:, 1, 0] = cos[0]
+        np.negative(sin[0], out=M[:, 2, 0])
+        M[:, 1, 1] = sin[0]
+        M[:, 2, 1] = cos[0]
+        RM = self.RM[:n]
+        np.matmul(R, M, out=RM)
+        np.clip(RM[:, 2, 0], -1.0, 1.0, out=t)
+        np.arcsin(t, out=q[1])
+        np.negative(RM[:, 0, 0], out=t)
+        np.arctan2(t, RM[:, 1, 0], out=q[0])
+        u = RM[:, 2, 1]
+        np.multiply(R[:, 2, 0], cos[1], out=H20)
+        np.multiply(u, sin[1], out=t)
+        H20 += t
+        np.negative(H20, out=H20)
+        np.multiply(u, cos[1], out=H22)
+        np.multiply(R[:, 2, 0], sin[1], out=t)
+        H22 -= t
+        np.arctan2(H20, H22, out=q[2])
+
+        flags, flag = self.flags[:, :n], self.flag[:n]
+        np.greater_equal(q, self.limits[:, 0, np.newaxis], out=flags)
+        np.logical_and.reduce(flags, axis=0, out=flag)
+        reachable &= flag
+        np.less_equal(q, self.limits[:, 1, np.newaxis], out=flags)
+        np.logical_and.reduce(flags, axis=0, out=flag)
+        reachable &= flag
+        return q.T, reachable
+
+    def solve_one(self, target):
+        '''return the angles (list of 6) and reachability of one foot transform target (4, 4),
+        like solve() but with scalar math, which is faster for a single target
+        '''
+        (r00, r01, r02, x), (r10, r11, r12, y), (r20, r21, r22, z) = np.asarray(target, dtype=float)[:3].tolist()
+        L1, L2 = THIGH_LENGTH, TIBIA_LENGTH
+        hx, hy, hz = self.hip.tolist()
+        ax = x + FOOT_HEIGHT * r02 - hx
+        ay = y + FOOT_HEIGHT * r12 - hy
+        az = z + FOOT_HEIGHT * r22 - hz
+        px = -(r00 * ax + r10 * ay + r20 * az)
+        py = -(r01 * ax + r11 * ay + r21 * az)
+        pz = -(r02 * ax + r12 * ay + r22 * az)
+        q5 = atan2(py, pz)
+        c3 = (px * px + py * py + pz * pz - L1 * L1 - L2 * L2) / (2 * L1 * L2)
+        reachable = abs(c3) <= 1.0
+        c3 = min(max(c3, -1.0), 1.0)
+        q3 = acos(c3)
+        q4 = atan2(-L1 * sin(q3), L1 * c3 + L2) - atan2(px, hypot(py, pz))
+        c5, s5 = cos(q5), sin(q5)
+        ce, se = cos(q3 + q4), sin(q3 + q4)
+        q1 = asin(min(max(r21 * c5 - r22 * s5, -1.0), 1.0))
+        q0 = atan2(r02 * s5 - r01 * c5, r11 * c5 - r12 * s5)
+        u = r21 * s5 + r22 * c5
+        q2 = atan2(-(r20 * ce + u * se), u * ce - r20 * se)
+        angles = [q0, q1, q2, q3, q4, q5]
+        reachable = reachable and all(lo <= angle <= hi for angle, (lo, hi) in zip(angles, self.limits.tolist()))
+        return angles, reachable
+
+if __name__ == '__main__':
+    import sys
+    from timeit import repeat
+    from kinematic_tree import KinematicTree
+    from spark_agent import JOINT_INDEX, N_JOINTS
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tree = KinematicTree()
+    rng = np.random.RandomState(0)
+    for leg, names in LEG_JOINTS.items():
+        ik = LegIK(leg)
+        limits = LEG_JOINT_LIMITS[leg]
+        angles = rng.uniform(limits[:, 0], limits[:, 1], (n, 6))
+        angles[:, 3] = np.abs(angles[:, 3])  # the solver bends the knee forwards
+        joint_angles = np.zeros((n, N_JOINTS))
+        joint_angles[:, [JOINT_INDEX[name] for name in names]] = angles
+        foot = tree.index[leg[0] + 'Foot']
+        targets = tree.forward_batch(joint_angles)[:, foot].copy()
+
+        solved, reachable = ik.solve(targets)
+        solved, reachable = solved.copy(), reachable.copy()
+        joint_angles[:, [JOINT_INDEX[name] for name in names]] = solved
+        reached = tree.forward_batch(joint_angles)[:, foot]
+        error = np.abs(reached - targets).max(axis=(1, 2))
+        print('%s: %d of %d configurations reachable, round trip error %.1e, angle error %.1e' % (
+            leg, reachable.sum(), n, error[reachable].max(),
+            np.abs(solved - angles)[reachable].max()))
+        assert error[reachable].max() < 1e-9
+        # out of reach: flagged and the leg stretched towards the target
+        far = targets[0].copy()
+        far[2, 3] -= 0.2
+        assert not ik.solve_one(far)[1] and not ik.solve(far[np.newaxis])[1][0]
+        for target, expected, flag in zip(targets[:1000], solved, reachable):
+            angles, one_reachable = ik.solve_one(target)
+            assert np.abs(np.array(angles) - expected).max() < 1e-12 and one_reachable == flag
+
+        one = targets[0]
+        print('  one target %.1f us, %d targets %.1f ms' % (
+            min(repeat(lambda: ik.solve_one(one), number=2000, repeat=5)) / 2000 * 1e6, n,
+            min(repeat(lambda: ik.solve(targets), number=1, repeat=3)) * 1e3))
@@ -0,0 +1,42 @@
+'''Sense-think-act cycles per second of the agents against fake_simspark,
+followed by the stage timing of AngleInterpolationAgent
+
+usage: python agent_benchmark.py [cycles]
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'joint_control'))
+
+from fake_simspark import cycles_per_second, STEP
+from spark_agent import SparkAgent
+from pid import PIDAgent
+from angle_interpolation import AngleInterpolationAgent
+from keyframes import hello
+
+
+def pid_agent(**kwargs):
+    agent = PIDAgent(**kwargs)
+    agent.target_joints['HeadYaw'] = 0.5
+    return agent
+
+
+def hello_agent(**kwargs):
+    agent = AngleInterpolationAgent(**kwargs)
+    agent.keyframes = hello()
+    return agent
+
+
+if __name__ == '__main__':
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for name, factory in (('SparkAgent', SparkAgent),
+                          ('PIDAgent', pid_agent),
+                          ('AngleInterpolationAgent', hello_agent)):
+        agent, rate = cycles_per_second(factory, cycles)
+        print('%-24s %7.0f cycles/s (%.1fx real time)' % (name, rate, rate * STEP))
+
+    def timed_hello_agent(**kwargs):
+        agent = hello_agent(**kwargs)
+        agent.enable_timing()
+        return agent
+    agent, _ = cycles_per_second(timed_hello_agent, cycles)
+    print(agent.timer.report())
@@ -0,0 +1,92 @@
+'''Microbenchmark of the command encoding, Action.to_commands + send_command
+against CommandEncoder
+
+usage: python command_benchmark.py [cycles]
+
+The actions follow a PID-like trajectory: every joint gets a speed each
+cycle, most of them settle after a while, stiffness is set once.
+'''
+
+import struct
+import sys
+from timeit import repeat
+
+import numpy as np
+
+from sexpr import bytes2sexpr
+from spark_agent import Action, CommandEncoder, JOINT_NAMES, N_JOINTS
+
+
+def make_actions(cycles=500, seed=0):
+    '''return actions with dict fields, as the agents used to build them'''
+    rng = np.random.RandomState(seed)
+    settle = rng.randint(20, cycles, N_JOINTS)
+    amplitude = rng.uniform(0.1, 2.0, N_JOINTS)
+    actions = []
+    for t in range(cycles):
+        speed = amplitude * np.exp(-5.0 * t / settle) * np.cos(0.1 * t)
+        action = Action()
+        action.speed = dict(zip(JOINT_NAMES, speed))
+        if t == 0:
+            action.stiffness = {name: 1.0 for name in JOINT_NAMES}
+        actions.append(action)
+    return actions
+
+
+def encode_strings(actions):
+    '''the encoding done by SparkAgent.act before CommandEncoder'''
+    messages = []
+    for action in actions:
+        commands = action.to_commands() + '(syn)'
+        messages.append(struct.pack(b"!I", len(commands)) + bytes(commands, encoding='utf8'))
+    return messages
+
+
+def encode_buffer(actions, encoder=None):
+    encoder = CommandEncoder() if encoder is None else encoder
+    return [bytes(encoder.encode_action(action)) for action in actions]
+
+
+def check(actions):
+    '''the server ends up with the same value for every effector'''
+    old = {}
+    new = {}
+    for state, messages in ((old, encode_strings(actions)), (new, encode_buffer(actions))):
+        for msg in messages:
+            assert struct.unpack('!I', msg[:4])[0] == len(msg) - 4
+            for cmd in bytes2sexpr(msg[4:]):
+                state[cmd[0]] = round(float(cmd[1]), 2) if len(cmd) > 1 else None
+    assert old == new, 'encoders disagree'
+
+
+def benchmark(actions, number=5):
+    '''return (seconds per message, bytes per message) of the string and buffer encoding'''
+    vectors = [Action() for _ in actions]
+    for a, v in zip(actions, vectors):
+        v.speed, v.stiffness = a.to_vectors()
+    encoder = CommandEncoder()
+
+    def run_strings():
+        encode_strings(actions)
+
+    def run_buffer():
+        encoder.reset()
+        for action in vectors:
+            encoder.encode_action(action)
+
+    n = number * len(actions)
+    sizes = (np.mean([len(m) for m in encode_strings(actions)]),
+             np.mean([len(m) for m in encode_buffer(vectors)]))
+    times = (min(repeat(run_strings, number=number, repeat=5)) / n,
+             min(repeat(run_buffer, number=number, repeat=5)) / n)
+    return times, sizes
+
+
+if __name__ == '__main__':
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    actions = make_actions(cycles)
+    check(actions)
+    (t_str, t_buf), (b_str, b_buf) = benchmark(actions)
+    print('to_commands + send_command: %6.1f us/message %6.1f bytes/message' % (t_str * 1e6, b_str))
+    print('CommandEncoder:             %6.1f us/message %6.1f bytes/message' % (t_buf * 1e6, b_buf))
+    print('speedup: %.1fx, bytes: %.1fx less' % (t_str / t_buf, b_str / b_buf))
@@ -0,0 +1,127 @@
+'''Per-stage timing of the sense-think-act loop
+
+SparkAgent.enable_timing() installs a CycleTimer. The loop then records
+the duration of recv, decode, think and act, and their sum without recv
+as 'cycle', which is checked against the deadline. Subclasses time their
+own sections with
+
+    with self.timed('pid'):
+        ...
+
+which costs one attribute lookup and an empty context manager while
+timing is disabled. Durations are kept in fixed-size ring buffers of
+perf_counter_ns values, so only the last `size` cycles are reported.
+
+Sections which skip work report how much with counters, which are
+summed over the whole run:
+
+    self.count('fk_links_skipped', n)
+'''
+from array import array
+from time import perf_counter_ns
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class _NullSection(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SECTION = _NullSection()
+
+
+class _Section(object):
+    '''one instance per name, a stack of start times makes nested and reentrant sections work'''
+    __slots__ = ('timer', 'name', 'starts')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.starts = []
+
+    def __enter__(self):
+        self.starts.append(perf_counter_ns())
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, perf_counter_ns() - self.starts.pop())
+        return False
+
+
+class CycleTimer(object):
+    def __init__(self, size=1024, deadline=0.02):
+        self.size = size
+        self.deadline_ns = int(deadline * 1e9)
+        self.rings = {}  # stage -> durations in ns
+        self.counts = {}  # stage -> number of recorded durations
+        self.sections = {}
+        self.counters = {}  # name -> total
+        self.cycles = 0
+        self.misses = 0
+        self.recv = 0  # ns waited for the frame of the current cycle, set by SparkAgent.sense
+
+    def add(self, name, ns):
+        ring = self.rings.get(name)
+        if ring is None:
+            ring = self.rings[name] = array('q', bytes(8 * self.size))
+            self.counts[name] = 0
+        n = self.counts[name]
+        ring[n % self.size] = ns
+        self.counts[name] = n + 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def cycle(self, recv, decode, think, act):
+        '''record the stages of one sense-think-act cycle'''
+        self.add('recv', recv)
+        self.add('decode', decode)
+        self.add('think', think)
+        self.add('act', act)
+        total = decode + think + act
+        self.add('cycle', total)
+        self.cycles += 1
+        if total > self.deadline_ns:
+            self.misses += 1
+
+    def section(self, name):
+        '''return a context manager which records its duration as stage name,
+        sections of the same name may be nested
+        '''
+        section = self.sections.get(name)
+        if section is None:
+            section = self.sections[name] = _Section(self, name)
+        return section
+
+    def durations(self, name):
+        '''return the recorded durations of stage name in seconds'''
+        n = min(self.counts.get(name, 0), self.size)
+        if not n:
+            return np.zeros(0)
+        return np.frombuffer(self.rings[name], dtype=np.int64)[:n] * 1e-9
+
+    def stats(self):
+        '''return {stage: (count, p50, p95, p99, max)} with durations in seconds'''
+        stats = {}
+        for name in self.rings:
+            d = self.durations(name)
+            stats[name] = (self.counts[name],) + tuple(np.percentile(d, PERCENTILES)) + (d.max(),)
+        return stats
+
+    def report(self):
+        lines = ['%-20s %8s %8s %8s %8s %8s' % ('stage [ms]', 'count', 'p50', 'p95', 'p99', 'max')]
+        for name, (count, p50, p95, p99, dmax) in self.stats().items():
+            lines.append('%-20s %8d %8.3f %8.3f %8.3f %8.3f' % (name, count, p50 * 1e3, p95 * 1e3, p99 * 1e3, dmax * 1e3))
+        for name, total in self.counters.items():
+            lines.append('%-20s %8d (%.1f per cycle)' % (name, total, total / max(self.cycles, 1)))
+        lines.append('deadline %.1fms missed in %d of %d cycles'
+                     % (self.deadline_ns * 1e-6, self.misses, self.cycles))
+        return '\n'.join(lines)
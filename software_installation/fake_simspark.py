@@ -0,0 +1,226 @@
+'''Pure-Python stand-in for the SimSpark server to run and benchmark agents offline
+
+It speaks the same length prefixed protocol in lock step like the sync
+mode of SimSpark: every message from an agent is answered with one
+perceptor message (time, GS, GYR, ACC, HJ, GPS, FRP and the camera
+blocks on every third cycle). Players get their number from the init
+command. Joint speed commands are clipped to MAX_JOINT_SPEED and
+integrated per 20ms step within the NAO joint limits, like the hinge
+effectors they keep their speed until the next command. There are no
+dynamics, the robot hangs in the air. Sensor noise comes from a seeded generator per player,
+so runs are deterministic.
+
+time_scale=0 steps as fast as the agents answer, time_scale=1 paces the
+cycles in real time. The connections are closed after `cycles` perceptor
+messages so that the agents' run() returns.
+
+usage: python fake_simspark.py [port] [cycles] [time_scale]
+'''
+import random
+import selectors
+import socket
+import sys
+import time
+from math import pi
+from threading import Thread
+
+from sexpr import bytes2sexpr
+from spark_agent import JOINT_SENSOR_NAMES, JOINT_CMD_NAMES, INVERSED_JOINTS, JOINT_LIMITS
+from spark_socket import FrameReader, HEADER
+
+SIMSPARK_PORT = 3100
+STEP = 0.02
+VISION_CYCLES = 3
+RAD_TO_DEG = 180 / pi
+MAX_JOINT_SPEED = 7.0  # rad/s
+
+# effector name -> (hinge name, min, max) with the limits in degrees in simspark direction
+HINGES = {}
+for _sensor, _joint in JOINT_SENSOR_NAMES.items():
+    _lo, _hi = (limit * RAD_TO_DEG for limit in JOINT_LIMITS[_joint])
+    if _joint in INVERSED_JOINTS:
+        _lo, _hi = -_hi, -_lo
+    HINGES[JOINT_CMD_NAMES[_joint]] = (_sensor, _lo, _hi)
+
+LANDMARKS = ['F1L', 'F2L', 'F1R', 'F2R', 'G1L', 'G2L', 'G1R', 'G2R']
+
+
+class FakePlayer(object):
+    '''state of one connection'''
+    def __init__(self, sock, seed=0):
+        self.socket = sock
+        self.reader = FrameReader(sock)
+        self.random = random.Random(seed)
+        self.unum = 0
+        self.team = 'left'
+        self.cycle = 0
+        self.position = (-self.random.uniform(1, 10), self.random.uniform(-6, 6))
+        self.joint_degrees = dict.fromkeys(JOINT_SENSOR_NAMES, 0.0)
+        self.joint_speeds = dict.fromkeys(JOINT_SENSOR_NAMES, 0.0)  # rad/s
+
+    def step(self):
+        '''integrate the joint speeds over one cycle'''
+        degrees = self.joint_degrees
+        for hinge, lo, hi in HINGES.values():
+            speed = self.joint_speeds[hinge]
+            if speed:
+                speed = min(MAX_JOINT_SPEED, max(-MAX_JOINT_SPEED, speed))
+                degrees[hinge] = min(hi, max(lo, degrees[hinge] + speed * STEP * RAD_TO_DEG))
+        self.cycle += 1
+
+
+def _pol(rng):
+    return '(pol %.2f %.2f %.2f)' % (rng.uniform(1, 20), rng.uniform(-60, 60), rng.uniform(-40, 5))
+
+
+def _vision(rng):
+    see = [' (%s %s)' % (name, _pol(rng)) for name in rng.sample(LANDMARKS, 4)]
+    see.append(' (B %s)' % _pol(rng))
+    for _ in range(2):
+        see.append(' (P (team Opponent) (id %d) (head %s) (rlowerarm %s) (llowerarm %s) (rfoot %s) (lfoot %s))'
+                   % ((rng.randint(1, 11),) + tuple(_pol(rng) for _ in range(5))))
+    for _ in range(4):
+        see.append(' (L %s %s)' % (_pol(rng), _pol(rng)))
+    return ''.join(see)
+
+
+class FakeSimSpark(object):
+    def __init__(self, host='localhost', port=0, cycles=1000, time_scale=0, seed=0):
+        self.cycles = cycles
+        self.time_scale = time_scale
+        self.seed = seed
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.players = {}
+        self.thread = None
+        self._next_unum = 1
+        self._start_time = None
+
+    def perceptors(self, player):
+        '''return the perceptor message of player'''
+        rng = player.random
+        t = player.cycle * STEP
+        msg = ['(time (now %.2f))(GS (unum %d) (team %s) (t %.2f) (pm BeforeKickOff))'
+               % (t, player.unum, player.team, t),
+               '(GYR (n torso) (rt %.2f %.2f %.2f))' % tuple(rng.gauss(0, 0.5) for _ in range(3)),
+               '(ACC (n torso) (a %.2f %.2f %.2f))'
+               % (rng.gauss(0, 0.1), rng.gauss(0, 0.1), 9.81 + rng.gauss(0, 0.05))]
+        if player.cycle % VISION_CYCLES == 0:
+            msg.append('(TopCamera (mypos %.2f %.2f 0.38) (ballpos 0.00 0.00 0.04)%s)(BottomCamera%s)'
+                       % (player.position + (_vision(rng), _vision(rng))))
+        msg.extend(['(HJ (n %s) (ax %.2f) (tp %.2f))' % (hinge, ax, 30 + 0.01 * player.cycle)
+                    for hinge, ax in player.joint_degrees.items()])
+        msg.append('(GPS (n torso) (tf 1.00 0.00 0.00 %.2f 0.00 1.00 0.00 %.2f 0.00 0.00 1.00 0.36 '
+                   '0.00 0.00 0.00 1.00))' % player.position)
+        for foot in ('lf', 'rf'):
+            msg.append('(FRP (n %s) (c %.2f %.2f -0.02) (f %.2f %.2f %.2f))'
+                       % (foot, rng.gauss(0, 0.02), rng.gauss(0, 0.02),
+                          rng.gauss(0, 1), rng.gauss(0, 1), 22.5 + rng.gauss(0, 1)))
+        return ''.join(msg).encode()
+
+    def command(self, player, commands):
+        '''handle one message of an agent'''
+        for cmd in bytes2sexpr(commands):
+            if not cmd:
+                continue
+            name = cmd[0]
+            if name in HINGES and len(cmd) > 1:
+                player.joint_speeds[HINGES[name][0]] = float(cmd[1])
+            elif name == 'init':
+                for arg in cmd[1:]:
+                    if arg[0] == 'unum':
+                        player.unum = int(arg[1])
+                    elif arg[0] == 'teamname':
+                        player.team = arg[1]
+                if player.unum == 0:
+                    player.unum = self._next_unum
+                self._next_unum = max(self._next_unum, player.unum + 1)
+
+    def _send(self, player):
+        if player.cycle >= self.cycles:
+            self._close(player)
+            return
+        if self.time_scale:
+            delay = self._start_time + player.cycle * STEP * self.time_scale - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        msg = self.perceptors(player)
+        try:
+            player.socket.sendall(HEADER.pack(len(msg)) + msg)
+        except OSError:
+            # the agent is gone (BrokenPipeError, ConnectionResetError), end its session only
+            self._close(player)
+            return
+        player.step()
+
+    def _close(self, player):
+        self.selector.unregister(player.socket)
+        player.socket.close()
+        del self.players[player.socket]
+
+    def poll(self, timeout=None):
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                sock, _ = self.listener.accept()
+                player = FakePlayer(sock, self.seed + len(self.players))
+                self.players[sock] = player
+                self.selector.register(sock, selectors.EVENT_READ, player)
+                if self._start_time is None:
+                    self._start_time = time.perf_counter()
+                continue
+            player = key.data
+            try:
+                player.reader.fill()
+            except (EOFError, ConnectionError):
+                self._close(player)
+                continue
+            frame = player.reader.next_frame()
+            while frame is not None and player.socket in self.players:
+                self.command(player, frame)
+                self._send(player)
+                frame = player.reader.next_frame()
+
+    def serve_forever(self):
+        while True:
+            self.poll()
+
+    def start(self):
+        '''serve in a daemon thread'''
+        if self.thread is None:
+            self.thread = Thread(target=self.serve_forever)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+
+def cycles_per_second(agent_class, cycles=500, **kwargs):
+    '''run agent_class against a fresh FakeSimSpark, return (agent, sense-think-act cycles per second)
+
+    The server runs in a thread of the same process, so the result
+    includes its share of the work.
+    '''
+    server = FakeSimSpark(cycles=cycles).start()
+    agent = agent_class(simspark_port=server.port, **kwargs)
+    start = time.perf_counter()
+    n = 0
+    try:
+        while True:
+            agent.sense_think_act()
+            n += 1
+    except EOFError:
+        pass
+    return agent, n / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else SIMSPARK_PORT
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    time_scale = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = FakeSimSpark(port=port, cycles=cycles, time_scale=time_scale)
+    print('fake simspark on port %d' % server.port)
+    server.serve_forever()
@@ -4,6 +4,10 @@
 ##
 ##  * public domain *
 ##
+import json
+import json.scanner
+import re
+
 try:
     import future
 except:
@@ -229,6 +233,81 @@ def str2sexpr_strict(s):
     return _SExprStrConverter.results
 
 
+##  bytes2sexpr
+##
+##  Fast reader for SimSpark messages. A message made of parentheses and
+##  single-space separated symbols is rewritten into a JSON array with a few
+##  bytes.replace calls and handed to the C scanner of the json module, so
+##  no symbol is assembled character by character. Anything else ("quoted"
+##  symbols, \ escapes, ; comments, other whitespace, unbalanced
+##  parentheses) goes through a regex tokenizer which still works on whole
+##  tokens.
+##
+# separators, comments and escapes like SExprReader: only ' ', '\t' and '\n'
+# separate, a backslash takes the next byte literally (a trailing one is
+# dropped) and an unterminated quote runs to the end of the message
+_TOKEN = re.compile(rb'[ \t\n]*(?:;[^\n]*|([()])|"((?:[^"\\]|\\[\s\S]|\\)*)"?'
+                    rb'|((?:[^ \t\n()";\\]|\\[\s\S]|\\)+))')
+_ESCAPE = re.compile(rb'\\([\s\S]?)')
+_SLOW_PATH_CHARS = (b';', b'\\', b'"', b'\t', b'\n', b'\r')
+_json_scan = json.scanner.make_scanner(json.JSONDecoder())
+
+
+def _tokens2sexpr(s):
+    results = build = []
+    stack = []
+    for paren, quoted, sym in _TOKEN.findall(s):
+        if paren:
+            if paren == b'(':
+                stack.append(build)
+                build.append([])
+                build = build[-1]
+            elif stack:
+                build = stack.pop()
+            continue
+        sym = sym or quoted
+        if b'\\' in sym:
+            sym = _ESCAPE.sub(rb'\1', sym)
+        if sym:
+            build.append(sym.decode())
+    if stack:
+        # like str2sexpr, an unclosed list is dropped
+        del stack[0][-1]
+    return results
+
+
+def bytes2sexpr(s):
+    """parse a SimSpark message as a sexpr.
+
+    `s` can be bytes, bytearray, memoryview or str; symbols are returned
+    as str, the result has the same shape as str2sexpr(s.decode()).
+    Unbalanced close parentheses are ignored and an unclosed list is
+    dropped, like str2sexpr does.
+    """
+    if isinstance(s, str):
+        s = s.encode()
+    elif not isinstance(s, (bytes, bytearray)):
+        s = bytes(s)
+    for c in _SLOW_PATH_CHARS:
+        if c in s:
+            return _tokens2sexpr(s)
+    # every separator becomes '","' with brackets in between, e.g.
+    # '(n hj1) (ax 0.1)' -> '["n","hj1"],["ax","0.1"]', adjacent separators
+    # leave empty strings behind which are removed afterwards.
+    j = s.replace(b') (', b'"],["').replace(b' ', b'","').replace(b'(', b'",["').replace(b')', b'"],"')
+    j = (b'["' + j + b'"]').replace(b',""', b'')
+    if b'[""' in j:
+        j = j.replace(b'["",', b'[').replace(b'[""]', b'[]')
+    j = j.decode()
+    try:
+        sexp, end = _json_scan(j, 0)
+    except (StopIteration, ValueError):
+        end = -1
+    if end != len(j):
+        return _tokens2sexpr(s)
+    return sexp
+
+
 ##  sexpr2str
 ##
 def sexpr2str(e):
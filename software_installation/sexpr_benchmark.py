@@ -0,0 +1,127 @@
+'''Microbenchmark of the sexpr readers and of Perception decoding on
+SimSpark perceptor messages
+
+usage: python sexpr_benchmark.py [messages_file] [number]
+
+simspark_messages.txt holds one NAO perceptor message per line, as SimSpark
+sends them after the length header: 22 hinge joints, FRP, GYR, ACC, GPS
+and both camera blocks on every third cycle.
+
+bytes2sexpr is about 5-6x as fast as str2sexpr, not 10x: creating the
+~1200 str and list objects of a message in the C json scanner alone takes
+about a twelfth of str2sexpr, and the bytes.replace passes rewriting the
+message cost about as much again.
+
+Before timing, both readers are run on the messages, on EDGE_CASES and on
+random strings of separators, parentheses, quotes, escapes and comments,
+and have to agree. Perception.decode has to agree with
+Perception.update(bytes2sexpr(msg)) on the messages and on DEEP_MESSAGES.
+'''
+
+import contextlib
+import io
+import random
+import sys
+from os import path
+from timeit import repeat
+
+import numpy as np
+
+from sexpr import str2sexpr, bytes2sexpr
+from spark_agent import Perception
+
+MESSAGES_FILE = path.join(path.dirname(path.abspath(__file__)), 'simspark_messages.txt')
+# inputs off the fast path, each must parse like str2sexpr
+EDGE_CASES = [b'(a) ;c', b'(a ;c\n b)', b';c\n(a)', b'(a "q r" s)', b'(a\t(b))',
+              b'(a))(b)', b'(a (b', b'(a) (b', b'x (a) y', b'()',
+              b'a \\.', b'(a\\ b)', b'("a\\"b" c)', b'a\\', b'(a\\', b'"x y', b'(a "x) y',
+              b'a"b"c', b'("" x)', b'(a\rb)', b'(a \\;c)']
+# a perceptor nested deeper than the fixed layouts, and a fixed layout inside another perceptor
+DEEP_MESSAGES = [b'(time (now 1.5))(See (P (team a) (id 1) (head (pol (a (b (c (d (e 1)))))))))(HJ (n hj1) (ax 10.0))',
+                 b'(See (P (team a) (HJ (n hj3) (ax 1.0))))(HJ (n hj1) (ax 10.0) (tp 30.0))']
+FUZZ_CHARS = ' \t\n\r();"\\ab1.-'
+
+
+def check_equivalence(messages, fuzz=20000, seed=0):
+    '''assert that bytes2sexpr and str2sexpr agree on messages, EDGE_CASES and
+    fuzz random strings of FUZZ_CHARS
+    '''
+    rng = random.Random(seed)
+    inputs = messages + EDGE_CASES + [''.join(rng.choice(FUZZ_CHARS) for _ in range(rng.randint(0, 12))).encode()
+                                      for _ in range(fuzz)]
+    # str2sexpr prints the unbalanced parentheses it ignores
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = [str2sexpr(msg.decode()) for msg in inputs]
+    for msg, sexp in zip(inputs, expected):
+        assert bytes2sexpr(msg) == sexp, 'readers disagree on %r' % msg[:40]
+
+
+def check_decode(messages):
+    '''assert that Perception.decode(msg) and Perception.update(bytes2sexpr(msg))
+    agree on messages and DEEP_MESSAGES
+    '''
+    for msg in messages + DEEP_MESSAGES:
+        decoded, updated = Perception(), Perception()
+        decoded.decode(msg)
+        updated.update(bytes2sexpr(msg))
+        assert np.allclose(decoded.data, updated.data), 'decode differs on %r' % msg[:40]
+        assert np.array_equal(decoded.joint.present, updated.joint.present), 'decode differs on %r' % msg[:40]
+        for name in ('fsr', 'see', 'gps', 'us'):
+            assert getattr(decoded, name) == getattr(updated, name), 'decode differs in %s on %r' % (name, msg[:40])
+        assert vars(decoded.game_state) == vars(updated.game_state), 'decode differs on %r' % msg[:40]
+
+
+def load_messages(filename=MESSAGES_FILE):
+    with open(filename, 'rb') as f:
+        return [line.rstrip(b'\n') for line in f if line.strip()]
+
+
+def benchmark(messages, number=20):
+    '''return seconds per message of (str2sexpr, bytes2sexpr)'''
+    check_equivalence(messages)
+
+    def run_str():
+        for msg in messages:
+            str2sexpr(msg.decode())
+
+    def run_bytes():
+        for msg in messages:
+            bytes2sexpr(msg)
+
+    n = number * len(messages)
+    return (min(repeat(run_str, number=number, repeat=5)) / n,
+            min(repeat(run_bytes, number=number, repeat=5)) / n)
+
+
+def benchmark_perception(messages, number=20):
+    '''return seconds per message of (Perception.update(str2sexpr(...)), Perception.decode)'''
+    check_decode(messages)
+    perception = Perception()
+
+    def run_update():
+        for msg in messages:
+            perception.update(str2sexpr(msg.decode()))
+
+    def run_decode():
+        for msg in messages:
+            perception.decode(msg)
+
+    n = number * len(messages)
+    return (min(repeat(run_update, number=number, repeat=5)) / n,
+            min(repeat(run_decode, number=number, repeat=5)) / n)
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else MESSAGES_FILE
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    messages = load_messages(filename)
+    t_str, t_bytes = benchmark(messages, number)
+    print('%d messages, %.0f bytes on average' % (len(messages), sum(map(len, messages)) / float(len(messages))))
+    print('str2sexpr:   %8.1f us/message' % (t_str * 1e6))
+    print('bytes2sexpr: %8.1f us/message' % (t_bytes * 1e6))
+    print('speedup:     %8.1fx' % (t_str / t_bytes))
+
+    t_update, t_decode = benchmark_perception(messages, number)
+    print('Perception.update(str2sexpr(msg)): %8.1f us/message' % (t_update * 1e6))
+    print('Perception.decode(msg):            %8.1f us/message' % (t_decode * 1e6))
+    print('speedup:                           %8.1fx' % (t_update / t_decode))
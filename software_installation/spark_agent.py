@@ -1,11 +1,17 @@
 '''Base agent for SimSpark, it implements the sense-think-act loop
 '''
 from builtins import bytes
+import re
 import socket
 import struct
+from collections.abc import MutableMapping
 from threading import Thread
 from math import pi, atan2, asin, cos, sin
-from sexpr import str2sexpr
+import numpy as np
+from sexpr import bytes2sexpr
+from spark_socket import FrameReader
+from cycle_timer import CycleTimer, NULL_SECTION, perf_counter_ns
+from spark_log import SparkLogWriter, SparkLogReader, RecordingConnection, ReplayConnection
 
 DEG_TO_RAD = pi / 180
 
@@ -101,6 +107,103 @@ INVERSED_JOINTS = ['HeadPitch',
                    'LAnklePitch',
                    'RAnklePitch']
 
+# canonical joint order, all joint arrays are indexed like this
+JOINT_NAMES = tuple(JOINT_CMD_NAMES)
+JOINT_INDEX = {name: i for i, name in enumerate(JOINT_NAMES)}
+JOINT_SENSOR_INDEX = {sensor.encode(): JOINT_INDEX[name] for sensor, name in JOINT_SENSOR_NAMES.items()}
+JOINT_SIGNS = np.array([-1.0 if name in INVERSED_JOINTS else 1.0 for name in JOINT_NAMES])
+_JOINT_SCALE = JOINT_SIGNS * DEG_TO_RAD
+
+# joint limits (min, max) in rad for the angles of JOINT_NAMES, from the NAO H25 V4
+# joint documentation, doc.aldebaran.com/2-1/family/nao_h25/joints_h25.html
+JOINT_LIMITS = {name: (lo * DEG_TO_RAD, hi * DEG_TO_RAD) for name, (lo, hi) in {
+    'HeadYaw': (-119.5, 119.5),
+    'HeadPitch': (-38.5, 29.5),
+    'LShoulderPitch': (-119.5, 119.5),
+    'LShoulderRoll': (-18.0, 76.0),
+    'LElbowYaw': (-119.5, 119.5),
+    'LElbowRoll': (-88.5, -2.0),
+    'LHipYawPitch': (-65.62, 42.44),
+    'LHipRoll': (-21.74, 45.29),
+    'LHipPitch': (-88.00, 27.73),
+    'LKneePitch': (-5.29, 121.04),
+    'LAnklePitch': (-68.15, 52.86),
+    'LAnkleRoll': (-22.79, 44.06),
+    'RShoulderPitch': (-119.5, 119.5),
+    'RShoulderRoll': (-76.0, 18.0),
+    'RElbowYaw': (-119.5, 119.5),
+    'RElbowRoll': (2.0, 88.5),
+    'RHipYawPitch': (-65.62, 42.44),
+    'RHipRoll': (-45.29, 21.74),
+    'RHipPitch': (-88.00, 27.73),
+    'RKneePitch': (-5.90, 121.47),
+    'RAnklePitch': (-67.97, 53.40),
+    'RAnkleRoll': (-44.06, 22.80)}.items()}
+
+
+# perceptors with a fixed layout are read straight from the message bytes,
+# the text between them (GS, vision, BAT, US, other layouts) goes through
+# bytes2sexpr
+_NUMBER = rb'([^\s()]+)'
+_NAME = rb'\(n\s+([^\s()]+)\)\s*'
+_PERCEPTORS = re.compile(
+    rb'\(HJ\s*' + _NAME + rb'\(ax\s+' + _NUMBER + rb'\)\s*(?:\(tp\s+' + _NUMBER + rb'\)\s*)?\)'
+    rb'|\(time\s*\(now\s+' + _NUMBER + rb'\)\s*\)'
+    rb'|\((GYR|ACC)\s*\(n\s+[^\s()]+\)\s*\((?:rt|a)\s+([^()]+)\)\s*\)'
+    rb'|\(GPS\s*' + _NAME + rb'\(tf\s+([^()]+)\)\s*\)'
+    rb'|\(FRP\s*' + _NAME + rb'\(c\s+([^()]+)\)\s*\(f\s+([^()]+)\)\s*\)')
+
+
+class JointView(MutableMapping):
+    '''dict of joint name -> value on top of an array in JOINT_NAMES order
+
+    Only joints which have been set are in the view, like in a plain dict.
+    Names which are not in JOINT_NAMES (e.g. LWristYaw from Choregraphe
+    keyframes) are kept in an ordinary dict next to the array.
+    '''
+    def __init__(self, values, present):
+        self.values = values
+        self.present = present
+        self.extra = {}
+
+    def __getitem__(self, name):
+        i = JOINT_INDEX.get(name)
+        if i is None:
+            return self.extra[name]
+        if not self.present[i]:
+            raise KeyError(name)
+        return float(self.values[i])
+
+    def __setitem__(self, name, value):
+        i = JOINT_INDEX.get(name)
+        if i is None:
+            self.extra[name] = value
+        else:
+            self.values[i] = value
+            self.present[i] = True
+
+    def __delitem__(self, name):
+        i = JOINT_INDEX.get(name)
+        if i is None:
+            del self.extra[name]
+        elif not self.present[i]:
+            raise KeyError(name)
+        else:
+            self.present[i] = False
+
+    def __iter__(self):
+        for name, p in zip(JOINT_NAMES, self.present):
+            if p:
+                yield name
+        for name in list(self.extra):
+            yield name
+
+    def __len__(self):
+        return int(self.present.sum()) + len(self.extra)
+
+    def __repr__(self):
+        return repr(dict(self))
+
 
 class GameState:
     def __init__(self):
@@ -122,19 +225,146 @@ class GameState:
                 self.team = s[1]
 
 
-class Perception:
+# layout of the float64 buffer behind Perception and PerceptionSnapshot
+N_JOINTS = len(JOINT_NAMES)
+PERCEPTION_LAYOUT = (('time', 1),
+                     ('joint_angles', N_JOINTS),
+                     ('joint_temperatures', N_JOINTS),
+                     ('gyr', 3),
+                     ('acc', 3),
+                     ('imu', 2))  # [AngleX, AngleY]
+PERCEPTION_SIZE = sum(n for _, n in PERCEPTION_LAYOUT)
+
+
+def _perception_views(data):
+    '''return read-only views of data for every field of PERCEPTION_LAYOUT'''
+    views = {}
+    offset = 0
+    for name, n in PERCEPTION_LAYOUT:
+        view = data[offset:offset + n]
+        view.flags.writeable = False
+        views[name] = view
+        offset += n
+    return views
+
+
+class PerceptionSnapshot(object):
+    '''copy of the numeric part of a Perception, e.g. for logging every cycle'''
+    __slots__ = ('data', 'joint_angles', 'joint_temperatures', 'gyr', 'acc', 'imu')
+
+    def __init__(self, data):
+        self.data = data
+        views = _perception_views(data)
+        for name, _ in PERCEPTION_LAYOUT[1:]:
+            setattr(self, name, views[name])
+
+    @property
+    def time(self):
+        return float(self.data[0])
+
+
+class Perception(object):
+    '''Sensor data of the robot.
+
+    All numeric sensors live in one contiguous float64 buffer `data`, see
+    PERCEPTION_LAYOUT. joint_angles, joint_temperatures, gyr, acc and imu are
+    read-only views of it (joints in JOINT_NAMES order), so consumers never
+    copy. joint and joint_temperature are dict views of the same arrays.
+    '''
+    __slots__ = ('data', '_views', 'joint_angles', 'joint_temperatures', 'gyr', 'acc', 'imu',
+                 'joint', 'joint_temperature', 'fsr', 'see', 'game_state', 'gps', 'us', 'bat')
+
     def __init__(self):
-        self.time = 0
-        self.joint = {}
-        self.joint_temperature = {}
+        self.data = np.zeros(PERCEPTION_SIZE)
+        # writable views for updating, the public attributes are read-only
+        self._views = {}
+        offset = 0
+        for name, n in PERCEPTION_LAYOUT:
+            self._views[name] = self.data[offset:offset + n]
+            offset += n
+        for name, view in _perception_views(self.data).items():
+            if name != 'time':
+                setattr(self, name, view)
+        self.joint = JointView(self._views['joint_angles'], np.zeros(N_JOINTS, dtype=bool))
+        self.joint_temperature = JointView(self._views['joint_temperatures'], np.zeros(N_JOINTS, dtype=bool))
         self.fsr = {}
         self.see = [{}, {}]
         self.game_state = GameState()
         self.gps = {}
-        self.imu = [0, 0] # [AngleX, AngleY]
         self.us = {}
 
+    @property
+    def time(self):
+        return float(self.data[0])
+
+    @time.setter
+    def time(self, value):
+        self.data[0] = value
+
+    def snapshot(self):
+        return PerceptionSnapshot(self.data.copy())
+
+    def decode(self, msg):
+        '''update from a raw server message, the fixed layout perceptors are
+        read from the bytes directly without building the sexpr tree
+        '''
+        if not isinstance(msg, bytes):
+            msg = bytes(msg)
+        matches = list(_PERCEPTORS.finditer(msg))
+        others = []
+        end = 0
+        for m in matches:
+            others.append(msg[end:m.start()])
+            end = m.end()
+        others.append(msg[end:])
+        for other in others:
+            if other.count(b'(') != other.count(b')'):
+                # a match inside another expression: the whole message goes through the tree
+                self.update(bytes2sexpr(msg))
+                return
+        joint_indices = []
+        joint_degrees = []
+        temperature_indices = []
+        temperatures = []
+        for m in matches:
+            hj, ax, tp, now, vec, xyz, gps, tf, frp, c, f = m.groups()
+            if hj:
+                i = JOINT_SENSOR_INDEX[hj]
+                joint_indices.append(i)
+                joint_degrees.append(float(ax))
+                if tp:
+                    temperature_indices.append(i)
+                    temperatures.append(float(tp))
+            elif now:
+                self.data[0] = float(now)
+            elif vec == b'GYR':
+                self._views['gyr'][:] = [float(v) for v in xyz.split()]
+            elif vec:
+                self._views['acc'][:] = [float(v) for v in xyz.split()]
+            elif gps:
+                self.gps[gps.decode()] = [float(v) for v in tf.split()]
+            else:
+                self.fsr[frp.decode()] = {'c': [float(v) for v in c.split()],
+                                          'f': [float(v) for v in f.split()]}
+        if joint_indices:
+            angles = self._views['joint_angles']
+            angles[joint_indices] = joint_degrees
+            angles[joint_indices] *= _JOINT_SCALE[joint_indices]
+            self.joint.present[joint_indices] = True
+        if temperature_indices:
+            self._views['joint_temperatures'][temperature_indices] = temperatures
+            self.joint_temperature.present[temperature_indices] = True
+
+        other = b''.join(others)
+        if other.strip():
+            self._update(bytes2sexpr(other))
+        self._update_imu()
+
     def update(self, sexp):
+        self._update(sexp)
+        self._update_imu()
+
+    def _update(self, sexp):
         for s in sexp:
             name = s[0]
             if name == 'time':
@@ -142,9 +372,9 @@ class Perception:
             elif name == GAME_STATE_PERCEPTOR:
                 self.game_state.update(s[1:])
             elif name == GYRO_RATE_PERCEPTOR:
-                self.gyr = [float(v) for v in s[2][1:]]
+                self._views['gyr'][:] = [float(v) for v in s[2][1:]]
             elif name == ACCELEROMETER_PERCEPTOR:
-                self.acc = [float(v) for v in s[2][1:]]
+                self._views['acc'][:] = [float(v) for v in s[2][1:]]
             elif name == HINGE_JOINT_PERCEPTOR:
                 jointv = {}
                 for i in s[1:]:
@@ -170,6 +400,7 @@ class Perception:
             else:
                 raise RuntimeError('unknown perception: ' + str(s))
 
+    def _update_imu(self):
         if 'torso' in self.gps:
             data = self.gps['torso']
             angX = atan2(data[9], data[10])
@@ -180,7 +411,7 @@ class Perception:
                 angX = atan2(sin(angX), cos(angX))  # normalize
                 angY = pi - angY
                 angY = atan2(sin(angY), cos(angY))  # normalize
-            self.imu = [angX, angY]
+            self._views['imu'][:] = (angX, angY)
 
     def _parse_vision(self, sexp):
         see = {}
@@ -196,6 +427,9 @@ class Perception:
 
 
 class Action(object):
+    '''speed and stiffness of the joints, either dicts of joint name -> value
+    or arrays in JOINT_NAMES order with NaN for joints without command
+    '''
     def __init__(self):
         self.stiffness = {}
         self.speed = {}
@@ -205,8 +439,100 @@ class Action(object):
         stiffness = ['(%ss %.2f)' % (JOINT_CMD_NAMES[k], self.stiffness[k]) for k in self.stiffness]
         return ''.join(speed + stiffness)
 
+    def to_vectors(self):
+        '''return (speed, stiffness) as arrays in JOINT_NAMES order, None if empty'''
+        return _joint_vector(self.speed), _joint_vector(self.stiffness)
+
+
+def _joint_vector(values):
+    if isinstance(values, JointView):
+        return np.where(values.present, values.values, np.nan)
+    if isinstance(values, dict):
+        if not values:
+            return None
+        v = np.full(N_JOINTS, np.nan)
+        for name, value in values.items():
+            i = JOINT_INDEX.get(name)
+            if i is not None:
+                v[i] = value
+        return v
+    return np.asarray(values, dtype=float)
+
+
+SPEED_COMMANDS = [('(%s ' % JOINT_CMD_NAMES[name]).encode() for name in JOINT_NAMES]
+STIFFNESS_COMMANDS = [('(%ss ' % JOINT_CMD_NAMES[name]).encode() for name in JOINT_NAMES]
+_SPEED_SCALE = JOINT_SIGNS * 100
+_STIFFNESS_SCALE = np.full(N_JOINTS, 100.0)
+_FORMATTED_CACHE_SIZE = 10000
+
+
+class CommandEncoder(object):
+    '''Encodes speed and stiffness vectors into complete server messages.
+
+    The message is written into one reused bytearray with the length
+    header in front. Values are quantized to the 0.01 resolution of the
+    text format and a joint is only sent when its quantized value differs
+    from the last one sent, the server keeps the previous value otherwise.
+    '''
+    def __init__(self, sync_mode=True):
+        self.sync_mode = sync_mode
+        self.buffer = bytearray(4)
+        self._formatted = {}  # quantized value -> b'0.12)'
+        self.reset()
+
+    def reset(self):
+        '''forget what has been sent, the next message contains every commanded joint'''
+        self.last_speed = np.full(N_JOINTS, np.nan)
+        self.last_stiffness = np.full(N_JOINTS, np.nan)
+
+    def encode(self, speed=None, stiffness=None, commands=b''):
+        '''return the buffer holding length header and message,
+        it is overwritten by the next call
+        '''
+        buf = self.buffer
+        del buf[4:]
+        if speed is not None:
+            self._append(buf, SPEED_COMMANDS, self.last_speed, speed, _SPEED_SCALE)
+        if stiffness is not None:
+            self._append(buf, STIFFNESS_COMMANDS, self.last_stiffness, stiffness, _STIFFNESS_SCALE)
+        buf += commands
+        if self.sync_mode:
+            buf += b'(syn)'
+        struct.pack_into('!I', buf, 0, len(buf) - 4)
+        return buf
+
+    def encode_action(self, action):
+        speed, stiffness = action.to_vectors()
+        return self.encode(speed, stiffness)
+
+    def _append(self, buf, names, last, values, scale):
+        # values in units of 0.01, NaN (no command) never equals last
+        q = np.asarray(values, dtype=float) * scale
+        np.rint(q, out=q)
+        changed = np.flatnonzero(q != last)
+        if not len(changed):
+            return
+        formatted = self._formatted
+        if len(formatted) > _FORMATTED_CACHE_SIZE:
+            formatted.clear()
+        parts = []
+        for i, v in zip(changed.tolist(), q[changed].tolist()):
+            if v == v:
+                last[i] = v
+                f = formatted.get(v)
+                if f is None:
+                    f = formatted[v] = b'%.2f)' % (v / 100)
+                parts.append(names[i])
+                parts.append(f)
+        buf += b''.join(parts)
+
 
 class SparkAgent(object):
+    # SparkLogWriter or SparkLogReader, set by record/replay before __init__ runs
+    log = None
+    # CycleTimer, see enable_timing
+    timer = None
+
     def __init__(self, simspark_ip='localhost',
                  simspark_port=3100,
                  teamname='DAInamite',
@@ -216,6 +542,7 @@ class SparkAgent(object):
         self.sync_mode = sync_mode
         self.connect(simspark_ip, simspark_port)
         self.perception = Perception()
+        self.encoder = CommandEncoder(sync_mode)
 
         self.send_command('(scene rsg/agent/naov4/nao.rsg)')
         self.sense()  # only need to get msg from simspark
@@ -230,43 +557,100 @@ class SparkAgent(object):
         self.player_id = player_id
 
     def act(self, action):
-        commands = action.to_commands()
-        self.send_command(commands)
+        self.socket.sendall(self.encoder.encode_action(action))
 
     def send_command(self, commands):
         if self.sync_mode:
             commands += '(syn)'
         self.socket.sendall(struct.pack(b"!I", len(commands)) + bytes(commands, encoding='utf8'))
 
+    @classmethod
+    def record(cls, log_path, *args, **kwargs):
+        '''create the agent and log all frames and commands to log_path'''
+        agent = cls.__new__(cls)
+        agent.log = SparkLogWriter(log_path)
+        agent.__init__(*args, **kwargs)
+        return agent
+
+    @classmethod
+    def replay(cls, log_path, *args, **kwargs):
+        '''create the agent on the frames of a recorded log instead of a server'''
+        agent = cls.__new__(cls)
+        agent.log = SparkLogReader(log_path)
+        agent.__init__(*args, **kwargs)
+        return agent
+
     def connect(self, simspark_ip, simspark_port):
+        if isinstance(self.log, SparkLogReader):
+            self.socket = self.reader = ReplayConnection(self.log)
+            return
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((simspark_ip, simspark_port))
+        self.reader = FrameReader(self.socket)
+        if self.log is not None:
+            self.socket = self.reader = RecordingConnection(self.socket, self.reader, self.log)
 
     def sense(self):
-        length = b''
-        while(len(length) < 4):
-            length += self.socket.recv(4 - len(length))
-        length = struct.unpack("!I", length)[0]
-        msg = b''
-        while len(msg) < length:
-            msg += self.socket.recv(length - len(msg))
-
-        sexp = str2sexpr(msg.decode())
-        self.perception.update(sexp)
+        timer = self.timer
+        if timer is None:
+            frame = self.reader.read_frame()
+        else:
+            t0 = perf_counter_ns()
+            frame = self.reader.read_frame()
+            timer.recv = perf_counter_ns() - t0
+        self.perception.decode(frame)
         return self.perception
 
     def think(self, perception):
         action = Action()
         return action
 
+    def enable_timing(self, size=1024, deadline=0.02):
+        '''time the stages of every cycle, see cycle_timer.py'''
+        self.timer = CycleTimer(size, deadline)
+        return self.timer
+
+    def disable_timing(self):
+        self.timer = None
+
+    def timed(self, name):
+        '''context manager timing a section as stage name while timing is enabled'''
+        if self.timer is None:
+            return NULL_SECTION
+        return self.timer.section(name)
+
+    def count(self, name, n=1):
+        '''add n to counter name while timing is enabled'''
+        if self.timer is not None:
+            self.timer.count(name, n)
+
     def sense_think_act(self):
+        timer = self.timer
+        if timer is None:
+            perception = self.sense()
+            action = self.think(perception)
+            self.act(action)
+            return
+        # sense() stores the time spent waiting for the frame, an overridden
+        # sense() which does not call it is timed as decode as a whole
+        timer.recv = 0
+        t0 = perf_counter_ns()
         perception = self.sense()
+        t1 = perf_counter_ns()
         action = self.think(perception)
+        t2 = perf_counter_ns()
         self.act(action)
+        t3 = perf_counter_ns()
+        recv = timer.recv
+        timer.cycle(recv, t1 - t0 - recv, t2 - t1, t3 - t2)
 
     def run(self):
-        while True:
-            self.sense_think_act()
+        '''run until the server closes the connection'''
+        try:
+            while True:
+                self.sense_think_act()
+        except EOFError:
+            pass
 
     def start(self):
         if self.thread is None:
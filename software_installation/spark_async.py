@@ -0,0 +1,87 @@
+'''asyncio version of the sense-think-act loop
+
+A whole team runs in one thread on one event loop instead of a thread per
+player. AsyncSparkAgent wraps a connected SparkAgent, so the existing
+agents (PIDAgent, AngleInterpolationAgent, ...) are used unchanged:
+
+    agents = [AsyncSparkAgent(PIDAgent(player_id=i)) for i in range(1, 12)]
+    run_agents(agents)
+'''
+import asyncio
+import socket
+from time import perf_counter_ns
+
+
+class AsyncSparkAgent(object):
+    '''awaitable sense-think-act loop around a SparkAgent
+
+    The handshake is done by the SparkAgent constructor, afterwards its
+    socket is switched to non-blocking mode and served by the event loop.
+    Agents created with SparkAgent.record or SparkAgent.replay work as well.
+    think delegates to the wrapped agent and can be overridden.
+    '''
+    def __init__(self, agent):
+        if not isinstance(agent.socket, socket.socket) and not hasattr(agent.socket, 'sendall_async'):
+            raise TypeError('AsyncSparkAgent needs a socket, RecordingConnection or ReplayConnection, not %s'
+                            % type(agent.socket).__name__)
+        self.agent = agent
+        agent.socket.setblocking(False)
+
+    @property
+    def perception(self):
+        return self.agent.perception
+
+    async def sense(self):
+        # wait for a complete frame, then the agent's own sense() reads it without blocking
+        await self.agent.reader.wait_frame_async(asyncio.get_running_loop())
+        return self.agent.sense()
+
+    def think(self, perception):
+        return self.agent.think(perception)
+
+    async def act(self, action):
+        agent = self.agent
+        loop = asyncio.get_running_loop()
+        # the encoder buffer is reused, so wait until it is sent
+        if isinstance(agent.socket, socket.socket):
+            await loop.sock_sendall(agent.socket, agent.encoder.encode_action(action))
+        else:
+            await agent.socket.sendall_async(loop, agent.encoder.encode_action(action))
+
+    async def sense_think_act(self):
+        timer = self.agent.timer
+        if timer is None:
+            perception = await self.sense()
+            action = self.think(perception)
+            await self.act(action)
+            return
+        # the stages of SparkAgent.sense_think_act, waiting for the frame counts as recv
+        timer.recv = 0
+        t0 = perf_counter_ns()
+        await self.agent.reader.wait_frame_async(asyncio.get_running_loop())
+        t1 = perf_counter_ns()
+        perception = self.agent.sense()
+        t2 = perf_counter_ns()
+        action = self.think(perception)
+        t3 = perf_counter_ns()
+        await self.act(action)
+        t4 = perf_counter_ns()
+        recv = timer.recv
+        timer.cycle(t1 - t0 + recv, t2 - t1 - recv, t3 - t2, t4 - t3)
+
+    async def run(self):
+        '''run until the server closes the connection'''
+        try:
+            while True:
+                await self.sense_think_act()
+        except EOFError:
+            pass
+
+
+async def gather_agents(agents):
+    await asyncio.gather(*[agent.run() for agent in agents])
+
+
+def run_agents(agents):
+    '''run AsyncSparkAgents on a new event loop until all connections are closed'''
+    asyncio.run(gather_agents(agents))
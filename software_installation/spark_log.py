@@ -0,0 +1,191 @@
+'''Record and replay the traffic of a SparkAgent
+
+A log is an append-only data file holding the raw server frames and the
+command messages sent back, and an index file `<path>.idx` with one
+INDEX_DTYPE entry (offset, length, kind) per record. Replay maps the
+data file with mmap and hands the frames to sense() without a socket,
+so think() can be re-run deterministically much faster than real time:
+
+    agent = StandingUpAgent.record('fall.log')    # against simspark
+    agent.run()
+    agent = StandingUpAgent.replay('fall.log')    # offline
+    agent.run()
+    agent.socket.mismatches                       # commands which differ
+
+usage: python spark_log.py [cycles]
+records a PIDAgent run against fake_simspark and replays it
+'''
+import mmap
+import struct
+
+import numpy as np
+
+FRAME = 0  # received from the server
+COMMAND = 1  # sent to the server
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('kind', 'u1')])
+_INDEX_ENTRY = struct.Struct('<QIB')
+
+
+class SparkLogWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path, 'ab')
+        self.index = open(path + '.idx', 'ab')
+        self.offset = self.data.tell()
+
+    def write(self, kind, data):
+        n = len(data)
+        self.data.write(data)
+        self.index.write(_INDEX_ENTRY.pack(self.offset, n, kind))
+        self.offset += n
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class SparkLogReader(object):
+    '''memory-mapped log, records are returned as memoryviews'''
+    def __init__(self, path):
+        self.path = path
+        self.index = np.fromfile(path + '.idx', dtype=INDEX_DTYPE)
+        with open(path, 'rb') as f:
+            if self.index['length'].sum():
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.mmap = b''
+        self.view = memoryview(self.mmap)
+
+    def __len__(self):
+        return len(self.index)
+
+    def record(self, i):
+        '''return (kind, data) of the i-th record'''
+        offset, length, kind = self.index[i].tolist()
+        return kind, self.view[offset:offset + length]
+
+    def offsets(self, kind):
+        '''return [(offset, end)] of all records of kind'''
+        entries = self.index[self.index['kind'] == kind]
+        offsets = entries['offset'].astype(np.int64)
+        return list(zip(offsets.tolist(), (offsets + entries['length']).tolist()))
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+
+
+class RecordingConnection(object):
+    '''socket and frame reader of an agent which log all traffic'''
+    def __init__(self, sock, reader, log):
+        self.sock = sock
+        self.reader = reader
+        self.log = log
+
+    def read_frame(self):
+        try:
+            frame = self.reader.read_frame()
+        except EOFError:
+            self.log.flush()
+            raise
+        self.log.write(FRAME, frame)
+        return frame
+
+    async def wait_frame_async(self, loop):
+        try:
+            await self.reader.wait_frame_async(loop)
+        except EOFError:
+            self.log.flush()
+            raise
+
+    def sendall(self, data):
+        self.log.write(COMMAND, data)
+        self.sock.sendall(data)
+
+    async def sendall_async(self, loop, data):
+        self.log.write(COMMAND, data)
+        await loop.sock_sendall(self.sock, data)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def close(self):
+        self.log.close()
+        self.sock.close()
+
+
+class ReplayConnection(object):
+    '''plays a log back as socket and frame reader of an agent
+
+    The commands the agent sends are compared with the recorded ones,
+    mismatches counts the differences.
+    '''
+    def __init__(self, log):
+        self.log = log
+        self.frames = log.offsets(FRAME)
+        self.commands = log.offsets(COMMAND)
+        self.next_frame = 0
+        self.next_command = 0
+        self.mismatches = 0
+
+    def read_frame(self):
+        if self.next_frame >= len(self.frames):
+            raise EOFError('end of log')
+        start, end = self.frames[self.next_frame]
+        self.next_frame += 1
+        return self.log.view[start:end]
+
+    async def wait_frame_async(self, loop):
+        pass  # read_frame never blocks
+
+    def sendall(self, data):
+        if self.next_command < len(self.commands):
+            start, end = self.commands[self.next_command]
+            if self.log.view[start:end] != data:
+                self.mismatches += 1
+        else:
+            self.mismatches += 1
+        self.next_command += 1
+
+    async def sendall_async(self, loop, data):
+        self.sendall(data)
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        self.log.close()
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import tempfile
+    import time
+    sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', 'joint_control'))
+    from fake_simspark import FakeSimSpark
+    from pid import PIDAgent
+
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    path = os.path.join(tempfile.mkdtemp(), 'pid.log')
+    server = FakeSimSpark(cycles=cycles).start()
+    agent = PIDAgent.record(path, simspark_port=server.port)
+    agent.target_joints['HeadYaw'] = 0.5
+    agent.run()
+    agent.socket.close()
+
+    agent = PIDAgent.replay(path)
+    agent.target_joints['HeadYaw'] = 0.5
+    start = time.perf_counter()
+    agent.run()
+    elapsed = time.perf_counter() - start
+    replay = agent.socket
+    print('%d frames in %.2fs, %.0f frames/s, %d command mismatches'
+          % (len(replay.frames), elapsed, len(replay.frames) / elapsed, replay.mismatches))
+    replay.close()
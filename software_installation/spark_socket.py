@@ -0,0 +1,146 @@
+'''Receive path for SimSpark connections
+
+FrameReader reads the length prefixed server messages with recv_into into
+one growable buffer. A single recv can bring several frames, which are
+handed out as memoryviews of the buffer without copying.
+
+SparkSelector runs the sense-think-act loop of many agents in one thread,
+driven by a selectors.DefaultSelector over their non-blocking sockets.
+'''
+import selectors
+import struct
+
+HEADER = struct.Struct('!I')
+
+
+class FrameReader(object):
+    '''length prefixed frames from a socket
+
+    A frame returned by next_frame/read_frame is a view of the internal
+    buffer and only valid until the next call of fill.
+    '''
+    def __init__(self, sock, size=1 << 16):
+        self.sock = sock
+        self._reset_buffer(bytearray(size))
+        self.start = 0  # first unread byte
+        self.end = 0  # end of received bytes
+
+    def _reset_buffer(self, buf):
+        self.buffer = buf
+        self.view = memoryview(buf)
+
+    def _make_room(self, needed):
+        '''make sure `needed` bytes from start fit into the buffer'''
+        pending = self.end - self.start
+        if needed > len(self.buffer):
+            buf = bytearray(max(needed, 2 * len(self.buffer)))
+            buf[:pending] = self.view[self.start:self.end]
+            # frames handed out before keep the old buffer alive
+            self._reset_buffer(buf)
+        elif self.start + needed > len(self.buffer):
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            return
+        self.start = 0
+        self.end = pending
+
+    def _free_view(self):
+        '''return the free part of the buffer to receive into'''
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            self._make_room(self.end - self.start + 1)
+        return self.view[self.end:]
+
+    def _received(self, n):
+        if n == 0:
+            raise EOFError('connection closed by server')
+        self.end += n
+        return n
+
+    def fill(self):
+        '''receive once, return the number of bytes read
+
+        returns 0 if a non-blocking socket has no data, raises EOFError
+        when the connection is closed.
+        '''
+        free = self._free_view()
+        try:
+            n = self.sock.recv_into(free)
+        except BlockingIOError:
+            return 0
+        return self._received(n)
+
+    def next_frame(self):
+        '''return the next complete frame in the buffer or None'''
+        available = self.end - self.start
+        if available < HEADER.size:
+            return None
+        length = HEADER.unpack_from(self.buffer, self.start)[0]
+        size = HEADER.size + length
+        if available < size:
+            self._make_room(size)
+            return None
+        frame = self.view[self.start + HEADER.size:self.start + size]
+        self.start += size
+        return frame
+
+    def frame_ready(self):
+        '''return True if a complete frame is in the buffer, so read_frame does not block'''
+        available = self.end - self.start
+        return (available >= HEADER.size and
+                available >= HEADER.size + HEADER.unpack_from(self.buffer, self.start)[0])
+
+    def read_frame(self):
+        '''block until a frame is complete and return it'''
+        frame = self.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.next_frame()
+        return frame
+
+    async def wait_frame_async(self, loop):
+        '''receive on an asyncio event loop until a frame is complete, for a non-blocking socket'''
+        while not self.frame_ready():
+            self._received(await loop.sock_recv_into(self.sock, self._free_view()))
+
+
+class SparkSelector(object):
+    '''serves the sockets of many SparkAgents from one thread
+
+    The sockets are switched to non-blocking mode. Commands are small, so
+    SparkAgent.act is not expected to block on sending.
+    '''
+    def __init__(self, agents=()):
+        self.selector = selectors.DefaultSelector()
+        for agent in agents:
+            self.register(agent)
+
+    def register(self, agent):
+        agent.socket.setblocking(False)
+        self.selector.register(agent.socket, selectors.EVENT_READ, agent)
+
+    def unregister(self, agent):
+        self.selector.unregister(agent.socket)
+
+    def poll(self, timeout=None):
+        '''run sense-think-act for every frame that arrived, return the number of frames'''
+        frames = 0
+        for key, _ in self.selector.select(timeout):
+            agent = key.data
+            reader = agent.reader
+            try:
+                reader.fill()
+            except EOFError:
+                self.unregister(agent)
+                continue
+            # sense() reads the frames which are complete without blocking
+            while reader.frame_ready():
+                agent.sense_think_act()
+                frames += 1
+        return frames
+
+    def run(self):
+        '''serve until all connections are closed'''
+        while self.selector.get_map():
+            self.poll()
@@ -0,0 +1,153 @@
+'''Run a team of agents in a process pool with a shared-memory blackboard
+
+Every player runs in its own process, pinned to a CPU where the platform
+supports it. After each sense the player publishes its perception to the
+Blackboard, a structured NumPy array in multiprocessing.shared_memory, so
+team-level code can read the whole team without sockets or pickling:
+
+    team = Team(PIDAgent, 11, teamname='DAInamite').start()
+    board = team.board
+    board.read_all()['joint_angles']
+
+usage: python team.py [n_players] [cycles]
+runs SparkAgents against fake_simspark and prints the blackboard
+'''
+import multiprocessing
+import os
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from spark_agent import SparkAgent, N_JOINTS
+
+BLACKBOARD_DTYPE = np.dtype([('seq', np.uint64),  # odd while being written
+                             ('unum', np.int32),
+                             ('time', np.float64),
+                             ('joint_angles', np.float64, N_JOINTS),
+                             ('gps', np.float64, 16),  # torso transform
+                             ('imu', np.float64, 2),
+                             ('posture', 'S16')])
+
+
+class Blackboard(object):
+    '''latest state of every player, one BLACKBOARD_DTYPE record each
+
+    Each record is guarded by a sequence lock: a player is the only writer
+    of its record, readers retry until they got a consistent copy.
+    Without name a new shared memory block is created, otherwise the
+    existing one is attached.
+    '''
+    def __init__(self, n_players, name=None):
+        self.n_players = n_players
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None,
+                                              size=BLACKBOARD_DTYPE.itemsize * n_players)
+        self.name = self.shm.name
+        self.players = np.ndarray((n_players,), BLACKBOARD_DTYPE, buffer=self.shm.buf)
+        self._seq = self.players['seq']
+
+    def write(self, i, perception, posture=''):
+        record = self.players[i:i + 1]
+        self._seq[i] += 1
+        record['unum'] = perception.game_state.unum
+        record['time'] = perception.time
+        record['joint_angles'] = perception.joint_angles
+        gps = perception.gps.get('torso')
+        if gps is not None:
+            record['gps'] = gps
+        record['imu'] = perception.imu
+        record['posture'] = posture.encode()[:16]
+        self._seq[i] += 1
+
+    def read(self, i):
+        '''return a consistent copy of the record of player i'''
+        while True:
+            seq = self._seq[i]
+            record = self.players[i].copy()
+            if seq % 2 == 0 and self._seq[i] == seq:
+                return record
+
+    def read_all(self):
+        return np.array([self.read(i) for i in range(self.n_players)], dtype=BLACKBOARD_DTYPE)
+
+    def close(self):
+        self.players = self._seq = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def _pin_cpu(index):
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+
+
+def _run_player(agent_class, index, board_name, n_players, pin_cpu, agent_kwargs):
+    if pin_cpu:
+        _pin_cpu(index)
+    board = Blackboard(n_players, board_name)
+    try:
+        agent = agent_class(player_id=index + 1, **agent_kwargs)
+        try:
+            while True:
+                agent.sense_think_act()
+                board.write(index, agent.perception, getattr(agent, 'posture', ''))
+        except EOFError:
+            pass
+        return agent.player_id
+    finally:
+        board.close()
+
+
+class Team(object):
+    '''n_players agents of agent_class, player i gets the number i + 1'''
+    def __init__(self, agent_class, n_players, pin_cpu=True, **agent_kwargs):
+        self.agent_class = agent_class
+        self.n_players = n_players
+        self.pin_cpu = pin_cpu
+        self.agent_kwargs = agent_kwargs
+        self.board = Blackboard(n_players)
+        self.pool = None
+        self.result = None
+
+    def start(self):
+        self.pool = multiprocessing.Pool(self.n_players)
+        args = [(self.agent_class, i, self.board.name, self.n_players, self.pin_cpu, self.agent_kwargs)
+                for i in range(self.n_players)]
+        self.result = self.pool.starmap_async(_run_player, args, chunksize=1)
+        return self
+
+    def join(self, timeout=None):
+        '''wait until all players are done, return their player ids'''
+        player_ids = self.result.get(timeout)
+        self.pool.close()
+        self.pool.join()
+        return player_ids
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.board.close()
+        self.board.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    from fake_simspark import FakeSimSpark
+    n_players = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    server = FakeSimSpark(cycles=cycles).start()
+    with Team(SparkAgent, n_players, simspark_port=server.port) as team:
+        print('players', team.start().join())
+        board = team.board.read_all()
+        print('unum', board['unum'])
+        print('time', board['time'])
+        print('seq ', board['seq'])